@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import click
+import collections
+import os
+import os.path
+import re
+import time
+import zlib
+
+import datadiff
+import storage
+
+# Content below this size is cheaper to store inline than as a reference.
+DEFAULT_MIN_BLOB_SIZE = 1024
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{16,128}$")
+
+def _check_digest(digest):
+    if not _DIGEST_RE.match(digest):
+        raise ValueError("invalid blob digest {}".format(repr(digest)))
+
+class BlobStore(object):
+    # Payloads addressed by the digest of their content hash, shared
+    # between all keys (and stores) that reference them.
+    min_blob_size = DEFAULT_MIN_BLOB_SIZE
+
+    def has_blob(self, digest):
+        raise NotImplementedError()
+
+    def touch_blob(self, digest):
+        # Marks an existing blob as just used, so garbage collection keeps
+        # it for another grace period; returns whether it exists.
+        return self.has_blob(digest)
+
+    def put_blob(self, digest, data):
+        raise NotImplementedError()
+
+    def get_blob(self, digest):
+        raise NotImplementedError()
+
+    def delete_blob(self, digest):
+        raise NotImplementedError()
+
+    def list_blobs(self):
+        raise NotImplementedError()
+
+    def blob_age(self, digest):
+        return None
+
+class InMemoryBlobStore(BlobStore):
+    def __init__(self, min_blob_size=DEFAULT_MIN_BLOB_SIZE):
+        self.min_blob_size = min_blob_size
+        self._blobs = {}
+
+    def has_blob(self, digest):
+        return digest in self._blobs
+
+    def put_blob(self, digest, data):
+        self._blobs.setdefault(digest, bytes(data))
+
+    def get_blob(self, digest):
+        return self._blobs[digest]
+
+    def delete_blob(self, digest):
+        del self._blobs[digest]
+
+    def list_blobs(self):
+        return sorted(self._blobs)
+
+class LocalFileBlobStore(BlobStore):
+    # One zlib-compressed file per blob, fanned out by digest prefix.
+    def __init__(self, outpath, min_blob_size=DEFAULT_MIN_BLOB_SIZE):
+        self._outpath = outpath
+        self._abspath = os.path.abspath(outpath)
+        self.min_blob_size = min_blob_size
+        if not os.path.exists(self._abspath):
+            raise ValueError("blob path {} does not exist".format(outpath))
+
+    def __repr__(self):
+        return "LocalFileBlobStore({})".format(repr(self._outpath))
+
+    def _blob_path(self, digest):
+        _check_digest(digest)
+        return os.path.join(self._abspath, digest[:2], digest)
+
+    def has_blob(self, digest):
+        return os.path.exists(self._blob_path(digest))
+
+    def touch_blob(self, digest):
+        try:
+            os.utime(self._blob_path(digest))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put_blob(self, digest, data):
+        path = self._blob_path(digest)
+        if self.touch_blob(digest):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpfile = "{}.{}{}".format(path, os.getpid(), storage._TMP_SUFFIX)
+        try:
+            with open(tmpfile, "xb") as f:
+                f.write(zlib.compress(data))
+                f.flush()
+                os.fsync(f.fileno())
+            # Concurrent writers of the same blob write the same bytes.
+            os.replace(tmpfile, path)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def get_blob(self, digest):
+        try:
+            with open(self._blob_path(digest), "rb") as f:
+                return zlib.decompress(f.read())
+        except FileNotFoundError:
+            raise KeyError(digest)
+
+    def delete_blob(self, digest):
+        try:
+            os.remove(self._blob_path(digest))
+        except FileNotFoundError:
+            raise KeyError(digest)
+
+    def list_blobs(self):
+        rv = []
+        for dp, dn, fn in os.walk(self._abspath):
+            rv.extend(f for f in fn if _DIGEST_RE.match(f))
+        rv.sort()
+        return rv
+
+    def blob_age(self, digest):
+        try:
+            return time.time() - os.path.getmtime(self._blob_path(digest))
+        except FileNotFoundError:
+            return None
+
+def open_blob_store(path, min_blob_size=DEFAULT_MIN_BLOB_SIZE):
+    if path is None:
+        return None
+    return LocalFileBlobStore(path, min_blob_size=min_blob_size)
+
+def count_references(stores):
+    rv = collections.Counter()
+    for store in stores:
+        rv.update(datadiff.blob_references(store))
+    return rv
+
+def collect_garbage(blob_store, stores, grace_period=3600.0, dry_run=False):
+    # Mark and sweep: references are counted by scanning every chunk of
+    # every store that may use the blob store. Writers touch a blob every
+    # time a new record references it, so blobs used within the grace
+    # period are kept even if the chunk referencing them is not written yet.
+    refcounts = count_references(stores)
+    deleted = []
+    for digest in blob_store.list_blobs():
+        if refcounts[digest]:
+            continue
+        age = blob_store.blob_age(digest)
+        if age is not None and age < grace_period:
+            continue
+        if not dry_run:
+            blob_store.delete_blob(digest)
+        deleted.append(digest)
+    return deleted
+
+@click.command()
+@click.option("--blob-dir", required=True,
+              help="Directory containing shared blobs.")
+@click.option("--data-dir", multiple=True, required=True,
+              help="Directory containing datawatch data referencing the blobs; repeat for every store using them.")
+@click.option("--grace-period", default=3600.0, show_default=True,
+              help="Keep unreferenced blobs younger than this many seconds.")
+@click.option("--dry-run/--no-dry-run",
+              default=False, show_default=True, type=bool,
+              help="Only report how many blobs would be deleted.")
+def main(blob_dir, data_dir, grace_period, dry_run):
+    stores = [storage.open_storage(d) for d in data_dir]
+    try:
+        deleted = collect_garbage(LocalFileBlobStore(blob_dir), stores, grace_period=grace_period, dry_run=dry_run)
+    finally:
+        for store in stores:
+            store.close()
+    print("{} {} unreferenced blobs.".format("Would delete" if dry_run else "Deleted", len(deleted)))
+
+if __name__ == "__main__":
+    main()
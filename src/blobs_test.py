@@ -0,0 +1,86 @@
+from .blobs import *
+
+import datadiff
+import methods
+import os
+import pytest
+import storage
+import time
+
+def _content(i):
+    return "\n".join("line {} {}".format(i, j) for j in range(500)).encode("utf-8")
+
+def test_identical_content_is_stored_once():
+    store = storage.InMemoryStorage()
+    blob_store = InMemoryBlobStore()
+    coll = datadiff.Collection(store, blobs=blob_store)
+    keys = ["https://example.com/{}".format(i) for i in range(5)]
+    for key in keys:
+        coll.update_data(key, _content(0), "1000")
+    for key in keys:
+        coll.update_data(key, _content(1), "1001")
+    coll.checkpoint_all()
+    # Later versions that diff well against the previous one stay diffs.
+    assert len(blob_store.list_blobs()) == 1
+    assert list(count_references([store]).values()) == [5]
+    assert not any(b"\"full" in data for data in store._data.values())
+    for key in keys:
+        kh = coll._compute_keyhash(key)
+        entry = datadiff.Collection(store, full_history=True, blobs=blob_store, chunk_cache=None)[kh]
+        assert [inc.data for inc in entry.incarnations()] == [_content(0), _content(1)]
+    with pytest.raises(ValueError):
+        datadiff.Collection(store, full_history=True, chunk_cache=None)[coll._compute_keyhash(keys[0])]
+
+def test_small_content_is_inline():
+    store = storage.InMemoryStorage()
+    blob_store = InMemoryBlobStore()
+    coll = datadiff.Collection(store, blobs=blob_store)
+    coll.update_data("https://example.com/", b"", "1000")
+    coll.checkpoint_all()
+    assert blob_store.list_blobs() == []
+
+def test_collect_garbage(tmp_path):
+    blob_store = LocalFileBlobStore(str(tmp_path))
+    store = storage.InMemoryStorage()
+    coll = datadiff.Collection(store, blobs=blob_store)
+    coll.update_data("https://example.com/", _content(0), "1000")
+    coll.checkpoint_all()
+    referenced = blob_store.list_blobs()
+    assert len(referenced) == 1
+    unreferenced = methods.compute_content_hash(_content(1))["digest"]
+    blob_store.put_blob(unreferenced, _content(1))
+    assert blob_store.get_blob(unreferenced) == _content(1)
+    assert collect_garbage(blob_store, [store]) == []
+    assert collect_garbage(blob_store, [store], grace_period=0, dry_run=True) == [unreferenced]
+    assert collect_garbage(blob_store, [store], grace_period=0) == [unreferenced]
+    assert blob_store.list_blobs() == referenced
+    with pytest.raises(KeyError):
+        blob_store.get_blob(unreferenced)
+
+def test_reused_blob_survives_garbage_collection(tmp_path):
+    blob_store = LocalFileBlobStore(str(tmp_path))
+    digest = methods.compute_content_hash(_content(0))["digest"]
+    blob_store.put_blob(digest, _content(0))
+    old = time.time() - 7200
+    os.utime(blob_store._blob_path(digest), (old, old))
+    # A new version reuses the aged blob, but its chunk is not written yet.
+    store = storage.InMemoryStorage()
+    entry = datadiff.Entry.create_initial("https://example.com/", _content(0), "1000")
+    records = list(entry._generate_records(blobs=blob_store))
+    assert "blob" in records[0]["content"]
+    assert collect_garbage(blob_store, [store]) == []
+    assert blob_store.get_blob(digest) == _content(0)
+
+def test_blobs_keyed_by_collision_resistant_hash():
+    blob_store = InMemoryBlobStore()
+    # Two bodies whose (weak) change-detection hashes collide.
+    colliding = {"method": "xxh3-64-hex", "digest": "00000000deadbeef"}
+    records = []
+    for i in range(2):
+        inc = datadiff.DataIncarnation(_content(i), str(1000 + i), content_hash=colliding)
+        records.append(inc._blob_content_record(blob_store, store=True)["blob"])
+    assert [r["digest"] for r in records] == [methods.compute_content_hash(_content(i))["digest"] for i in range(2)]
+    assert all(r["method"] == "sha256-hex" for r in records)
+    assert sorted(blob_store.list_blobs()) == sorted(r["digest"] for r in records)
+    inc = datadiff.DataIncarnation(_content(0), "1000", content_hash=methods.compute_content_hash(_content(0), method="blake2b-hex"))
+    assert inc._blob_content_record(blob_store, store=True)["blob"]["method"] == "blake2b-hex"
@@ -0,0 +1,86 @@
+import collections
+import threading
+import weakref
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+_caches = weakref.WeakSet()
+
+class ChunkCache(object):
+    # LRU cache for values derived from immutable chunks. Keys start with
+    # the storage's cache namespace and the chunk name so that every value
+    # derived from a chunk can be dropped when the chunk is deleted.
+    # Sizes are approximate and supplied by the caller.
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        _caches.add(self)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key, value, size):
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self._evict_locked()
+
+    def _evict_locked(self):
+        while self._bytes > self._max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._evictions += 1
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict_locked()
+
+    def invalidate_chunk(self, namespace, name):
+        with self._lock:
+            doomed = [k for k in self._entries if k[:2] == (namespace, name)]
+            for k in doomed:
+                _, size = self._entries.pop(k)
+                self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+            }
+
+def invalidate_chunk(namespace, name):
+    if namespace is None:
+        return
+    for cache in list(_caches):
+        cache.invalidate_chunk(namespace, name)
+
+DEFAULT = ChunkCache()
@@ -0,0 +1,33 @@
+from .chunkcache import *
+
+def test_lru_eviction_and_stats():
+    cache = ChunkCache(max_bytes=100)
+    cache.put(("ns", "a", "parsed"), "A", 40)
+    cache.put(("ns", "b", "parsed"), "B", 40)
+    assert cache.get(("ns", "a", "parsed")) == "A"
+    cache.put(("ns", "c", "parsed"), "C", 40)
+    assert cache.get(("ns", "b", "parsed")) is None
+    assert cache.get(("ns", "a", "parsed")) == "A"
+    assert cache.get(("ns", "c", "parsed")) == "C"
+    stats = cache.stats()
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+    assert stats["evictions"] == 1
+    assert stats["bytes"] == 80
+
+def test_oversized_values_are_not_cached():
+    cache = ChunkCache(max_bytes=10)
+    cache.put(("ns", "a", "parsed"), "A", 11)
+    assert cache.get(("ns", "a", "parsed")) is None
+
+def test_invalidate_chunk():
+    cache = ChunkCache()
+    cache.put(("ns", "a", "parsed"), "A", 1)
+    cache.put(("ns", "a", "incarnation", "123"), "A123", 1)
+    cache.put(("ns", "b", "parsed"), "B", 1)
+    cache.put(("other", "a", "parsed"), "A'", 1)
+    invalidate_chunk("ns", "a")
+    assert cache.get(("ns", "a", "parsed")) is None
+    assert cache.get(("ns", "a", "incarnation", "123")) is None
+    assert cache.get(("ns", "b", "parsed")) == "B"
+    assert cache.get(("other", "a", "parsed")) == "A'"
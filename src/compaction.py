@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import click
+import collections
+import time
+
+import blobs
+import datadiff
+import filenames
+import storage
+
+def compact_keyhash(store, keyhash, min_chunks=2, blob_store=None):
+    # Merges all chunks of a key into one independent chunk and deletes the
+    # chunks it replaces right away, so this is for offline use; while
+    # others may be reading the store, use SummaryCompactor.
+    names = store.list_filtered_chunks(keyhash_filter=[keyhash])
+    if len(names) < min_chunks:
+        return False
+    entry = datadiff.Entry.load_dumps(store, names, full_history=True, blobs=blob_store)
+    merged = filenames.encode_filename_from_nameinfo(entry.info)
+    if merged not in names:
+        entry.write_dump(store, blobs=blob_store)
+    for name in names:
+        if name != merged:
+            store.delete_chunk(name)
+    return True
+
+def keyhashes_to_compact(store, min_chunks=2, keyhash_filter=None):
+    counts = collections.Counter(filenames.decode_filename(name).keyhash for name in store.list_chunks())
+    return [kh for kh, n in counts.most_common() if n >= min_chunks and (keyhash_filter is None or keyhash_filter(kh))]
+
+def compact_store(store, min_chunks=2, max_keys=None, keyhash_filter=None, blob_store=None):
+    khs = keyhashes_to_compact(store, min_chunks=min_chunks, keyhash_filter=keyhash_filter)
+    if max_keys is not None:
+        khs = khs[:max_keys]
+    n = 0
+    for kh in khs:
+        if compact_keyhash(store, kh, min_chunks=min_chunks, blob_store=blob_store):
+            n += 1
+    return n
+
+def _chunk_order(fni):
+    # A compacted chunk ends at the same version as the chain it replaces;
+    # it is preferred, as when loading.
+    return (int(fni.last_version), -fni.dependency_chain_length)
+
+def _trail_length(fnis):
+    # Number of chunks read to load the latest version. Chain lengths in
+    # chunk names keep counting past a compacted chunk, so walk the chain
+    # the way the loader does.
+    fnis = sorted(fnis, key=_chunk_order)
+    by_last_version = {fni.last_version: fni for fni in fnis}
+    step = fnis[-1]
+    n = 1
+    while step.depends_on_version is not None:
+        dep = step.depends_on_version
+        step = by_last_version.get(dep)
+        if step is None:
+            containing = [fni for fni in fnis if int(fni.first_version) <= int(dep) <= int(fni.last_version)]
+            if not containing:
+                break
+            step = containing[0]
+        n += 1
+    return n
+
+class _RetiringCompactor(object):
+    # Superseded chunks are deleted only after a grace period, so readers
+    # that listed them shortly before can still read them.
+    def __init__(self, store, grace_period=300.0, keyhash_filter=None, clock=time.time, blob_store=None, chunk_index=None):
+        self._store = store
+        self._blob_store = blob_store
+        self._chunk_index = chunk_index
+        self._grace_period = grace_period
+        self._keyhash_filter = keyhash_filter
+        self._clock = clock
+        self._retiring = collections.deque()
+        self._retiring_names = set()
+
+    def _live_names(self, keyhash):
+        names = self._store.list_filtered_chunks(keyhash_filter=[keyhash])
+        return [name for name in names if name not in self._retiring_names]
+
+    def _write_merged(self, entry, names):
+        merged = filenames.encode_filename_from_nameinfo(entry.info)
+        if merged not in names:
+            entry.write_dump(self._store, blobs=self._blob_store)
+            if self._chunk_index is not None:
+                self._chunk_index.add_chunk(merged)
+        return merged
+
+    def _retire_later(self, names):
+        self._retiring.append((self._clock() + self._grace_period, names))
+        self._retiring_names.update(names)
+
+    def retire_due(self):
+        n = 0
+        now = self._clock()
+        while self._retiring and self._retiring[0][0] <= now:
+            _, names = self._retiring.popleft()
+            for name in names:
+                try:
+                    self._store.delete_chunk(name)
+                except (KeyError, FileNotFoundError):
+                    pass
+                if self._chunk_index is not None:
+                    self._chunk_index.remove_chunk(name)
+                self._retiring_names.discard(name)
+                n += 1
+        return n
+
+    @property
+    def retiring(self):
+        return len(self._retiring_names)
+
+    def candidates(self):
+        raise NotImplementedError()
+
+    def compact_keyhash(self, keyhash):
+        raise NotImplementedError()
+
+    def run_once(self, max_keys=None):
+        self.retire_due()
+        khs = self.candidates()
+        if max_keys is not None:
+            khs = khs[:max_keys]
+        n = 0
+        for kh in khs:
+            if self.compact_keyhash(kh):
+                n += 1
+        return n
+
+class SummaryCompactor(_RetiringCompactor):
+    # Like compact_store, merges all chunks of a key into one independent
+    # chunk, but retires the merged chunks after the grace period.
+    def __init__(self, store, min_chunks=2, **kwargs):
+        super().__init__(store, **kwargs)
+        self._min_chunks = min_chunks
+
+    def candidates(self):
+        counts = collections.Counter()
+        for name in self._store.list_chunks():
+            if name in self._retiring_names:
+                continue
+            kh = filenames.decode_filename(name).keyhash
+            if self._keyhash_filter is None or self._keyhash_filter(kh):
+                counts[kh] += 1
+        return [kh for kh, n in counts.most_common() if n >= self._min_chunks]
+
+    def compact_keyhash(self, keyhash):
+        names = self._live_names(keyhash)
+        if len(names) < self._min_chunks:
+            return False
+        entry = datadiff.Entry.load_dumps(self._store, names, full_history=True, blobs=self._blob_store)
+        merged = self._write_merged(entry, names)
+        self._retire_later([name for name in names if name != merged])
+        return True
+
+class ChainCompactor(_RetiringCompactor):
+    # Rewrites the chain of chunks needed to load the latest version of a
+    # key into one self-contained chunk.
+    def __init__(self, store, min_chain_length=4, **kwargs):
+        super().__init__(store, **kwargs)
+        self._min_chain_length = min_chain_length
+
+    def candidates(self):
+        by_keyhash = collections.defaultdict(list)
+        for name in self._store.list_chunks():
+            fni = filenames.decode_filename(name)
+            if self._keyhash_filter is None or self._keyhash_filter(fni.keyhash):
+                by_keyhash[fni.keyhash].append(fni)
+        rv = []
+        for kh, fnis in by_keyhash.items():
+            n = _trail_length(fnis)
+            if n >= self._min_chain_length:
+                rv.append((n, kh))
+        rv.sort(reverse=True)
+        return [kh for _, kh in rv]
+
+    def _superseded(self, names, merged):
+        # Chunks whose versions all lie within an independent chunk are
+        # redundant, since an independent chunk holds every version of
+        # the key in its range.
+        merged_fni = filenames.decode_filename(merged)
+        first, last = int(merged_fni.first_version), int(merged_fni.last_version)
+        rv = []
+        for name in names:
+            if name == merged or name in self._retiring_names:
+                continue
+            fni = filenames.decode_filename(name)
+            if first <= int(fni.first_version) and int(fni.last_version) <= last:
+                rv.append(name)
+        return rv
+
+    def compact_keyhash(self, keyhash):
+        names = self._live_names(keyhash)
+        if not names:
+            return False
+        if _trail_length(filenames.decode_filename(name) for name in names) < self._min_chain_length:
+            return False
+        entry = datadiff.Entry.load_dumps(self._store, names, only_from_last_checkpoint=True, blobs=self._blob_store)
+        merged = self._write_merged(entry, names)
+        self._retire_later(self._superseded(names, merged))
+        return True
+
+@click.command()
+@click.option("--data-dir", required=True,
+              help="Directory containing datawatch data (typically summaries).")
+@click.option("--min-chunks", default=2, show_default=True,
+              help="Only compact keys stored in at least this many chunks.")
+@click.option("--max-keys", default=None, type=int,
+              help="Compact at most this many keys.")
+@click.option("--blob-dir", default=None,
+              help="Directory containing shared blobs, if the data uses them.")
+def main(data_dir, min_chunks, max_keys, blob_dir):
+    store = storage.open_storage(data_dir)
+    try:
+        n = compact_store(store, min_chunks=min_chunks, max_keys=max_keys, blob_store=blobs.open_blob_store(blob_dir))
+    finally:
+        store.close()
+    print("Compacted {} keys.".format(n))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+from .compaction import *
+
+import datadiff
+import storage
+
+def _fill(coll, key, start, stop):
+    for i in range(start, stop):
+        coll.update_data(key, "content {}".format(i // 2).encode("utf-8"), str(1000 + i))
+        coll.sync_and_flush_one()
+
+def test_incremental_summaries_and_compaction():
+    store = storage.InMemoryStorage()
+    summary_store = storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    summary_coll = datadiff.Collection(summary_store)
+    key = "https://example.com/"
+    kh = coll._compute_keyhash(key)
+    for start in range(0, 30, 10):
+        _fill(coll, key, start, start + 10)
+        assert coll.summarize_to(summary_coll)
+        assert not coll.summarize_to(summary_coll)
+    names = list(summary_store.list_chunks())
+    assert len(names) == 3
+    fnis = sorted((filenames.decode_filename(name) for name in names), key=lambda fni: int(fni.last_version))
+    assert [fni.first_version for fni in fnis] == ["1000", "1010", "1020"]
+    assert [fni.depends_on_version for fni in fnis] == [None, "1009", "1019"]
+    expected = [(str(1000 + i), "content {}".format(i // 2).encode("utf-8")) for i in range(30)]
+    def summarized():
+        entry = datadiff.Collection(summary_store, full_history=True, chunk_cache=None)[kh]
+        return [(inc.data_version, inc.data) for inc in entry.incarnations()]
+    assert summarized() == expected
+    assert not compact_store(summary_store, min_chunks=4)
+    assert compact_store(summary_store, min_chunks=3) == 1
+    names = list(summary_store.list_chunks())
+    assert len(names) == 1
+    assert filenames.decode_filename(names[0]).depends_on_version is None
+    assert summarized() == expected
+    _fill(coll, key, 30, 35)
+    assert coll.summarize_to(summary_coll)
+    assert summarized() == expected + [(str(1000 + i), "content {}".format(i // 2).encode("utf-8")) for i in range(30, 35)]
+
+class _FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def clock(self):
+        return self.now
+
+def test_chain_compactor():
+    store = storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    key = "https://example.com/"
+    kh = coll._compute_keyhash(key)
+    _fill(coll, key, 0, 10)
+    fake = _FakeClock()
+    compactor = ChainCompactor(store, min_chain_length=4, grace_period=60, clock=fake.clock)
+    assert compactor.candidates() == [kh]
+    assert compactor.run_once() == 1
+    assert compactor.retiring == 10
+    assert compactor.candidates() == []
+    # Superseded chunks stay readable until the grace period has passed.
+    assert len(list(store.list_chunks())) == 11
+    entry = datadiff.Collection(store)[kh]
+    assert entry.current_version == "1009"
+    _fill(coll, key, 10, 12)
+    fake.now += 61
+    assert compactor.run_once() == 0
+    assert compactor.retiring == 0
+    names = list(store.list_chunks())
+    assert len(names) == 3
+    expected = [(str(1000 + i), "content {}".format(i // 2).encode("utf-8")) for i in range(12)]
+    entry = datadiff.Collection(store, full_history=True)[kh]
+    assert [(inc.data_version, inc.data) for inc in entry.incarnations()] == expected
+    entry = datadiff.Collection(store)[kh]
+    assert entry.current_version == "1011"
+
+def test_summary_compactor_retires_after_grace():
+    store = storage.InMemoryStorage()
+    summary_store = storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    summary_coll = datadiff.Collection(summary_store)
+    key = "https://example.com/"
+    kh = coll._compute_keyhash(key)
+    for start in range(0, 30, 10):
+        _fill(coll, key, start, start + 10)
+        coll.summarize_to(summary_coll)
+    old = list(summary_store.list_chunks())
+    fake = _FakeClock()
+    compactor = SummaryCompactor(summary_store, min_chunks=3, grace_period=60, clock=fake.clock)
+    assert compactor.run_once() == 1
+    assert compactor.retiring == 3
+    assert compactor.candidates() == []
+    # A reader that listed the store before the merge can still read.
+    entry = datadiff.Entry.load_dumps(summary_store, old, full_history=True, chunk_cache=None)
+    assert entry.current_version == "1029"
+    fake.now += 61
+    assert compactor.run_once() == 0
+    names = list(summary_store.list_chunks())
+    assert len(names) == 1
+    assert filenames.decode_filename(names[0]).depends_on_version is None
+    entry = datadiff.Collection(summary_store, full_history=True, chunk_cache=None)[kh]
+    assert [(inc.data_version, inc.data) for inc in entry.incarnations()] == [(str(1000 + i), "content {}".format(i // 2).encode("utf-8")) for i in range(30)]
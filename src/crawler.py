@@ -8,7 +8,22 @@ import time
 import re
 import hashlib
 import datadiff
+import methods
+import compaction
+import blobs
+import hashindex
+import textindex
+import snapshot
 import storage
+import revisit
+import normalize
+import sharding
+import writer
+import wal
+import multiprocessing
+import queue
+
+_TARGET_POLL_DELAY = 1.0
 
 @click.command()
 @click.option("--root", multiple=True, help="Roots for target discovery.")
@@ -27,60 +42,284 @@ import storage
               help="Output directory for summaries.")
 @click.option("--summary_delay", default=3600,
               help="Desired delay between summaries.")
+@click.option("--summary_compaction_delay", default=6*3600, show_default=True,
+              help="Desired delay between merging the chunks of summaries.")
+@click.option("--summary_compaction_min_chunks", default=8, show_default=True,
+              help="Merge the summary of a key once it is stored in at least this many chunks.")
+@click.option("--summary_compaction_grace", default=300.0, show_default=True,
+              help="Delay before deleting summary chunks replaced by a merged one.")
 @click.option("--checkpoint_delay", default=30,
               help="Desired delay between checkpoint attempts.")
+@click.option("--chain_compaction_delay", default=300.0, show_default=True,
+              help="Desired delay between rewriting long checkpoint chains into self-contained chunks.")
+@click.option("--chain_compaction_min_length", default=4, show_default=True,
+              help="Rewrite a key's checkpoints once loading it requires reading at least this many chunks.")
+@click.option("--chain_compaction_grace", default=300.0, show_default=True,
+              help="Delay before deleting checkpoint chunks replaced by a rewritten chain.")
+@click.option("--snapshot_index_path", default=None,
+              help="SQLite file indexing the checkpoint chunks for snapshot queries; rebuilt on startup and updated as checkpoints are written.")
+@click.option("--hash_index_path", default=None,
+              help="SQLite file indexing which keys and versions had each content hash, updated as checkpoints are written.")
+@click.option("--text_index_path", default=None,
+              help="SQLite file with a trigram index of the text of every version, updated as checkpoints are written.")
+@click.option("--storage_format", default="auto", show_default=True,
+              type=click.Choice(storage.STORAGE_FORMATS),
+              help="Layout of the checkpoint and summary stores: one file per chunk, packed segment files, or an SQLite database file.")
+@click.option("--blob_dir", default=None,
+              help="Directory for content shared across keys; large payloads are stored there once and referenced by content hash.")
+@click.option("--min_blob_size", default=blobs.DEFAULT_MIN_BLOB_SIZE, show_default=True,
+              help="Smallest payload stored in --blob_dir rather than inline.")
+@click.option("--baseline_candidates", default=datadiff.DEFAULT_BASELINE_CANDIDATES, show_default=True,
+              help="Recent distinct versions a new version may be diffed against; each tracked key keeps up to this many minus one extra versions in memory.")
+@click.option("--background_checkpoints/--no-background_checkpoints",
+              default=False, show_default=True, type=bool,
+              help="Write checkpoints on a background thread instead of in the fetching loop.")
+@click.option("--checkpoint_queue_size", default=64, show_default=True,
+              help="Maximum number of queued background checkpoint writes before fetching waits.")
+@click.option("--wal_path", default=None,
+              help="Write-ahead log for versions not yet checkpointed; when set, all entries are checkpointed together every --checkpoint_delay.")
+@click.option("--wal_sync_delay", default=1.0, show_default=True,
+              help="Maximum delay before appended write-ahead log records are fsynced.")
+@click.option("--content_hash_method", default="sha256-hex", show_default=True,
+              type=click.Choice(sorted(methods.CONTENT_HASHERS)),
+              help="Hash recorded for new versions and used for change detection; xxh3-64-hex needs the xxhash package.")
+@click.option("--max_body_size", default=fetcher.DEFAULT_MAX_BODY_SIZE, show_default=True,
+              help="Maximum response body size in bytes; larger responses are skipped. Bodies are held in memory.")
 @click.option("--exponential_backoff", default=None,
               help="Increase time to next fetch for resources that don't change much.")
+@click.option("--fetch_budget", default=None, type=float,
+              help="Fetches per second shared by all targets; enables revisit scheduling by estimated change rate.")
+@click.option("--min_fetch_delay", default=10.0,
+              help="Shortest revisit delay for a target under --fetch_budget.")
+@click.option("--max_fetch_delay", default=86400.0,
+              help="Longest revisit delay for a target under --fetch_budget.")
+@click.option("--normalization_rules", default=None,
+              help="YAML file with rules for stripping volatile content before change detection.")
+@click.option("--store_raw/--no-store_raw",
+              default=False, show_default=True, type=bool,
+              help="Store raw rather than normalized content, recording a new raw version only when the normalized content changes.")
+@click.option("--workers", default=1, show_default=True,
+              help="Number of fetching processes; targets are partitioned between them by key hash.")
 @click.option("--heap-profiling/--no-heap-profiling",
               default=False, show_default=True, type=bool,
               help="Regularly dump a heap memory profile to stdout.")
-def main(root, target_regex, user_agent, fetching_rate_limit, target_fetch_delay, rediscovery_delay, checkpoint_output_dir, summary_output_dir, summary_delay, checkpoint_delay, exponential_backoff, heap_profiling):
+def main(root, target_regex, user_agent, fetching_rate_limit, target_fetch_delay, rediscovery_delay, checkpoint_output_dir, summary_output_dir, summary_delay, summary_compaction_delay, summary_compaction_min_chunks, summary_compaction_grace, checkpoint_delay, chain_compaction_delay, chain_compaction_min_length, chain_compaction_grace, snapshot_index_path, hash_index_path, text_index_path, storage_format, blob_dir, min_blob_size, baseline_candidates, background_checkpoints, checkpoint_queue_size, wal_path, wal_sync_delay, content_hash_method, max_body_size, exponential_backoff, fetch_budget, min_fetch_delay, max_fetch_delay, normalization_rules, store_raw, workers, heap_profiling):
     assert root
     assert target_regex
     assert user_agent
     assert checkpoint_output_dir
-    if heap_profiling:
-        import guppy
-        heap_profiler = guppy.hpy()
-    exponential_backoff = float(exponential_backoff) if (exponential_backoff is not None) else None
+    assert workers >= 1
+    if workers > 1:
+        # Segment and SQLite stores are written by a single process.
+        assert not storage.is_single_process_store(checkpoint_output_dir, storage_format)
+        # Index files hold a write transaction open between batch commits,
+        # so workers sharing one would block each other.
+        assert not hash_index_path
+        assert not text_index_path
+        assert not snapshot_index_path
     if exponential_backoff is not None:
-        assert 1 < exponential_backoff < 10
+        assert 1 < float(exponential_backoff) < 10
+    if fetch_budget is not None:
+        assert exponential_backoff is None
+    params = click.get_current_context().params
+    if workers == 1:
+        _run_fetching(params, fetching_rate_limit)
+    else:
+        _run_coordinator(params)
+
+def _make_target_link_filter(target_regex):
     compiled = [re.compile(x) for x in target_regex]
     def target_link_filter(url):
         for x in compiled:
             if x.match(url):
                 return True
         return False
-    coll = datadiff.Collection(storage.LocalFileStorage(checkpoint_output_dir))
-    def now():
-        return str(int(time.time()*1e9))
-    def on_fetched(target_url, resp, content):
-        coll.update_data(target_url, content, now())
-    def sync_to_checkpoints(task):
-        coll.sync_and_flush_one()
-    mainloop = fetcher.FetcherLoop(
+    return target_link_filter
+
+def _make_fetcher_loop(params, on_fetched, fetching_rate_limit, fetch_budget=None, target_sink=None):
+    exponential_backoff = params["exponential_backoff"]
+    exponential_backoff = float(exponential_backoff) if (exponential_backoff is not None) else None
+    revisit_policy = None
+    if fetch_budget is not None:
+        revisit_policy = revisit.RevisitPolicy(
+            fetch_budget=fetch_budget,
+            default_delay=params["target_fetch_delay"],
+            min_delay=params["min_fetch_delay"],
+            max_delay=params["max_fetch_delay"],
+        )
+    normalization_rules = params["normalization_rules"]
+    normalizer = normalize.load_normalizer(normalization_rules) if normalization_rules else None
+    return fetcher.FetcherLoop(
         on_fetched=on_fetched,
-        user_agent=user_agent,
-        target_link_filter=target_link_filter,
+        user_agent=params["user_agent"],
+        target_link_filter=_make_target_link_filter(params["target_regex"]),
         fetching_ratelimit=fetching_rate_limit,
-        discovery_delay=rediscovery_delay,
-        fetch_delay=target_fetch_delay,
-        exponential_backoff=float(exponential_backoff),
+        discovery_delay=params["rediscovery_delay"],
+        fetch_delay=params["target_fetch_delay"],
+        exponential_backoff=exponential_backoff,
+        revisit_policy=revisit_policy,
+        normalizer=normalizer,
+        store_raw=params["store_raw"],
+        max_body_size=params["max_body_size"],
+        target_sink=target_sink,
         verbose=True,
     )
-    if summary_output_dir:
-        summary_coll = datadiff.Collection(storage.LocalFileStorage(summary_output_dir))
+
+def _run_fetching(params, fetching_rate_limit, fetch_budget=None, target_queue=None, worker_index=None):
+    methods.set_content_hash_method(params["content_hash_method"])
+    if params["heap_profiling"]:
+        import guppy
+        heap_profiler = guppy.hpy()
+    checkpoint_writer = None
+    if params["background_checkpoints"]:
+        checkpoint_writer = writer.BackgroundWriter(max_pending=params["checkpoint_queue_size"])
+    write_ahead_log = None
+    if params["wal_path"]:
+        wal_path = params["wal_path"]
+        if worker_index is not None:
+            wal_path = "{}.{}".format(wal_path, worker_index)
+        write_ahead_log = wal.WriteAheadLog(wal_path, group_commit_delay=params["wal_sync_delay"])
+    stores = [storage.open_storage(params["checkpoint_output_dir"], params["storage_format"])]
+    blob_store = blobs.open_blob_store(params["blob_dir"], min_blob_size=params["min_blob_size"])
+    chunk_index = snapshot.open_chunk_index(params["snapshot_index_path"])
+    if chunk_index is not None:
+        # Chunks written while the crawler was not running are picked up here.
+        chunk_index.rebuild(stores[0])
+    indexes = [index for index in (
+        chunk_index,
+        hashindex.open_hash_index(params["hash_index_path"]),
+        textindex.open_text_index(params["text_index_path"]),
+    ) if index is not None]
+    coll = datadiff.Collection(stores[0], flush_settings={"baseline_candidates": params["baseline_candidates"]}, writer=checkpoint_writer, wal=write_ahead_log, blobs=blob_store, indexes=indexes)
+    if write_ahead_log is not None:
+        print("replayed", coll.replay_wal(), "versions from", write_ahead_log)
+    def now():
+        return str(int(time.time()*1e9))
+    def on_fetched(target_url, resp, content, content_hash, changed):
+        coll.update_data(target_url, content, now(), content_hash=content_hash, unchanged=not changed)
+    def sync_to_checkpoints(task):
+        if write_ahead_log is not None:
+            coll.checkpoint_all()
+        else:
+            coll.sync_and_flush_one()
+    if fetch_budget is None:
+        fetch_budget = params["fetch_budget"]
+    mainloop = _make_fetcher_loop(params, on_fetched, fetching_rate_limit, fetch_budget=fetch_budget)
+    owned_keyhash = None
+    if worker_index is not None:
+        # Workers share stores; each one only compacts the keys it fetches.
+        def owned_keyhash(keyhash):
+            return sharding.shard_for_keyhash(keyhash, params["workers"]) == worker_index
+    chain_compactor = compaction.ChainCompactor(
+        stores[0],
+        min_chain_length=params["chain_compaction_min_length"],
+        grace_period=params["chain_compaction_grace"],
+        keyhash_filter=owned_keyhash,
+        blob_store=blob_store,
+        chunk_index=chunk_index)
+    def compact_chains(task):
+        chain_compactor.run_once()
+    mainloop.schedule_nonfetching_task(callback=compact_chains, delay=params["chain_compaction_delay"], reschedule=True)
+    if params["summary_output_dir"]:
+        summary_store = storage.open_storage(params["summary_output_dir"], params["storage_format"])
+        stores.append(summary_store)
+        summary_coll = datadiff.Collection(summary_store, blobs=blob_store)
         def do_summaries(task):
             coll.summarize_one_to(summary_coll)
-        mainloop.schedule_nonfetching_task(callback=do_summaries, delay=summary_delay, reschedule=True)
-    mainloop.schedule_nonfetching_task(callback=sync_to_checkpoints, delay=checkpoint_delay, reschedule=True)
-    for oneroot in root:
-        mainloop.add_discovery_root(oneroot)
-    if heap_profiling:
+        mainloop.schedule_nonfetching_task(callback=do_summaries, delay=params["summary_delay"], reschedule=True)
+        summary_compactor = compaction.SummaryCompactor(
+            summary_store,
+            min_chunks=params["summary_compaction_min_chunks"],
+            grace_period=params["summary_compaction_grace"],
+            keyhash_filter=owned_keyhash,
+            blob_store=blob_store)
+        def compact_summaries(task):
+            summary_compactor.run_once()
+        mainloop.schedule_nonfetching_task(callback=compact_summaries, delay=params["summary_compaction_delay"], reschedule=True)
+    mainloop.schedule_nonfetching_task(callback=sync_to_checkpoints, delay=params["checkpoint_delay"], reschedule=True)
+    if write_ahead_log is not None:
+        def sync_wal(task):
+            write_ahead_log.sync_if_due()
+        mainloop.schedule_nonfetching_task(callback=sync_wal, delay=params["wal_sync_delay"], reschedule=True)
+    if target_queue is None:
+        for oneroot in params["root"]:
+            mainloop.add_discovery_root(oneroot)
+    else:
+        def receive_targets(task):
+            while True:
+                try:
+                    discovery_root_url, targets = target_queue.get_nowait()
+                except queue.Empty:
+                    return
+                mainloop.set_targets_for_root(discovery_root_url, targets)
+        mainloop.schedule_nonfetching_task(callback=receive_targets, delay=_TARGET_POLL_DELAY, reschedule=True)
+    if params["heap_profiling"]:
         def dump_heap_profile(task):
             print(heap_profiler.heap())
         mainloop.schedule_nonfetching_task(callback=dump_heap_profile, delay=10, reschedule=True)
-    mainloop.run_loop()
+    for index in indexes:
+        def commit_index(task):
+            task.payload.commit()
+        mainloop.schedule_nonfetching_task(callback=commit_index, payload=index, delay=params["checkpoint_delay"], reschedule=True)
+    for store in stores:
+        if isinstance(store, storage.SegmentStorage):
+            store.start_background_compaction()
+        if isinstance(store, storage.SqliteStorage):
+            def commit_store(task):
+                task.payload.commit()
+            mainloop.schedule_nonfetching_task(callback=commit_store, payload=store, delay=params["checkpoint_delay"], reschedule=True)
+    try:
+        mainloop.run_loop()
+    finally:
+        if checkpoint_writer is not None:
+            print("draining", checkpoint_writer.pending, "queued checkpoint writes")
+            checkpoint_writer.close()
+        if write_ahead_log is not None:
+            write_ahead_log.close()
+        for index in indexes:
+            index.close()
+        for store in stores:
+            store.close()
+
+def _run_worker(params, index, target_queue):
+    num_workers = params["workers"]
+    print("starting worker", index, "of", num_workers)
+    # Workers share the global politeness budget between them.
+    fetch_budget = params["fetch_budget"]
+    if fetch_budget is not None:
+        fetch_budget = fetch_budget / num_workers
+    _run_fetching(params, params["fetching_rate_limit"] * num_workers, fetch_budget=fetch_budget, target_queue=target_queue, worker_index=index)
+
+def _run_coordinator(params):
+    num_workers = params["workers"]
+    target_queues = [multiprocessing.Queue() for _ in range(num_workers)]
+    processes = [
+        multiprocessing.Process(target=_run_worker, args=(params, i, q), name="crawler-worker-{}".format(i), daemon=True)
+        for i, q in enumerate(target_queues)
+    ]
+    for p in processes:
+        p.start()
+    def distribute_targets(discovery_root_url, targets):
+        for q, shard in zip(target_queues, sharding.partition_keys(targets, num_workers)):
+            q.put((discovery_root_url, sorted(shard)))
+    def on_fetched(*args):
+        raise RuntimeError("coordinator does not fetch targets")
+    def check_workers(task):
+        for p in processes:
+            if not p.is_alive():
+                raise RuntimeError("worker {} exited with code {}".format(p.name, p.exitcode))
+    try:
+        mainloop = _make_fetcher_loop(params, on_fetched, params["fetching_rate_limit"], target_sink=distribute_targets)
+        mainloop.schedule_nonfetching_task(callback=check_workers, delay=_TARGET_POLL_DELAY, reschedule=True)
+        for oneroot in params["root"]:
+            mainloop.add_discovery_root(oneroot)
+        mainloop.run_loop()
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+        for p in processes:
+            p.join()
 
 if __name__ == "__main__":
     main()
@@ -2,7 +2,10 @@ import methods
 import version
 import filenames
 import storage
+import chunkcache
+import sketch
 import binascii
+import bisect
 import collections
 import contextlib
 import zlib
@@ -63,6 +66,10 @@ def _pack_bytes(data):
 def _unpack_bytes(b64s):
     return binascii.a2b_base64(b64s)
 
+def _encoded_size(content):
+    # Size of a content section as _write_named_json writes it.
+    return len(json.dumps(content, indent="  "))
+
 def _boolcount(*bools):
     return len([x for x in bools if x])
 
@@ -80,12 +87,54 @@ def _coerce_to_bytes(x):
         return x.encode("utf-8")
     return x.read()
 
+# Recent distinct versions a new version may be diffed against. Each
+# resident entry keeps up to this many minus one extra historical bodies
+# in memory, so more than one is opt-in.
+DEFAULT_BASELINE_CANDIDATES = 1
+
+# How much of the data rebuilt while loading is checked against recorded
+# content hashes: every version, only the latest one, the latest one and
+# a random sample of the others, or nothing. Lengths are always checked.
+VERIFY_LEVELS = ("full", "final", "sample", "none")
+VERIFY_SAMPLE_RATE = 0.05
+
+# Content at least this large is delta-encoded by content-defined chunking
+# instead of bsdiff, whose time and memory grow steeply with input size.
+CDC_MIN_SIZE = 1024 * 1024
+
+def _recent_distinct(incarnations, n):
+    # The n most recent incarnations with distinct content, oldest first.
+    rv = []
+    seen = set()
+    for inc in reversed(incarnations):
+        if len(rv) >= n:
+            break
+        if inc.content_hash_digest not in seen:
+            seen.add(inc.content_hash_digest)
+            rv.append(inc)
+    rv.reverse()
+    return rv
+
+def _make_verify_predicate(verify):
+    if verify not in VERIFY_LEVELS:
+        raise ValueError("unknown verification level {}; expected one of {}".format(repr(verify), repr(VERIFY_LEVELS)))
+    def should_verify(version, final_version=None):
+        if verify == "full":
+            return True
+        if verify == "none":
+            return False
+        if version == final_version:
+            return True
+        return verify == "sample" and random.random() < VERIFY_SAMPLE_RATE
+    return should_verify
+
 class DataIncarnation(object):
-    def __init__(self, data, data_version):
+    def __init__(self, data, data_version, content_hash=None):
         self._ver = data_version
         self._data = data
         self._memo_data_as_unicode = None
-        content_hash = methods.compute_content_hash(data)
+        if content_hash is None:
+            content_hash = methods.compute_content_hash(data)
         self._content_hash_digest = content_hash["digest"]
         self._metadata = IncarnationHeader(
             version=self._ver,
@@ -93,11 +142,16 @@ class DataIncarnation(object):
             content_length=len(data),
         )._asdict()
         self._memo = {}
+        self._dedup_hash = None
+        self._sketch = None
+        # Digest of each content-defined chunk to its (offset, length).
+        self._chunk_map = None
 
     def same_data_as(self, other):
         if other is None:
             return False
-        if self.content_hash_digest != other.content_hash_digest:
+        same_method = self.content_hash["method"] == other.content_hash["method"]
+        if same_method and self.content_hash_digest != other.content_hash_digest:
             return False
         return self.data == other.data
 
@@ -136,6 +190,45 @@ class DataIncarnation(object):
     def content_hash_digest(self):
         return self._content_hash_digest
 
+    @property
+    def content_hash(self):
+        return self._metadata["content_hash"]
+
+    @property
+    def sketch(self):
+        if self._sketch is None:
+            self._sketch = sketch.compute_sketch(self._data)
+        return self._sketch
+
+    @property
+    def chunk_map(self):
+        # Known from the record when this version was decoded from one;
+        # otherwise the content is chunked once.
+        if self._chunk_map is None:
+            digest = methods.DEFAULT_CHUNKER.chunk_digest
+            chunk_map = {}
+            offset = 0
+            for chunk in methods.split_content(self._data):
+                chunk_map.setdefault(digest(chunk), (offset, len(chunk)))
+                offset += len(chunk)
+            self._chunk_map = chunk_map
+        return self._chunk_map
+
+    def _choose_baseline(self, last, candidates):
+        # Diffing against every candidate would run bsdiff K times; instead
+        # pick the candidate whose sketch is most similar, preferring the
+        # most recent version unless another one is strictly better.
+        if not any(cand is not last for cand in candidates):
+            return last
+        best, best_similarity = last, sketch.estimate_similarity(self.sketch, last.sketch)
+        for cand in reversed(candidates):
+            if cand is last:
+                continue
+            similarity = sketch.estimate_similarity(self.sketch, cand.sketch)
+            if similarity > best_similarity:
+                best, best_similarity = cand, similarity
+        return best
+
     def _full_content_record(self):
         min_savings = 50
         compressed = zlib.compress(self._data)
@@ -158,9 +251,44 @@ class DataIncarnation(object):
             "unchanged": True,
         }
 
+    def _cdc_content_record(self, last):
+        # Lists the content's chunks by digest, carrying only the chunks
+        # that the baseline does not have.
+        digest = methods.DEFAULT_CHUNKER.chunk_digest
+        known = last.chunk_map
+        digests = []
+        lengths = []
+        new_chunks = []
+        chunk_map = {}
+        offset = 0
+        for chunk in methods.split_content(self._data):
+            d = digest(chunk)
+            digests.append(d)
+            lengths.append(len(chunk))
+            if d not in known and d not in chunk_map:
+                new_chunks.append(chunk)
+            chunk_map.setdefault(d, (offset, len(chunk)))
+            offset += len(chunk)
+        self._chunk_map = chunk_map
+        rv = {
+            "baseline_version": last.data_version,
+            "cdc": {
+                "method": methods.DEFAULT_CHUNKER.chunking_method,
+                "chunks": digests,
+                "lengths": lengths,
+                "data": _pack_bytes(zlib.compress(b"".join(new_chunks))),
+            },
+        }
+        full = self._full_content_record()
+        if _encoded_size(rv) > _encoded_size(full):
+            return full
+        return rv
+
     def _delta_content_record(self, last):
         if last.data == self.data:
             return self._content_record_same_as(last)
+        if max(len(self._data), len(last.data)) >= CDC_MIN_SIZE:
+            return self._cdc_content_record(last)
         diff = methods.compute_diff(last.data, self.data)
         full = self._full_content_record()
         full_data = _unpack_bytes(full["full"] if ("full" in full) else full["full_compressed"]["data"])
@@ -174,9 +302,29 @@ class DataIncarnation(object):
             },
         }
 
-    def _content_record(self, last, previous):
+    def _blob_content_record(self, blobs, store):
+        # Content shared across keys is stored once in the blob store and
+        # referenced by content hash.
+        if blobs is None or len(self._data) < blobs.min_blob_size:
+            return None
+        if self._dedup_hash is None:
+            self._dedup_hash = methods.compute_dedup_hash(self._data, self.content_hash)
+        dedup_hash = self._dedup_hash
+        digest = dedup_hash["digest"]
+        if not blobs.touch_blob(digest):
+            if not store:
+                return None
+            blobs.put_blob(digest, self._data)
+        return {
+            "blob": {
+                "method": dedup_hash["method"],
+                "digest": digest,
+            },
+        }
+
+    def _content_record(self, last, previous, blobs=None, candidates=None):
         if not last:
-            return self._full_content_record()
+            return self._blob_content_record(blobs, store=True) or self._full_content_record()
         try:
             equal_old = previous[self._content_hash_digest]
         except KeyError:
@@ -184,23 +332,29 @@ class DataIncarnation(object):
         else:
             if self.data == equal_old.data:
                 return self._content_record_same_as(equal_old)
-        k = (last.data_version, last.content_hash_digest)
+        rv = self._blob_content_record(blobs, store=False)
+        if rv is not None:
+            return rv
+        base = self._choose_baseline(last, candidates)
+        k = (base.data_version, base.content_hash_digest)
         try:
-            return self._memo[k]
+            rv = self._memo[k]
         except KeyError:
-            pass
-        rv = self._delta_content_record(last)
-        self._memo = {k: rv}
+            rv = self._delta_content_record(base)
+            self._memo = {k: rv}
+        if "baseline_version" not in rv:
+            rv = self._blob_content_record(blobs, store=True) or rv
         return rv
 
-    def as_record(self, baseline, previous_by_content):
+    def as_record(self, baseline, previous_by_content, blobs=None, candidates=None):
         return {
           "metadata": self._metadata,
-          "content": self._content_record(baseline, previous_by_content),
+          "content": self._content_record(baseline, previous_by_content, blobs=blobs, candidates=candidates),
         }
 
     @staticmethod
-    def build_from_record(record, baseline):
+    def build_from_record(record, baseline, blobs=None, verify=True):
+        decoded_chunk_map = [None]
         def handle_full(cont):
             return _unpack_bytes(cont)
         def handle_full_compressed(cont):
@@ -216,6 +370,63 @@ class DataIncarnation(object):
             patch_bytes = _unpack_bytes(cont["data"])
             new_data = methods.apply_patch(old_data, patch_bytes)
             return new_data
+        def handle_cdc(cont):
+            if cont["method"] != methods.DEFAULT_CHUNKER.chunking_method:
+                raise ValueError("invalid or unhandled 'cdc' section: unknown method ({}); perhaps from a future version?".format(repr(cont["method"])))
+            if not baseline:
+                raise ValueError("invalid 'cdc' section: missing baseline")
+            new_data = zlib.decompress(_unpack_bytes(cont["data"]))
+            if "lengths" in cont:
+                return handle_cdc_lengths(cont, new_data)
+            # Older records only list the lengths of the new chunks, so the
+            # baseline has to be chunked again to find the others.
+            digest = methods.DEFAULT_CHUNKER.chunk_digest
+            pool = {}
+            for chunk in methods.split_content(baseline.data):
+                pool[digest(chunk)] = chunk
+            offset = 0
+            for length in cont["new_lengths"]:
+                chunk = new_data[offset:offset+length]
+                pool[digest(chunk)] = chunk
+                offset += length
+            try:
+                return b"".join(pool[d] for d in cont["chunks"])
+            except KeyError as e:
+                raise ValueError("invalid 'cdc' section: chunk {} is neither in the baseline nor in the record".format(e))
+        def handle_cdc_lengths(cont, new_data):
+            # Every chunk is sliced out of the baseline or the new data by
+            # the recorded lengths; the rolling hash is not run again.
+            if len(cont["lengths"]) != len(cont["chunks"]):
+                raise ValueError("invalid 'cdc' section: {} chunks but {} lengths".format(len(cont["chunks"]), len(cont["lengths"])))
+            base, base_map = baseline.data, baseline.chunk_map
+            parts = []
+            pieces = {}
+            chunk_map = {}
+            offset = new_offset = 0
+            for d, length in zip(cont["chunks"], cont["lengths"]):
+                if d in pieces:
+                    part = pieces[d]
+                elif d in base_map:
+                    start, base_length = base_map[d]
+                    part = base[start:start+base_length]
+                else:
+                    part = new_data[new_offset:new_offset+length]
+                    new_offset += length
+                if len(part) != length:
+                    raise ValueError("invalid 'cdc' section: chunk {} has length {}, not {}".format(d, len(part), length))
+                pieces[d] = part
+                chunk_map.setdefault(d, (offset, length))
+                parts.append(part)
+                offset += length
+            decoded_chunk_map[0] = chunk_map
+            return b"".join(parts)
+        def handle_blob(cont):
+            if blobs is None:
+                raise ValueError("invalid 'blob' section: no blob store provided")
+            try:
+                return blobs.get_blob(cont["digest"])
+            except KeyError:
+                raise ValueError("invalid 'blob' section: blob {} not found".format(cont["digest"]))
         def handle_unchanged(cont):
             if cont != True:
                 raise ValueError("invalid 'unchanged' section: should be True; was {}".format(repr(cont)))
@@ -227,6 +438,8 @@ class DataIncarnation(object):
             "full_compressed": handle_full_compressed,
             "diff": handle_diff,
             "unchanged": handle_unchanged,
+            "blob": handle_blob,
+            "cdc": handle_cdc,
         }
         data_version = record["metadata"]["version"]
         mutdict = dict(record["content"])
@@ -242,15 +455,25 @@ class DataIncarnation(object):
         except KeyError:
             raise ValueError("invalid or unknown encoding method {}".format(repr(k)))
         data = handler(mutdict[k])
-        inc = DataIncarnation(data, data_version)
-        new, old = inc._metadata["content_length"], record["metadata"]["content_length"]
+        new, old = len(data), record["metadata"]["content_length"]
         if new != old:
             raise ValueError("bailing out: data for {} could not be reconstructed to pass length check ({} vs. {})".format(data_version, new, old))
-        # XXX respect different hashing methods
-        new, old = inc.content_hash_digest, record["metadata"]["content_hash"]["digest"]
+        if verify:
+            content_hash = DataIncarnation._verify_hash(data, record)
+        else:
+            content_hash = record["metadata"]["content_hash"]
+        rv = DataIncarnation(data, data_version, content_hash=content_hash)
+        rv._chunk_map = decoded_chunk_map[0]
+        return rv
+
+    @staticmethod
+    def _verify_hash(data, record):
+        recorded = record["metadata"]["content_hash"]
+        content_hash = methods.compute_content_hash(data, method=recorded["method"])
+        new, old = content_hash["digest"], recorded["digest"]
         if new != old:
-            raise ValueError("bailing out: data for {} could not be reconstructed to pass hash check ({} vs. {})".format(data_version, new, old))
-        return inc
+            raise ValueError("bailing out: data for {} could not be reconstructed to pass hash check ({} vs. {})".format(record["metadata"]["version"], new, old))
+        return content_hash
 
 class Entry(object):
     def __init__(self, key, versioninfo, dependency_chain_length, incarnations):
@@ -259,10 +482,16 @@ class Entry(object):
         self._versioninfo = versioninfo
         self._chain_length = dependency_chain_length
         self._incarnations = incarnations
+        # Integer versions of the incarnations, for bisection.
+        self._version_index = [int(inc.data_version) for inc in incarnations]
         self._external_last_version = None
+        # Recent distinct versions in the chunks this entry's next chunk
+        # depends on; any of them can serve as a diff baseline.
+        self._external_baselines = []
+        self._max_baselines = DEFAULT_BASELINE_CANDIDATES
 
     @staticmethod
-    def create_initial(key, data, data_version):
+    def create_initial(key, data, data_version, content_hash=None):
         ver = data_version
         vers = DatadiffVersionsHeader(
             first_contained_version=ver,
@@ -271,31 +500,45 @@ class Entry(object):
             last_contained_version_with_diff=ver,
             depends_on_external_version=None,
         )
-        incarn = [DataIncarnation(data=data, data_version=ver)]
+        incarn = [DataIncarnation(data=data, data_version=ver, content_hash=content_hash)]
         return Entry(key=key,
           dependency_chain_length=0,
           versioninfo=vers,
           incarnations=incarn)
 
+    @staticmethod
+    def _read_dump_file(reader):
+        with reader() as buf:
+            # Not zero-copy: the JSON is decoded into a str holding the
+            # whole chunk. Decoding straight from the buffer only saves
+            # the bytes copy a file read or bytes(buf) would make first.
+            size = len(buf)
+            text, _ = codecs.utf_8_decode(buf)
+            rv = json.loads(text)
+        # XXX validate with jsonschema?
+        return (rv["datawatch"]["header"], rv["datawatch"]["content"]), size
+
     @staticmethod
     def _parse_dump_file(reader, handle_record=None, handle_header=None):
-        with reader() as f:
-            # XXX simplistic implementation
-            rv = json.load(f)
-            # XXX validate with jsonschema?
-            if handle_header:
-                handle_header(rv["datawatch"]["header"])
-            if handle_record:
-                for record in rv["datawatch"]["content"]:
-                    handle_record(record)
+        (header, records), _ = Entry._read_dump_file(reader)
+        if handle_header:
+            handle_header(header)
+        if handle_record:
+            for record in records:
+                handle_record(record)
 
     @staticmethod
-    def _load_from_dump_files(filenames_with_readers, only_from_last_checkpoint=False, full_history=False):
+    def _load_from_dump_files(filenames_with_readers, only_from_last_checkpoint=False, full_history=False, chunk_cache=None, cache_namespace=None, blobs=None, verify="full", min_version=None, max_version=None):
         if _boolcount(only_from_last_checkpoint, full_history) != 1:
             raise ValueError("exactly one read mode must be set (only_from_last_checkpoint or full_history)")
+        ranged = (min_version is not None) or (max_version is not None)
+        if ranged and not full_history:
+            raise ValueError("a version range can only be loaded with full_history")
+        should_verify = _make_verify_predicate(verify)
         ctx = {}
         datas = {}
         recs_by_version = {}
+        chunk_by_version = {}
         versions_required = set()
         last_with_diff = None
         def ensure_consistent(k, hdr, getter):
@@ -315,9 +558,10 @@ class Entry(object):
                 ctx["last_with_diff"] = lc
             elif lc:
                 ctx["last_with_diff"] = max(ctx["last_with_diff"], ctx["last_with_diff"])
-        def on_record(rec):
+        def on_record(rec, filename):
             v = rec["metadata"]["version"]
             recs_by_version[v] = rec
+            chunk_by_version[v] = filename
             req = rec["content"].get("baseline_version")
             if req:
                 versions_required.add(req)
@@ -326,7 +570,9 @@ class Entry(object):
             raise RuntimeError("no files specified")
         fni_with_readers = [(filenames.decode_filename(name), reader) for name, reader in filenames_with_readers]
         stamped_fni_with_readers = [(int(fni.last_version), fni, reader) for fni, reader in fni_with_readers]
-        stamped_fni_with_readers.sort()
+        # Where a compacted chunk and the chain it replaces end at the same
+        # version, prefer the compacted one.
+        stamped_fni_with_readers.sort(key=lambda t: (t[0], -t[1].dependency_chain_length))
         fnis_with_readers_by_stamp = {str(v): (fni, reader) for (v, fni, reader) in stamped_fni_with_readers}
         latest = tuple(stamped_fni_with_readers[-1][1:])
         trail = [latest]
@@ -349,9 +595,23 @@ class Entry(object):
         else:
             assert full_history
             to_load = filenames_with_readers
+        if cache_namespace is None:
+            chunk_cache = None
         n = 0
-        for filename, reader in to_load:
-            Entry._parse_dump_file(reader, handle_header=on_header, handle_record=on_record)
+        name_by_reader = {reader: name for name, reader in filenames_with_readers}
+        for _, reader in to_load:
+            filename = name_by_reader[reader]
+            parsed = None
+            if chunk_cache is not None:
+                parsed = chunk_cache.get((cache_namespace, filename, "parsed"))
+            if parsed is None:
+                parsed, size = Entry._read_dump_file(reader)
+                if chunk_cache is not None:
+                    chunk_cache.put((cache_namespace, filename, "parsed"), parsed, size)
+            header, records = parsed
+            on_header(header)
+            for record in records:
+                on_record(record, filename)
             n += 1
         if not n:
             raise RuntimeError("no files specified")
@@ -365,16 +625,25 @@ class Entry(object):
             raise RuntimeError("files do not cover a self-contained set of versions: external version would be required (forbidden): {}".format(repr(rv)))
         versionlist = list(recs_by_version)
         versionlist.sort()
-        versioninfo = DatadiffVersionsHeader(
-            first_contained_version=versionlist[0],
-            last_contained_version=versionlist[-1],
-            last_contained_version_with_diff=ctx["last_with_diff"],
-            first_known_version=ctx["versioninfo.first_known_version"],
-            depends_on_external_version=None,
-        )
+        wanted = versionlist
+        if ranged:
+            wanted = _versions_for_range(versionlist, min_version, max_version)
+            if not wanted:
+                raise RuntimeError("provided set of {} chunks contains no version up to {}".format(len(filenames_with_readers), max_version))
+        # Outside a range, only the versions the wanted ones are diffed
+        # against (transitively) are reconstructed.
+        needed = set(wanted)
+        pending = list(wanted)
+        while pending:
+            req = recs_by_version[pending.pop()]["content"].get("baseline_version")
+            if req and req not in needed:
+                needed.add(req)
+                pending.append(req)
         built_incarnations = []
         built_incarnations_index = {}
         for v in versionlist:
+            if v not in needed:
+                continue
             rec = recs_by_version[v]
             cont = rec["content"]
             try:
@@ -387,45 +656,96 @@ class Entry(object):
                     baseline_inc = built_incarnations_index[baseline_ver]
                 except KeyError:
                     raise RuntimeError("content for {} refers to version {} out of sequence".format(v, baseline_ver))
-            new_inc = DataIncarnation.build_from_record(rec, baseline=baseline_inc)
+            verify_this = should_verify(v, wanted[-1])
+            cache_key = (cache_namespace, chunk_by_version[v], "incarnation", v)
+            cached = None
+            if chunk_cache is not None:
+                cached = chunk_cache.get(cache_key)
+            if cached is None:
+                new_inc = DataIncarnation.build_from_record(rec, baseline=baseline_inc, blobs=blobs, verify=verify_this)
+                if chunk_cache is not None:
+                    chunk_cache.put(cache_key, (new_inc, verify_this), len(new_inc.data) + 256)
+            else:
+                new_inc, verified = cached
+                if verify_this and not verified:
+                    DataIncarnation._verify_hash(new_inc.data, rec)
+                    chunk_cache.put(cache_key, (new_inc, True), len(new_inc.data) + 256)
             built_incarnations.append(new_inc)
             built_incarnations_index[v] = new_inc
+        last_with_diff = ctx["last_with_diff"]
+        if ranged:
+            built_incarnations = [built_incarnations_index[v] for v in wanted]
+            last_with_diff = None
+            prev = None
+            for inc in built_incarnations:
+                if not inc.same_data_as(prev):
+                    last_with_diff = inc.data_version
+                prev = inc
+        versioninfo = DatadiffVersionsHeader(
+            first_contained_version=wanted[0],
+            last_contained_version=wanted[-1],
+            last_contained_version_with_diff=last_with_diff,
+            first_known_version=ctx["versioninfo.first_known_version"],
+            depends_on_external_version=None,
+        )
         return Entry(key=ctx["key"],
           dependency_chain_length=0,
           versioninfo=versioninfo,
           incarnations=built_incarnations)
 
-    def write_dump(self, storage):
-        self._write_named_json(storage.write_chunk)
+    def write_dump(self, storage, blobs=None):
+        self._write_named_json(storage.write_chunk, blobs=blobs)
+
+    def snapshot(self):
+        # Incarnations are immutable, so a shallow copy can be serialized
+        # while this entry keeps being updated and flushed.
+        rv = Entry(key=self._key,
+          dependency_chain_length=self._chain_length,
+          versioninfo=self._versioninfo,
+          incarnations=list(self._incarnations))
+        rv._external_last_version = self._external_last_version
+        rv._external_baselines = list(self._external_baselines)
+        rv._max_baselines = self._max_baselines
+        return rv
 
     @staticmethod
-    def load_dumps(storage, filenames, **kwargs):
+    def load_dumps(storage, filenames, chunk_cache=chunkcache.DEFAULT, **kwargs):
         filenames = list(filenames)
         filename_readers = []
         for fn in filenames:
             def make_contextmanager(captured_fn):
                 @contextlib.contextmanager
                 def read_this_chunk():
-                    with storage.read_chunk(captured_fn) as f:
-                        yield f
+                    with storage.read_chunk_buffer(captured_fn) as buf:
+                        yield buf
                 return read_this_chunk
             filename_readers.append((fn, make_contextmanager(fn)))
-        return Entry._load_from_dump_files(filename_readers, **kwargs)
+        return Entry._load_from_dump_files(filename_readers, chunk_cache=chunk_cache, cache_namespace=storage.cache_namespace, **kwargs)
 
-    def update_data(self, readflo, data_version):
+    def update_data(self, readflo, data_version, content_hash=None):
         readflo = _coerce_to_readflo(readflo)
         if int(self.current_version) == int(data_version):
             raise ValueError("cannot update with same version")
         if int(self.current_version) > int(data_version):
             raise ValueError("cannot update with older version")
         data = readflo.read()
-        has_diff = data != self._incarnations[-1].data
-        inc = DataIncarnation(data=data, data_version=data_version)
+        inc = DataIncarnation(data=data, data_version=data_version, content_hash=content_hash)
+        has_diff = not inc.same_data_as(self._incarnations[-1])
         self._incarnations.append(inc)
+        self._version_index.append(int(data_version))
         self._versioninfo = self._versioninfo._replace(last_contained_version=data_version)
         if has_diff:
             self._versioninfo = self._versioninfo._replace(last_contained_version_with_diff=data_version)
 
+    def update_unchanged(self, data_version):
+        cur = self._incarnations[-1]
+        if int(cur.data_version) >= int(data_version):
+            raise ValueError("cannot update with same or older version")
+        inc = DataIncarnation(data=cur.data, data_version=data_version, content_hash=cur.content_hash)
+        self._incarnations.append(inc)
+        self._version_index.append(int(data_version))
+        self._versioninfo = self._versioninfo._replace(last_contained_version=data_version)
+
     def _has_data(self):
         return self._versioninfo and (self._chain_length is not None)
     
@@ -445,26 +765,28 @@ class Entry(object):
     def _make_metadata_header(self):
         return _make_header(self._make_nameinfo(), self._versioninfo, self.key)
 
-    def _generate_records(self):
+    def _generate_records(self, blobs=None):
         last = self._external_last_version
         prev = {}
+        candidates = list(self._external_baselines) or ([last] if last else [])
         for inc in self._incarnations:
             if last and inc.data_version <= last.data_version:
                 raise ValueError("incarnations are in inconsistent state (out of order)")
             h = inc.content_hash_digest
-            rec = inc.as_record(baseline=last, previous_by_content=prev)
+            rec = inc.as_record(baseline=last, previous_by_content=prev, blobs=blobs, candidates=candidates)
             yield rec
             last = inc
             prev[h] = inc
+            candidates = _recent_distinct(candidates + [inc], self._max_baselines)
 
-    def _write_named_json(self, opener):
+    def _write_named_json(self, opener, blobs=None):
         hdr = self._make_metadata_header()
         with opener(hdr["name"]) as binary_out:
             out = codecs.getwriter("utf-8")(binary_out)
             out.write("""{"datawatch":{"header":""")
             json.dump(hdr, out, indent="  ")
             out.write(""","content":[""")
-            for i, rec in enumerate(self._generate_records()):
+            for i, rec in enumerate(self._generate_records(blobs=blobs)):
                 if i > 0:
                     out.write(",")
                 json.dump(rec, out, indent="  ")
@@ -476,13 +798,17 @@ class Entry(object):
             yield out
         self._write_named_json(dummy_opener)
 
-    def flush(self, dependency_chain_length_limit=10):
+    def flush(self, dependency_chain_length_limit=10, baseline_candidates=None):
+        if baseline_candidates is not None:
+            self._max_baselines = baseline_candidates
         if len(self._incarnations) < 2:
             return
+        self._external_baselines = _recent_distinct(self._external_baselines + self._incarnations[:-1], self._max_baselines)
         self._external_last_version = self._incarnations[-2]
         cur = self._incarnations[-1]
         has_diff = not cur.same_data_as(self._external_last_version)
         self._incarnations = [cur]
+        self._version_index = [int(cur.data_version)]
         self._chain_length = self._chain_length + 1
         self._versioninfo = self._versioninfo._replace(
             first_contained_version=cur.data_version,
@@ -492,23 +818,76 @@ class Entry(object):
         if dependency_chain_length_limit is not None:
             if self._chain_length > dependency_chain_length_limit:
                 self._external_last_version = None
+                self._external_baselines = []
                 self._chain_length = 0
                 self._versioninfo = self._versioninfo._replace(depends_on_external_version=None)
 
+    def with_incarnations(self, incarnations):
+        # A self-contained entry holding a subset of this entry's
+        # incarnations; first_known_version is kept.
+        incarnations = list(incarnations)
+        if not incarnations:
+            raise ValueError("no incarnations provided")
+        last_with_diff = None
+        prev = None
+        for inc in incarnations:
+            if not inc.same_data_as(prev):
+                last_with_diff = inc.data_version
+            prev = inc
+        return Entry(key=self._key,
+          dependency_chain_length=0,
+          versioninfo=self._versioninfo._replace(
+            first_contained_version=incarnations[0].data_version,
+            last_contained_version=incarnations[-1].data_version,
+            last_contained_version_with_diff=last_with_diff,
+            depends_on_external_version=None),
+          incarnations=incarnations)
+
+    def suffix_after(self, data_version, dependency_chain_length):
+        # The incarnations after data_version, as an entry that is written
+        # as a chunk depending on data_version.
+        baseline = None
+        rest = []
+        for inc in self._incarnations:
+            if int(inc.data_version) == int(data_version):
+                baseline = inc
+            elif int(inc.data_version) > int(data_version):
+                rest.append(inc)
+        if baseline is None:
+            raise ValueError("version {} is not loaded; cannot use it as a baseline".format(data_version))
+        if not rest:
+            return None
+        last_with_diff = None
+        prev = baseline
+        for inc in rest:
+            if not inc.same_data_as(prev):
+                last_with_diff = inc.data_version
+            prev = inc
+        rv = Entry(key=self._key,
+          dependency_chain_length=dependency_chain_length,
+          versioninfo=self._versioninfo._replace(
+            first_contained_version=rest[0].data_version,
+            last_contained_version=rest[-1].data_version,
+            last_contained_version_with_diff=last_with_diff,
+            depends_on_external_version=baseline.data_version),
+          incarnations=rest)
+        rv._external_last_version = baseline
+        return rv
+
     def _find_incarnation(self, target):
         assert self._versioninfo.first_contained_version <= target <= self._versioninfo.last_contained_version
-        # XXX index and/or binary search
-        last = None
-        for inc in self._incarnations:
-            if target == inc.data_version:
-                return inc
-            if target < inc.data_version:
-                assert last
-                assert target >= last.data_version
-                return last
-            last = inc
-        assert self._versioninfo.last_contained_version == last.data_version == target
-        return last
+        # The incarnation in effect at target: the last one at or before it.
+        i = bisect.bisect_right(self._version_index, int(target))
+        assert i > 0
+        return self._incarnations[i - 1]
+
+    def versions_between(self, min_version=None, max_version=None):
+        # The loaded incarnations with versions in [min_version, max_version];
+        # either bound may be None.
+        lo = 0 if min_version is None else bisect.bisect_left(self._version_index, int(min_version))
+        hi = len(self._incarnations) if max_version is None else bisect.bisect_right(self._version_index, int(max_version))
+        for i in range(lo, hi):
+            yield self._incarnations[i]
 
     def read_data_bytes_at(self, data_version):
         with self.read_data_at(data_version) as f:
@@ -605,31 +984,167 @@ def _make_example():
     new_entry.update_data(io.BytesIO((xs+"z"+ys).encode("utf-8")), "124000702")
     return new_entry
 
-def read_streaming(store, key_filter=None, include_unchanged=False):
+def _versions_for_range(versionlist, min_version=None, max_version=None):
+    # The sorted versions in the range, preceded by the one in effect at
+    # min_version, so the result can answer reads anywhere in the range.
+    ints = [int(v) for v in versionlist]
+    lo = 0 if min_version is None else max(0, bisect.bisect_right(ints, int(min_version)) - 1)
+    hi = len(versionlist) if max_version is None else bisect.bisect_right(ints, int(max_version))
+    return versionlist[lo:hi]
+
+def _dependency_closure(decoded, selected):
+    # The selected chunks plus the chunks their dependency chains lead back
+    # to, which are needed to reconstruct them.
+    by_last_version = {fni.last_version: name for name, fni in decoded.items()}
+    selected = set(selected)
+    pending = list(selected)
+    while pending:
+        dep = decoded[pending.pop()].depends_on_version
+        if dep is None:
+            continue
+        parent = by_last_version.get(dep)
+        if parent is None:
+            containing = [name for name, fni in decoded.items() if int(fni.first_version) <= int(dep) <= int(fni.last_version)]
+            if not containing:
+                raise RuntimeError("no chunk contains version {} required by a dependent chunk".format(dep))
+            parent = containing[0]
+        if parent not in selected:
+            selected.add(parent)
+            pending.append(parent)
+    return sorted(selected)
+
+def _select_chunks_for_range(names, min_version=None, max_version=None):
+    # Chunks overlapping the range, with their dependencies.
+    decoded = {name: filenames.decode_filename(name) for name in names}
+    selected = set()
+    for name, fni in decoded.items():
+        if min_version is not None and int(fni.last_version) < int(min_version):
+            continue
+        if max_version is not None and int(fni.first_version) > int(max_version):
+            continue
+        selected.add(name)
+    return _dependency_closure(decoded, selected)
+
+def _list_chunks_for_range(store, keyhash, min_version=None, max_version=None):
+    # Like _select_chunks_for_range over all of the key's chunks, but the
+    # store filters by version, and each dependency outside the range is
+    # listed on its own as the chains are followed back.
+    decoded = {name: filenames.decode_filename(name) for name in store.list_filtered_chunks(keyhash_filter=[keyhash], min_last_version=min_version, max_first_version=max_version)}
+    pending = list(decoded)
+    while pending:
+        dep = decoded[pending.pop()].depends_on_version
+        if dep is None or any(int(fni.first_version) <= int(dep) <= int(fni.last_version) for fni in decoded.values()):
+            continue
+        containing = store.list_filtered_chunks(keyhash_filter=[keyhash], min_last_version=dep, max_first_version=dep)
+        if not containing:
+            raise RuntimeError("no chunk contains version {} required by a dependent chunk".format(dep))
+        found = {name: filenames.decode_filename(name) for name in containing}
+        parent = next((name for name, fni in found.items() if fni.last_version == dep), containing[0])
+        decoded[parent] = found[parent]
+        pending.append(parent)
+    return _dependency_closure(decoded, decoded)
+
+def _select_chunks_at(names, version):
+    # One chunk holding the latest version at or before the given one, with
+    # its dependencies: a chunk spanning the version if there is one, else
+    # the one ending closest before it. Shorter chains are preferred.
+    decoded = {name: filenames.decode_filename(name) for name in names}
+    best, best_order = None, None
+    for name, fni in decoded.items():
+        if int(fni.first_version) > int(version):
+            continue
+        order = (min(int(fni.last_version), int(version) + 1), -fni.dependency_chain_length)
+        if best is None or order > best_order:
+            best, best_order = name, order
+    if best is None:
+        return []
+    return _dependency_closure(decoded, [best])
+
+def blob_references(store):
+    for name in store.list_chunks():
+        (_, records), _ = Entry._read_dump_file(lambda: store.read_chunk_buffer(name))
+        for record in records:
+            blob = record["content"].get("blob")
+            if blob is not None:
+                yield blob["digest"]
+
+def read_snapshot(store, at_version, key_filter=None, chunk_names=None, chunk_cache=chunkcache.DEFAULT, blobs=None, verify="full"):
+    # Yields (key, data_version, data) for the latest version at or before
+    # at_version of every key, loading only the chunks needed for it.
+    # chunk_names may map keyhashes to chunk names, e.g. from a
+    # materialized index, to avoid listing the store; a key whose indexed
+    # chunks have since been deleted (e.g. by compaction) is listed afresh.
+    from_index = chunk_names is not None
+    if chunk_names is None:
+        chunk_names = collections.defaultdict(list)
+        for name in store.list_chunks():
+            chunk_names[filenames.decode_filename(name).keyhash].append(name)
+    only_keys = None
+    keyhashes = sorted(chunk_names)
+    if key_filter is not None:
+        only_keys = set(key_filter)
+        wanted = set(methods.compute_key_hash(k)["digest"] for k in only_keys)
+        keyhashes = [kh for kh in keyhashes if kh in wanted]
+    for kh in keyhashes:
+        names = _select_chunks_at(chunk_names[kh], at_version)
+        if not names:
+            continue
+        try:
+            entry = Entry.load_dumps(store, names, full_history=True, chunk_cache=chunk_cache, blobs=blobs, verify=verify, min_version=at_version, max_version=at_version)
+        except (KeyError, FileNotFoundError):
+            if not from_index:
+                raise
+            names = _select_chunks_at(store.list_filtered_chunks(keyhash_filter=[kh]), at_version)
+            if not names:
+                continue
+            entry = Entry.load_dumps(store, names, full_history=True, chunk_cache=chunk_cache, blobs=blobs, verify=verify, min_version=at_version, max_version=at_version)
+        if only_keys is not None and entry.key not in only_keys:
+            continue
+        # Only the version in effect at at_version is loaded.
+        found = entry._incarnations[-1]
+        yield entry.key, found.data_version, found.data
+
+def read_streaming(store, key_filter=None, include_unchanged=False, min_version=None, max_version=None, chunk_cache=chunkcache.DEFAULT, blobs=None, verify="full"):
     assert key_filter or (key_filter is None)
-    keyhashes = Collection(store).get_keyhash_names_from_storage()
     only_keys = only_keyhashes = None
     if key_filter is not None:
         only_keys = set(key_filter)
         only_keyhashes = set(methods.compute_key_hash(k)["digest"] for k in only_keys)
+        keyhashes = sorted(only_keyhashes)
+    else:
+        keyhashes = Collection(store).get_keyhash_names_from_storage()
+    ranged = (min_version is not None) or (max_version is not None)
     for kh in keyhashes:
-        if (key_filter is not None) and kh not in only_keyhashes:
+        if ranged:
+            names = _list_chunks_for_range(store, kh, min_version=min_version, max_version=max_version)
+        else:
+            names = store.list_filtered_chunks(keyhash_filter=[kh])
+        if not names:
             continue
         # TODO optimize or at least make actually streaming.
         # don't need to load the entire history at once.
-        entry = Collection(store, full_history=True)[kh]
+        entry = Entry.load_dumps(store, names, full_history=True, chunk_cache=chunk_cache, blobs=blobs, verify=verify, min_version=min_version, max_version=max_version)
         if (key_filter is not None) and entry.key not in only_keys:
             continue
         last_data = None
-        for inc in entry.incarnations():
+        for inc in entry.versions_between(min_version, max_version):
             if inc.data == last_data and not include_unchanged:
                 continue
             last_data = inc.data
             yield entry, inc
 
 class Collection(object):
-    def __init__(self, storage, flush_settings=None, full_history=False):
+    def __init__(self, storage, flush_settings=None, full_history=False, writer=None, wal=None, chunk_cache=chunkcache.DEFAULT, blobs=None, verify="full", indexes=None):
         self._storage = storage
+        self._blobs = blobs
+        # Secondary indexes (e.g. hashindex, textindex) updated with every
+        # chunk written to the store.
+        self._indexes = list(indexes or [])
+        self._verify = verify
+        self._chunk_cache = chunk_cache
+        self._writer = writer
+        self._wal = wal
+        self._last_submitted = {}
         self._entries = {}
         self._keys = set()
         self._keyhashes = set()
@@ -650,10 +1165,10 @@ class Collection(object):
         if not names:
             return None
         if not self._full_history:
-            entry = Entry.load_dumps(self._storage, names, only_from_last_checkpoint=True)
+            entry = Entry.load_dumps(self._storage, names, only_from_last_checkpoint=True, chunk_cache=self._chunk_cache, blobs=self._blobs, verify=self._verify)
             entry.flush(dependency_chain_length_limit=0)
         else:
-            entry = Entry.load_dumps(self._storage, names, full_history=True)
+            entry = Entry.load_dumps(self._storage, names, full_history=True, chunk_cache=self._chunk_cache, blobs=self._blobs, verify=self._verify)
         self._entries[keyhash] = entry
         self._keys.add(entry.key)
         self._keyhashes.add(entry.info.keyhash)
@@ -665,26 +1180,57 @@ class Collection(object):
         if entry is None:
             return entry
         if entry.key != key:
-            raise ValueError("hash collision ({} vs. {} both map to {}; bailing out)".format(entry.key, key, kh))
+            raise ValueError("hash collision ({} vs. {} both map to {}; bailing out)".format(entry.key, key, keyhash))
         return entry
 
-    def _get_entry_by_key_and_update(self, key, data, data_version):
+    def _get_entry_by_key_and_update(self, key, data, data_version, content_hash=None, unchanged=False):
         kh = self._compute_keyhash(key)
         entry = self._try_get_entry_by_keyhash(kh)
-        if entry is None:
-            entry = Entry.create_initial(key, data, data_version)
+        if entry is not None and unchanged:
+            entry.update_unchanged(data_version)
+        elif entry is None:
+            entry = Entry.create_initial(key, data, data_version, content_hash=content_hash)
             self._entries[kh] = entry
             self._keys.add(entry.key)
             self._keyhashes.add(entry.info.keyhash)
         else:
-            entry.update_data(io.BytesIO(data), data_version)
+            entry.update_data(io.BytesIO(data), data_version, content_hash=content_hash)
         if entry.key != key:
             raise ValueError("hash collision ({} vs. {} both map to {}; bailing out)".format(entry.key, key, kh))
         return entry
 
-    def update_data(self, key, data, data_version):
-        readflo = _coerce_to_bytes(data)
-        return self._get_entry_by_key_and_update(key, data, data_version)
+    def update_data(self, key, data, data_version, content_hash=None, unchanged=False):
+        # With unchanged=True the version repeats the current data of an
+        # existing entry; data is only used if the key has no entry yet.
+        data = _coerce_to_bytes(data)
+        entry = self._get_entry_by_key_and_update(key, data, data_version, content_hash=content_hash, unchanged=unchanged)
+        if self._wal is not None:
+            inc = entry._incarnations[-1]
+            changed = entry._versioninfo.last_contained_version_with_diff == data_version
+            self._wal.append(key, data_version, inc.content_hash, inc.data if changed else None)
+        return entry
+
+    def replay_wal(self):
+        n = 0
+        for key, data_version, content_hash, data in self._wal.replay():
+            entry = self._try_get_entry_by_key(key)
+            if entry is not None and int(entry.current_version) >= int(data_version):
+                continue
+            self._get_entry_by_key_and_update(key, data, data_version, content_hash=content_hash, unchanged=data is None)
+            n += 1
+        return n
+
+    def checkpoint_all(self):
+        did = False
+        stored_versions = self._determine_last_stored_versions(self._storage)
+        for kh in list(self):
+            if self._sync_and_flush_single(kh, stored_versions=stored_versions):
+                did = True
+        if self._writer is not None:
+            self._writer.drain()
+        if self._wal is not None:
+            self._wal.truncate()
+        return did
     
     def entry_by_key(self, key):
         rv = self._try_get_entry_by_key(key)
@@ -709,18 +1255,43 @@ class Collection(object):
             return None
         return max([fni.last_version for fni in fnis])
 
-    def _write_to_storage_and_flush(self, entry, store):
+    def _determine_last_stored_versions(self, store):
+        rv = {}
+        for fn in store.list_chunks():
+            fni = filenames.decode_filename(fn)
+            if fni.keyhash not in rv or int(fni.last_version) > int(rv[fni.keyhash]):
+                rv[fni.keyhash] = fni.last_version
+        return rv
+
+    def _write_to_storage_and_flush(self, entry, store, writer=None, stored_versions=None):
         kh = entry.info.keyhash
-        last_stored_version = self._determine_last_stored_version(kh, store)
-        if last_stored_version is None:
-            entry.write_dump(store)
-            return True
-        have_more_recent = int(entry.current_version) > int(last_stored_version)
-        if not have_more_recent:
-            return False
-        entry.write_dump(store)
+        if stored_versions is None:
+            last_stored_version = self._determine_last_stored_version(kh, store)
+        else:
+            last_stored_version = stored_versions.get(kh)
+        if writer is not None and kh in self._last_submitted:
+            # The store may not reflect writes that are still queued.
+            submitted = self._last_submitted[kh]
+            if last_stored_version is None or int(submitted) > int(last_stored_version):
+                last_stored_version = submitted
+        if last_stored_version is not None:
+            have_more_recent = int(entry.current_version) > int(last_stored_version)
+            if not have_more_recent:
+                return False
+        if writer is None:
+            self._write_dump(entry, store)
+        else:
+            writer.submit(self._write_dump, entry.snapshot(), store)
+            self._last_submitted[kh] = entry.current_version
         return True
 
+    def _write_dump(self, entry, store):
+        entry.write_dump(store, blobs=self._blobs)
+        # Only chunks written to this collection's own store are indexed.
+        if store is self._storage:
+            for index in self._indexes:
+                index.add_entry(entry)
+
     def _sync_to_other(self, other_coll):
         did = False
         for kh in self:
@@ -745,19 +1316,42 @@ class Collection(object):
         for kh in self.get_keyhash_names_from_storage():
             self.load_keyhash_from_storage(kh)
 
+    def _summarize_keyhash_to(self, store, kh):
+        # Summaries are appended as chunks depending on the last summarized
+        # version, so each run only reads and writes the new versions.
+        names = self._storage.list_filtered_chunks(keyhash_filter=[kh])
+        if not names:
+            return False
+        summary_names = store.list_filtered_chunks(keyhash_filter=[kh])
+        if not summary_names:
+            entry = Entry.load_dumps(self._storage, names, full_history=True, chunk_cache=self._chunk_cache, blobs=self._blobs, verify=self._verify)
+            entry.write_dump(store, blobs=self._blobs)
+            return True
+        latest = max((filenames.decode_filename(name) for name in summary_names), key=lambda fni: int(fni.last_version))
+        names = _select_chunks_for_range(names, min_version=latest.last_version)
+        if not names:
+            return False
+        entry = Entry.load_dumps(self._storage, names, full_history=True, chunk_cache=self._chunk_cache, blobs=self._blobs, verify=self._verify)
+        tail = entry.suffix_after(latest.last_version, dependency_chain_length=latest.dependency_chain_length + 1)
+        if tail is None:
+            return False
+        tail.write_dump(store, blobs=self._blobs)
+        return True
+
     def _summarize_to_specific(self, other_coll, khs):
-        hist = Collection(self._storage, full_history=True)
+        did = False
         for kh in khs:
-            hist._try_get_entry_by_keyhash(kh)
-        hist._sync_to_other(other_coll)
+            if self._summarize_keyhash_to(other_coll._storage, kh):
+                did = True
+        return did
 
     def summarize_to(self, other_coll):
         return self._summarize_to_specific(other_coll, list(self))
     
-    def _sync_and_flush_single(self, kh):
+    def _sync_and_flush_single(self, kh, stored_versions=None):
         entry = self[kh]
         did = False
-        if self._write_to_storage_and_flush(entry, self._storage):
+        if self._write_to_storage_and_flush(entry, self._storage, writer=self._writer, stored_versions=stored_versions):
             did = True
         entry.flush(**self._flush_settings)
         self._last_flushed[kh] = time.time()
@@ -4,6 +4,7 @@ import datadiff
 
 import io
 import json
+import pytest
 
 def _make_example():
     import io
@@ -46,3 +47,248 @@ def test_coercing_to_bytes():
     assert datadiff._coerce_to_bytes(io.BytesIO(b"hello")) == b"hello"
     assert datadiff._coerce_to_bytes(b"hello") == b"hello"
     assert datadiff._coerce_to_bytes("hello") == b"hello"
+
+def test_update_with_precomputed_content_hash():
+    coll = datadiff.Collection(datadiff.storage.InMemoryStorage())
+    data = b"hello world"
+    content_hash = datadiff.methods.compute_content_hash(data)
+    entry = coll.update_data("https://example.com/", io.BytesIO(data), "100", content_hash=content_hash)
+    entry = coll.update_data("https://example.com/", data, "200", content_hash=content_hash)
+    assert entry.current_content_hash_digest == content_hash["digest"]
+    assert entry.read_data_bytes_at("150") == data
+    assert entry._versioninfo.last_contained_version_with_diff == "100"
+
+def test_update_unchanged_repeats_current_data():
+    coll = datadiff.Collection(datadiff.storage.InMemoryStorage())
+    coll.update_data("https://example.com/", b"first", "100")
+    entry = coll.update_data("https://example.com/", b"first, with a new nonce", "200", unchanged=True)
+    assert entry.read_data_bytes_at("200") == b"first"
+    assert entry.loaded_versions() == ["100", "200"]
+    assert entry._versioninfo.last_contained_version_with_diff == "100"
+
+def test_sync_with_background_writer():
+    import writer
+    store = datadiff.storage.InMemoryStorage()
+    w = writer.BackgroundWriter(max_pending=1)
+    coll = datadiff.Collection(store, writer=w)
+    key = "https://example.com/"
+    versions = [str(100 + i) for i in range(20)]
+    for i, ver in enumerate(versions):
+        coll.update_data(key, "content {}".format(i // 3), ver)
+        if i % 4 == 3:
+            coll.sync_and_flush_one()
+            assert not coll.sync_and_flush_one()
+    coll.sync_and_flush_one()
+    w.close()
+    loaded = datadiff.Collection(store, full_history=True).entry_by_key(key)
+    assert loaded.loaded_versions() == versions
+    for i, ver in enumerate(versions):
+        assert loaded.read_data_bytes_at(ver) == "content {}".format(i // 3).encode("utf-8")
+
+def test_wal_replay_restores_uncheckpointed_versions(tmp_path):
+    import wal
+    store = datadiff.storage.InMemoryStorage()
+    path = str(tmp_path / "wal.log")
+    key = "https://example.com/"
+    coll = datadiff.Collection(store, wal=wal.WriteAheadLog(path))
+    coll.update_data(key, b"one", "100")
+    coll.checkpoint_all()
+    coll.update_data(key, b"two", "200")
+    coll.update_data(key, b"two", "300")
+    coll._wal.close()
+    recovered = datadiff.Collection(store, wal=wal.WriteAheadLog(path))
+    assert recovered.replay_wal() == 2
+    entry = recovered.entry_by_key(key)
+    assert entry.current_version == "300"
+    assert entry.read_data_bytes_at("250") == b"two"
+    recovered.checkpoint_all()
+    assert list(recovered._wal.replay()) == []
+    loaded = datadiff.Collection(store, full_history=True).entry_by_key(key)
+    assert loaded.loaded_versions() == ["100", "200", "300"]
+
+def test_read_streaming_version_range():
+    store = datadiff.storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    key = "https://example.com/"
+    for i in range(30):
+        coll.update_data(key, "content {}".format(i).encode("utf-8"), str(1000 + i))
+        if i % 5 == 4:
+            coll.sync_and_flush_one()
+    read = [(inc.data_version, inc.data) for _, inc in datadiff.read_streaming(store, min_version="1012", max_version="1017")]
+    assert read == [(str(1000 + i), "content {}".format(i).encode("utf-8")) for i in range(12, 18)]
+    names = store.list_filtered_chunks(keyhash_filter=[coll._compute_keyhash(key)])
+    assert len(datadiff._select_chunks_for_range(names, min_version="1012", max_version="1017")) < len(names)
+    selected = datadiff._select_chunks_for_range(names, min_version="1012", max_version="1017")
+    assert datadiff._list_chunks_for_range(store, coll._compute_keyhash(key), min_version="1012", max_version="1017") == selected
+
+def test_read_snapshot():
+    store = datadiff.storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    for i in range(30):
+        coll.update_data("https://example.com/a", "a {}".format(i).encode("utf-8"), str(1000 + 2 * i))
+        if i >= 10:
+            coll.update_data("https://example.com/b", "b {}".format(i).encode("utf-8"), str(1001 + 2 * i))
+        if i % 5 == 4:
+            coll.sync_and_flush_one()
+            coll.sync_and_flush_one()
+    assert sorted(datadiff.read_snapshot(store, "1013")) == [("https://example.com/a", "1012", b"a 6")]
+    assert sorted(datadiff.read_snapshot(store, "1031")) == [
+        ("https://example.com/a", "1030", b"a 15"),
+        ("https://example.com/b", "1031", b"b 15"),
+    ]
+    assert list(datadiff.read_snapshot(store, "999")) == []
+    assert list(datadiff.read_snapshot(store, "5000", key_filter=["https://example.com/b"])) == [("https://example.com/b", "1059", b"b 29")]
+    names = store.list_filtered_chunks(keyhash_filter=[coll._compute_keyhash("https://example.com/a")])
+    assert len(datadiff._select_chunks_at(names, "1013")) < len(names)
+
+def test_collections_share_chunk_cache(tmp_path):
+    import chunkcache
+    cache = chunkcache.ChunkCache()
+    store = datadiff.storage.LocalFileStorage(str(tmp_path))
+    coll = datadiff.Collection(store, chunk_cache=cache)
+    key = "https://example.com/"
+    for i in range(10):
+        coll.update_data(key, "content {}".format(i).encode("utf-8"), str(1000 + i))
+        if i % 5 == 4:
+            coll.sync_and_flush_one()
+    kh = coll._compute_keyhash(key)
+    first = datadiff.Collection(store, full_history=True, chunk_cache=cache)[kh]
+    misses = cache.stats()["misses"]
+    second = datadiff.Collection(store, full_history=True, chunk_cache=cache)[kh]
+    assert cache.stats()["misses"] == misses
+    assert cache.stats()["hits"] > 0
+    assert [inc.data for inc in first.incarnations()] == [inc.data for inc in second.incarnations()]
+    names = store.list_chunks()
+    store.delete_chunk(names[0])
+    assert not any(k[1] == names[0] for k in cache._entries)
+
+def test_diff_against_most_similar_recent_version():
+    def page(prefix, changed):
+        lines = [prefix + b" line %d" % i for i in range(2000)]
+        lines[changed] = b"changed"
+        return b"\n".join(lines)
+    store = datadiff.storage.InMemoryStorage()
+    coll = datadiff.Collection(store, flush_settings={"baseline_candidates": 4})
+    key = "https://example.com/"
+    versions = []
+    for i in range(8):
+        ver = str(1000 + i)
+        versions.append(ver)
+        coll.update_data(key, page(b"AB"[i % 2:i % 2 + 1], i), ver)
+        coll.sync_and_flush_one()
+    baselines = {}
+    for data in store._data.values():
+        for rec in json.loads(data.decode("utf-8"))["datawatch"]["content"]:
+            baselines[rec["metadata"]["version"]] = rec["content"].get("baseline_version")
+    # Alternating pages diff against the version before the previous one.
+    for i in range(2, 8):
+        assert baselines[versions[i]] == versions[i - 2]
+    entry = datadiff.Collection(store, full_history=True, chunk_cache=None)[coll._compute_keyhash(key)]
+    assert [inc.data for inc in entry.incarnations()] == [page(b"AB"[i % 2:i % 2 + 1], i) for i in range(8)]
+    entry = datadiff.Collection(store, chunk_cache=None)[coll._compute_keyhash(key)]
+    assert entry.read_data_bytes_at(versions[-1]) == page(b"B", 7)
+
+def test_large_content_uses_content_defined_chunks():
+    import random
+    rng = random.Random(2)
+    big = bytes(rng.randrange(256) for _ in range(datadiff.CDC_MIN_SIZE + 100000))
+    edited = big[:500000] + b"inserted" + big[500000:-1000]
+    store = datadiff.storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    coll.update_data("https://example.com/", big, "1000")
+    coll.update_data("https://example.com/", edited, "1001")
+    coll.checkpoint_all()
+    [data] = store._data.values()
+    records = json.loads(data.decode("utf-8"))["datawatch"]["content"]
+    assert "cdc" in records[1]["content"]
+    assert len(data) < len(big) * 1.5
+    entry = datadiff.Collection(store, full_history=True, chunk_cache=None)[coll._compute_keyhash("https://example.com/")]
+    assert [inc.data for inc in entry.incarnations()] == [big, edited]
+    # Decoding slices by the recorded lengths, so only the full version
+    # at the start of the chain is chunked.
+    calls = []
+    def split_content(data):
+        calls.append(len(data))
+        return split(data)
+    split = datadiff.methods.split_content
+    datadiff.methods.split_content = split_content
+    try:
+        entry = datadiff.Collection(store, full_history=True, chunk_cache=None)[coll._compute_keyhash("https://example.com/")]
+        assert [inc.data for inc in entry.incarnations()] == [big, edited]
+        assert list(entry.incarnations())[1].chunk_map == datadiff.DataIncarnation(edited, "1001").chunk_map
+    finally:
+        datadiff.methods.split_content = split
+    assert calls == [len(big), len(edited)]
+
+def test_verify_with_recorded_hash_method():
+    import methods
+    store = datadiff.storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    key = "https://example.com/"
+    coll.update_data(key, b"one", "1000")
+    coll.checkpoint_all()
+    methods.set_content_hash_method("blake2b-hex")
+    try:
+        coll.update_data(key, b"one", "1001")
+        coll.update_data(key, b"two", "1002")
+        coll.checkpoint_all()
+    finally:
+        methods.set_content_hash_method("sha256-hex")
+    entry = datadiff.Collection(store, full_history=True, chunk_cache=None)[coll._compute_keyhash(key)]
+    incs = list(entry.incarnations())
+    assert [inc.content_hash["method"] for inc in incs] == ["sha256-hex", "blake2b-hex", "blake2b-hex"]
+    assert incs[1].same_data_as(incs[0])
+    assert [inc.data for inc in incs] == [b"one", b"one", b"two"]
+
+def test_verify_levels():
+    store = datadiff.storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    key = "https://example.com/"
+    for i in range(3):
+        coll.update_data(key, "content {}".format(i).encode("utf-8"), str(1000 + i))
+    coll.checkpoint_all()
+    [(name, data)] = store._data.items()
+    doc = json.loads(data.decode("utf-8"))
+    doc["datawatch"]["content"][0]["metadata"]["content_hash"]["digest"] = "0" * 64
+    store._data[name] = json.dumps(doc).encode("utf-8")
+    kh = coll._compute_keyhash(key)
+    def load(verify):
+        return datadiff.Entry.load_dumps(store, [name], full_history=True, chunk_cache=None, verify=verify)
+    with pytest.raises(ValueError):
+        load("full")
+    assert load("final").current_version == "1002"
+    assert load("none").current_version == "1002"
+    with pytest.raises(ValueError):
+        load("paranoid")
+
+def test_versions_between():
+    entry = Entry.create_initial("https://example.com/", b"v0", "1000")
+    for i in range(1, 200):
+        entry.update_data(io.BytesIO("v{}".format(i // 3).encode("utf-8")), str(1000 + 10 * i))
+    assert entry.read_data_bytes_at("1000") == b"v0"
+    assert entry.read_data_bytes_at("1015") == b"v0"
+    assert entry.read_data_bytes_at("1030") == b"v1"
+    assert entry.read_data_bytes_at("2990") == b"v66"
+    assert [inc.data_version for inc in entry.versions_between("1015", "1040")] == ["1020", "1030", "1040"]
+    assert [inc.data_version for inc in entry.versions_between(max_version="1010")] == ["1000", "1010"]
+    assert [inc.data_version for inc in entry.versions_between(min_version="2980")] == ["2980", "2990"]
+    assert list(entry.versions_between("1011", "1019")) == []
+    entry.flush()
+    assert entry.loaded_versions() == ["2990"]
+    entry.update_unchanged("3000")
+    assert [inc.data_version for inc in entry.versions_between("2995")] == ["3000"]
+
+def test_load_version_range():
+    store = datadiff.storage.InMemoryStorage()
+    coll = datadiff.Collection(store, full_history=True)
+    key = "https://example.com/"
+    for i in range(20):
+        coll.update_data(key, "content {}".format(i).encode("utf-8"), str(1000 + 10 * i))
+    coll.sync_and_flush_one()
+    names = list(store.list_chunks())
+    assert len(names) == 1
+    entry = Entry.load_dumps(store, names, full_history=True, chunk_cache=None, min_version="1055", max_version="1080")
+    assert entry.loaded_versions() == ["1050", "1060", "1070", "1080"]
+    assert entry.read_data_bytes_at("1055") == b"content 5"
+    with pytest.raises(ValueError):
+        Entry.load_dumps(store, names, only_from_last_checkpoint=True, chunk_cache=None, min_version="1055")
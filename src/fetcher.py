@@ -1,20 +1,50 @@
 import scheduling
+import methods
 import requests
-import bs4
-import uritools
+import links
 import collections
+import time
+
+_READ_CHUNK_SIZE = 64 * 1024
+
+# Fetched bodies are held in memory (as are the versions stored from them),
+# so there must be some limit.
+DEFAULT_MAX_BODY_SIZE = 64 * 1024 * 1024
+
+class ResponseTooLarge(RuntimeError):
+    pass
+
+def read_body(resp, max_body_size=DEFAULT_MAX_BODY_SIZE):
+    declared = resp.headers.get("Content-Length")
+    if max_body_size is not None and declared and declared.isdigit() and int(declared) > max_body_size:
+        resp.close()
+        raise ResponseTooLarge("declared body size {} of {} exceeds limit {}".format(declared, resp.url, max_body_size))
+    hasher = methods.content_hash_stream()
+    n = 0
+    chunks = []
+    for chunk in resp.iter_content(chunk_size=_READ_CHUNK_SIZE):
+        n += len(chunk)
+        if max_body_size is not None and n > max_body_size:
+            resp.close()
+            raise ResponseTooLarge("body of {} exceeds limit {}".format(resp.url, max_body_size))
+        hasher.update(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks), hasher.result()
 
 class FetcherLoop(object):
-    def __init__(self, on_fetched, user_agent, target_link_filter, fetching_ratelimit=0.2, discovery_delay=300, fetch_delay=60, verbose=False, exponential_backoff=None):
+    def __init__(self, on_fetched, user_agent, target_link_filter, fetching_ratelimit=0.2, discovery_delay=300, fetch_delay=60, verbose=False, exponential_backoff=None, max_body_size=DEFAULT_MAX_BODY_SIZE, revisit_policy=None, normalizer=None, store_raw=False, target_sink=None):
         self._loop = scheduling.SchedulingLoop(global_ratelimit=fetching_ratelimit, verbose=verbose)
         self._targets_by_root = collections.defaultdict(set)
+        self._target_refcounts = collections.Counter()
+        self._target_task_ids = {}
+        self._discovery_digests = {}
         self._discovery_delay = discovery_delay
         self._fetch_delay = fetch_delay
         session = requests.session()
         headers = {"User-Agent": user_agent}
         timeout = 60
         def geturl(url, allow_failure=False):
-            resp = session.get(url, headers=headers, timeout=timeout)
+            resp = session.get(url, headers=headers, timeout=timeout, stream=True)
             # TODO: on receiving Last-Modified, cache responses and send If-Modified-Since in headers
             print("getting url", url, "got it:", resp)
             if not allow_failure:
@@ -25,27 +55,67 @@ class FetcherLoop(object):
         self._geturl = geturl
         self._target_link_filter = target_link_filter
         self._exponential_backoff = exponential_backoff
+        self._revisit_policy = revisit_policy
+        self._normalizer = normalizer
+        self._store_raw = store_raw
+        self._target_sink = target_sink
+        self._max_body_size = max_body_size
 
     def _has_target(self, target):
-        for k, targetset in self._targets_by_root.items():
-            if target in targetset:
-                return True
-        return False
+        return target in self._target_refcounts
+
+    def _retain_target(self, target):
+        self._target_refcounts[target] += 1
+        if self._target_refcounts[target] == 1:
+            self._add_target(target)
+
+    def _release_target(self, target):
+        self._target_refcounts[target] -= 1
+        if self._target_refcounts[target] > 0:
+            return
+        del self._target_refcounts[target]
+        task_id = self._target_task_ids.pop(target, None)
+        if task_id is not None:
+            print("dropping target", target)
+            self._loop.cancel_task(task_id)
+        if self._revisit_policy is not None:
+            self._revisit_policy.remove(target)
+
+    def set_targets_for_root(self, root, targets):
+        old = self._targets_by_root[root]
+        new = set(targets)
+        self._targets_by_root[root] = new
+        for target in new - old:
+            self._retain_target(target)
+        for target in old - new:
+            self._release_target(target)
+
+    def _read_body(self, resp):
+        return read_body(resp, max_body_size=self._max_body_size)
+
+    def _normalize(self, url, content, content_hash):
+        if self._normalizer is None:
+            return content, content_hash
+        normalized = self._normalizer.normalize(url, content)
+        if normalized is content:
+            return content, content_hash
+        return normalized, methods.compute_content_hash(normalized)
 
     def _discovery_extract_links(self, data, content_type, discovery_url):
-        soup = bs4.BeautifulSoup(data, features="html.parser")
-        links = [el.attrs["href"] for el in soup.find_all("a") if "href" in el.attrs]
-        links = [uritools.urijoin(discovery_url, link) for link in links]
-        rv = list(set([link for link in links if self._target_link_filter(link)]))
+        found = links.extract_links(data, discovery_url, content_type=content_type)
+        rv = list(set([link for link in found if self._target_link_filter(link)]))
         return rv
 
     def _add_target(self, url):
         delay = scheduling.as_delay(self._fetch_delay)
         def should_reschedule():
             return self._has_target(url)
-        last_content = [None]
+        last_digest = [None]
+        last_fetched = [None]
         consecutive_nochange = [0]
         def compute_reschedule_delay():
+            if self._revisit_policy is not None:
+                return self._revisit_policy.delay_for(url)
             n = consecutive_nochange[0]
             if self._exponential_backoff is None or n == 0:
                 return delay()
@@ -55,34 +125,56 @@ class FetcherLoop(object):
             return multiplier * delay()
         def run_fetch(task):
             url = task.payload
+            fetch_time = time.time()
             resp = self._geturl(url, allow_failure=True)
-            content = resp.content
-            changed = last_content[0] != content
+            try:
+                content, content_hash = self._read_body(resp)
+            except ResponseTooLarge as e:
+                print("skipping", url, "-", e)
+                return
+            normalized, normalized_hash = self._normalize(url, content, content_hash)
+            if not self._store_raw:
+                content, content_hash = normalized, normalized_hash
+            changed = last_digest[0] != normalized_hash["digest"]
             if not changed:
                 consecutive_nochange[0] += 1
             else:
                 consecutive_nochange[0] = 0
             print(url, "has changed?", changed, "nochange counter now at", consecutive_nochange[0])
-            last_content[0] = content
-            self._on_fetched(url, resp, content)
+            if self._revisit_policy is not None and last_fetched[0] is not None:
+                self._revisit_policy.observe(url, changed, fetch_time - last_fetched[0])
+            last_digest[0] = normalized_hash["digest"]
+            last_fetched[0] = fetch_time
+            self._on_fetched(url, resp, content, content_hash, changed)
         print("adding new target for", url)
-        self._loop.schedule_task(
+        if self._revisit_policy is not None:
+            self._revisit_policy.add(url)
+        task = self._loop.schedule_task(
             callback=run_fetch,
             payload=url,
             delay=self._fetch_delay,
             reschedule_if=should_reschedule,
             reschedule_delay=compute_reschedule_delay,
         )
+        self._target_task_ids[url] = task.task_id
 
     def _run_discovery(self, task):
         discovery_root_url = task.payload
         resp = self._geturl(discovery_root_url)
-        ctype = resp.headers["Content-Type"]
-        discovered = self._discovery_extract_links(resp.content, resp.headers["Content-Type"], discovery_root_url)
-        newly = [x for x in discovered if not self._has_target(x)]
-        self._targets_by_root[discovery_root_url] = set(discovered)
-        for new_target_url in newly:
-            self._add_target(new_target_url)
+        ctype = resp.headers.get("Content-Type")
+        try:
+            content, content_hash = self._read_body(resp)
+        except ResponseTooLarge as e:
+            print("keeping previous targets for", discovery_root_url, "-", e)
+            return
+        if self._discovery_digests.get(discovery_root_url) == content_hash["digest"]:
+            return
+        self._discovery_digests[discovery_root_url] = content_hash["digest"]
+        discovered = self._discovery_extract_links(content, ctype, discovery_root_url)
+        if self._target_sink is not None:
+            self._target_sink(discovery_root_url, discovered)
+        else:
+            self.set_targets_for_root(discovery_root_url, discovered)
 
     def schedule_nonfetching_task(self, **kwargs):
         self._loop.schedule_task(**kwargs, apply_global_ratelimit=False)
@@ -102,7 +194,7 @@ class FetcherLoop(object):
 if __name__ == "__main__":
     user_agent = "Fetcherbot"
     target_link_filter = lambda url: url.startswith("https://docs.python.org/3/library/") and url.endswith(".html") and "cookiejar" in url
-    def on_fetched(url, resp, content):
+    def on_fetched(url, resp, content, content_hash, changed):
         print("response from", url, "was", resp, "with", len(content), "bytes of content")
         print("headers were", resp.headers)
     def do_something_else(task):
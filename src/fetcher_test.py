@@ -0,0 +1,34 @@
+from .fetcher import *
+
+import pytest
+
+class _FakeResponse(object):
+    def __init__(self, body, headers=None):
+        self._body = body
+        self.headers = headers or {}
+        self.url = "https://example.com/"
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self._body), chunk_size):
+            yield self._body[i:i+chunk_size]
+
+    def close(self):
+        self.closed = True
+
+def test_read_body_hashes_while_reading():
+    body = b"x" * 300000
+    content, content_hash = read_body(_FakeResponse(body))
+    assert content == body
+    assert content_hash == methods.compute_content_hash(body)
+
+def test_read_body_size_limit():
+    resp = _FakeResponse(b"x" * 300000)
+    with pytest.raises(ResponseTooLarge):
+        read_body(resp, max_body_size=100000)
+    assert resp.closed
+    resp = _FakeResponse(b"x", headers={"Content-Length": "300000"})
+    with pytest.raises(ResponseTooLarge):
+        read_body(resp, max_body_size=100000)
+    content, _ = read_body(_FakeResponse(b"x" * 100000), max_body_size=100000)
+    assert len(content) == 100000
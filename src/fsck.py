@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import click
+import collections
+import concurrent.futures
+import multiprocessing
+import sys
+
+import blobs
+import datadiff
+import filenames
+import storage
+
+def check_chains(names):
+    # Every dependent chunk must find the version it depends on in some
+    # chunk of the same key.
+    fnis = [(name, filenames.decode_filename(name)) for name in names]
+    last_versions = set(fni.last_version for _, fni in fnis)
+    problems = []
+    for name, fni in fnis:
+        dep = fni.depends_on_version
+        if dep is None or dep in last_versions:
+            continue
+        if not any(int(other.first_version) <= int(dep) <= int(other.last_version) for _, other in fnis):
+            problems.append("broken chain: {} depends on version {}, which no chunk contains".format(name, dep))
+    return problems
+
+def check_keyhash(store, keyhash, blob_store=None):
+    names = store.list_filtered_chunks(keyhash_filter=[keyhash])
+    problems = check_chains(names)
+    if problems:
+        return problems
+    try:
+        datadiff.Entry.load_dumps(store, names, full_history=True, chunk_cache=None, blobs=blob_store, verify="full")
+    except Exception as e:
+        problems.append("{}: {}".format(type(e).__name__, e))
+    return problems
+
+_worker_state = {}
+
+def _init_worker(data_dir, blob_dir):
+    _worker_state["store"] = storage.open_storage(data_dir)
+    _worker_state["blobs"] = blobs.open_blob_store(blob_dir)
+
+def _check_in_worker(keyhash):
+    return keyhash, check_keyhash(_worker_state["store"], keyhash, blob_store=_worker_state["blobs"])
+
+def check_store(data_dir, blob_dir=None, workers=None):
+    # Yields (keyhash, problems) for every key. Stores that only one process
+    # may open are checked with threads instead of processes.
+    store = storage.open_storage(data_dir)
+    try:
+        keyhashes = sorted(set(filenames.decode_filename(name).keyhash for name in store.list_chunks()))
+        if storage.is_single_process_store(data_dir):
+            blob_store = blobs.open_blob_store(blob_dir)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for kh, problems in zip(keyhashes, executor.map(lambda kh: check_keyhash(store, kh, blob_store=blob_store), keyhashes)):
+                    yield kh, problems
+            return
+    finally:
+        store.close()
+    with multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(data_dir, blob_dir)) as pool:
+        for kh, problems in pool.imap(_check_in_worker, keyhashes, chunksize=16):
+            yield kh, problems
+
+@click.command()
+@click.option("--data-dir", required=True,
+              help="Directory containing datawatch data.")
+@click.option("--blob-dir", default=None,
+              help="Directory containing shared blobs, if the data uses them.")
+@click.option("--workers", default=None, type=int,
+              help="Number of parallel checkers; defaults to the number of CPUs.")
+@click.option("--verbose/--no-verbose",
+              default=False, show_default=True, type=bool,
+              help="Also list keys without problems.")
+def main(data_dir, blob_dir, workers, verbose):
+    counts = collections.Counter()
+    for kh, problems in check_store(data_dir, blob_dir=blob_dir, workers=workers):
+        counts["keys"] += 1
+        if not problems:
+            if verbose:
+                print("OK", kh)
+            continue
+        counts["broken"] += 1
+        for problem in problems:
+            print("BROKEN", kh, problem)
+    print("Checked {} keys; {} broken.".format(counts["keys"], counts["broken"]))
+    if counts["broken"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
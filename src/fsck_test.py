@@ -0,0 +1,38 @@
+from .fsck import *
+
+import datadiff
+import json
+import os
+import storage
+
+def _make_store(path):
+    store = storage.LocalFileStorage(path)
+    coll = datadiff.Collection(store)
+    for key in ("https://example.com/a", "https://example.com/b"):
+        for i in range(6):
+            coll.update_data(key, "{} {}".format(key, i // 2).encode("utf-8"), str(1000 + i))
+            coll.sync_and_flush_one()
+    return store, coll
+
+def test_check_store(tmp_path):
+    store, coll = _make_store(str(tmp_path))
+    results = dict(check_store(str(tmp_path), workers=2))
+    assert results == {coll._compute_keyhash("https://example.com/a"): [], coll._compute_keyhash("https://example.com/b"): []}
+    kh = coll._compute_keyhash("https://example.com/a")
+    names = sorted(store.list_filtered_chunks(keyhash_filter=[kh]))
+    path = os.path.join(str(tmp_path), names[-1])
+    with open(path) as f:
+        doc = json.load(f)
+    doc["datawatch"]["content"][-1]["metadata"]["content_hash"]["digest"] = "0" * 64
+    os.remove(path)
+    with open(path, "w") as f:
+        json.dump(doc, f)
+    results = dict(check_store(str(tmp_path), workers=2))
+    assert len(results[kh]) == 1
+    assert results[kh][0].startswith("ValueError")
+    assert "hash check" in results[kh][0]
+    # Chunks overlap by one version, so removing two breaks the chain.
+    os.remove(os.path.join(str(tmp_path), names[1]))
+    os.remove(os.path.join(str(tmp_path), names[2]))
+    results = dict(check_store(str(tmp_path), workers=2))
+    assert [p.split(":")[0] for p in results[kh]] == ["broken chain"]
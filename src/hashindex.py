@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import click
+
+import datadiff
+import filenames
+import storage
+
+# Maps content hashes to the (keyhash, version) pairs that had that content.
+# Entries are only ever added, so versions later dropped from the store
+# (e.g. by retention) stay listed until the index is rebuilt.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    method TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    keyhash TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (digest, method, keyhash, version)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS keys (
+    keyhash TEXT PRIMARY KEY,
+    key TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+class ContentHashIndex(storage.BatchedSqlite):
+    def __init__(self, path, batch_size=1000, max_batch_delay=5.0):
+        super().__init__(path, _SCHEMA, batch_size, max_batch_delay=max_batch_delay)
+
+    def __repr__(self):
+        return "ContentHashIndex({})".format(repr(self._path))
+
+    def add_versions(self, key, keyhash, versions):
+        # versions are (version, content_hash) pairs; adding a pair again
+        # is a no-op, since consecutive chunks may overlap.
+        rows = [(content_hash["method"], content_hash["digest"], keyhash, int(version)) for version, content_hash in versions]
+        with self._lock:
+            self._begin_if_needed()
+            self._conn.execute("INSERT OR IGNORE INTO keys (keyhash, key) VALUES (?, ?)", (keyhash, key))
+            self._conn.executemany("INSERT OR IGNORE INTO versions (method, digest, keyhash, version) VALUES (?, ?, ?, ?)", rows)
+            self._maybe_commit(len(rows))
+
+    def add_entry(self, entry):
+        self.add_versions(entry.key, entry.keyhash, [(inc.data_version, inc.content_hash) for inc in entry.incarnations()])
+
+    def add_chunk(self, store, name):
+        # Only the record metadata is needed; no content is reconstructed.
+        (header, records), _ = datadiff.Entry._read_dump_file(lambda: store.read_chunk_buffer(name))
+        key = header["key"]
+        versions = [(rec["metadata"]["version"], rec["metadata"]["content_hash"]) for rec in records]
+        self.add_versions(key, filenames.decode_filename(name).keyhash, versions)
+
+    def clear(self):
+        with self._lock:
+            self._begin_if_needed()
+            self._conn.execute("DELETE FROM versions")
+            self._conn.execute("DELETE FROM keys")
+            self.commit()
+
+    def rebuild(self, store):
+        self.clear()
+        n = 0
+        for name in store.list_chunks():
+            self.add_chunk(store, name)
+            n += 1
+        self.commit()
+        return n
+
+    def lookup(self, digest, method=None, limit=None):
+        # (key, keyhash, version) for every version with this content,
+        # oldest first.
+        query = "SELECT keys.key, versions.keyhash, versions.version FROM versions JOIN keys USING (keyhash) WHERE digest = ?"
+        args = [digest]
+        if method is not None:
+            query += " AND method = ?"
+            args.append(method)
+        query += " ORDER BY version, keyhash"
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, args).fetchall()
+        return [(key, keyhash, str(version)) for key, keyhash, version in rows]
+
+    def first_seen(self, digest, method=None):
+        rows = self.lookup(digest, method=method, limit=1)
+        if not rows:
+            return None
+        return rows[0]
+
+    def keyhashes_with(self, digest, method=None, exclude_keyhash=None):
+        # The keys that ever had this content, e.g. to detect content
+        # duplicated across keys.
+        query = "SELECT DISTINCT keyhash FROM versions WHERE digest = ?"
+        args = [digest]
+        if method is not None:
+            query += " AND method = ?"
+            args.append(method)
+        if exclude_keyhash is not None:
+            query += " AND keyhash != ?"
+            args.append(exclude_keyhash)
+        with self._lock:
+            return sorted(kh for (kh,) in self._conn.execute(query, args))
+
+def open_hash_index(path):
+    if path is None:
+        return None
+    return ContentHashIndex(path)
+
+@click.command()
+@click.option("--index", required=True,
+              help="Content hash index file.")
+@click.option("--data-dir", default=None,
+              help="Directory containing datawatch data; required with --rebuild.")
+@click.option("--rebuild/--no-rebuild",
+              default=False, show_default=True, type=bool,
+              help="Rebuild the index from a scan of --data-dir before looking anything up.")
+@click.option("--method", default=None,
+              help="Only match content hashes computed with this method.")
+@click.option("--first/--no-first",
+              default=False, show_default=True, type=bool,
+              help="Only show the first version that had each content.")
+@click.argument("digests", nargs=-1)
+def main(index, data_dir, rebuild, method, first, digests):
+    idx = ContentHashIndex(index)
+    try:
+        if rebuild:
+            if not data_dir:
+                raise click.UsageError("--rebuild requires --data-dir")
+            store = storage.open_storage(data_dir)
+            try:
+                print("Indexed {} chunks.".format(idx.rebuild(store)))
+            finally:
+                store.close()
+        for digest in digests:
+            rows = idx.lookup(digest, method=method, limit=1 if first else None)
+            for key, keyhash, version in rows:
+                print("\t".join((digest, version, keyhash, key)))
+    finally:
+        idx.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+from .hashindex import *
+
+import datadiff
+import methods
+import storage
+
+def _digest(data):
+    return methods.compute_content_hash(data)["digest"]
+
+def test_index_as_collection_writes(tmp_path):
+    store = storage.InMemoryStorage()
+    idx = ContentHashIndex(str(tmp_path / "hashes.sqlite"))
+    coll = datadiff.Collection(store, indexes=[idx])
+    for i in range(10):
+        coll.update_data("https://example.com/a", "a {}".format(i // 2).encode("utf-8"), str(1000 + i))
+        if i >= 5:
+            coll.update_data("https://example.com/b", b"a 1", str(1000 + i))
+        if i % 3 == 2:
+            coll.sync_and_flush_one()
+            coll.sync_and_flush_one()
+    coll.sync_and_flush_one()
+    coll.sync_and_flush_one()
+    kha = coll._compute_keyhash("https://example.com/a")
+    khb = coll._compute_keyhash("https://example.com/b")
+    assert idx.lookup(_digest(b"a 1")) == [("https://example.com/a", kha, "1002"), ("https://example.com/a", kha, "1003")] + [("https://example.com/b", khb, str(1000 + i)) for i in range(5, 10)]
+    assert idx.first_seen(_digest(b"a 4")) == ("https://example.com/a", kha, "1008")
+    assert idx.first_seen(_digest(b"nothing")) is None
+    assert idx.keyhashes_with(_digest(b"a 1"), exclude_keyhash=kha) == [khb]
+    assert idx.keyhashes_with(_digest(b"a 0"), exclude_keyhash=kha) == []
+    indexed = idx.lookup(_digest(b"a 1"))
+    assert idx.rebuild(store) == len(list(store.list_chunks()))
+    assert idx.lookup(_digest(b"a 1")) == indexed
+    idx.close()
+
+def test_lookup_by_method(tmp_path):
+    idx = ContentHashIndex(str(tmp_path / "hashes.sqlite"))
+    idx.add_versions("k", "kh", [("100", {"method": "one", "digest": "abcd"}), ("200", {"method": "two", "digest": "abcd"})])
+    assert [v for _, _, v in idx.lookup("abcd")] == ["100", "200"]
+    assert [v for _, _, v in idx.lookup("abcd", method="two")] == ["200"]
+    idx.close()
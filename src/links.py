@@ -0,0 +1,72 @@
+import codecs
+import html.parser
+import re
+import uritools
+
+class _HrefCollector(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.hrefs = []
+        self.base = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            for name, value in attrs:
+                if name == "href":
+                    self.hrefs.append(value or "")
+                    break
+        elif tag == "base" and self.base is None:
+            for name, value in attrs:
+                if name == "href" and value:
+                    self.base = value
+                    break
+
+_BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+_CONTENT_TYPE_CHARSET = re.compile(r"""charset\s*=\s*["']?([-\w.:]+)""", re.IGNORECASE)
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([-\w.:]+)""", re.IGNORECASE)
+# Browsers only look for a <meta> charset this far into the document.
+_META_PRESCAN_SIZE = 1024
+
+def _known_encoding(name):
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+def sniff_encoding(data, content_type=None):
+    # As browsers do: a byte order mark wins, then the charset of the
+    # Content-Type header, then a <meta> charset, else UTF-8.
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            return encoding
+    if content_type:
+        m = _CONTENT_TYPE_CHARSET.search(content_type)
+        if m and _known_encoding(m.group(1)):
+            return _known_encoding(m.group(1))
+    m = _META_CHARSET.search(data[:_META_PRESCAN_SIZE])
+    if m and _known_encoding(m.group(1).decode("ascii")):
+        return _known_encoding(m.group(1).decode("ascii"))
+    return "utf-8"
+
+def _decode(data, content_type=None):
+    if isinstance(data, str):
+        return data
+    return data.decode(sniff_encoding(data, content_type), errors="replace")
+
+def extract_hrefs(data, content_type=None):
+    collector = _HrefCollector()
+    collector.feed(_decode(data, content_type))
+    collector.close()
+    return collector.base, collector.hrefs
+
+def extract_links(data, url, content_type=None):
+    base, hrefs = extract_hrefs(data, content_type)
+    if base:
+        url = uritools.urijoin(url, base)
+    return [uritools.urijoin(url, href) for href in hrefs]
+
+def extract_links_bs4(data, url):
+    import bs4
+    soup = bs4.BeautifulSoup(data, features="html.parser")
+    links = [el.attrs["href"] for el in soup.find_all("a") if "href" in el.attrs]
+    return [uritools.urijoin(url, link) for link in links]
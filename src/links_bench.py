@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import click
+import os
+import time
+
+import links
+
+def _collect_pages(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dp, dn, fn in os.walk(path):
+                for f in sorted(fn):
+                    if f.endswith((".html", ".htm")):
+                        yield os.path.join(dp, f)
+        else:
+            yield path
+
+def _time_extractor(extract, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for url, data in pages:
+            extract(data, url)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+@click.command()
+@click.option("--repeat", default=3, show_default=True,
+              help="Number of timing rounds; the best round is reported.")
+@click.option("--min-size", default=0, show_default=True,
+              help="Skip pages smaller than this many bytes.")
+@click.argument("paths", nargs=-1, required=True)
+def main(repeat, min_size, paths):
+    pages = []
+    for path in _collect_pages(paths):
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) >= min_size:
+            pages.append(("file://" + os.path.abspath(path), data))
+    if not pages:
+        raise click.UsageError("no pages found")
+    total_bytes = sum(len(data) for _, data in pages)
+    mismatches = 0
+    for url, data in pages:
+        if set(links.extract_links(data, url)) != set(links.extract_links_bs4(data, url)):
+            mismatches += 1
+    fast = _time_extractor(links.extract_links, pages, repeat)
+    slow = _time_extractor(links.extract_links_bs4, pages, repeat)
+    print("pages:", len(pages), "bytes:", total_bytes)
+    print("pages with differing link sets:", mismatches)
+    for name, elapsed in (("bs4", slow), ("htmlparser", fast)):
+        print("{}: {:.3f}s ({:.1f} MB/s)".format(name, elapsed, total_bytes / elapsed / 1e6))
+    print("speedup: {:.2f}x".format(slow / fast))
+
+if __name__ == "__main__":
+    main()
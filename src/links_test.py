@@ -0,0 +1,42 @@
+from .links import *
+
+import codecs
+
+_PAGE = b"""<!DOCTYPE html>
+<html><head><title>index</title></head>
+<body>
+<p><a href="foo.html">foo</a> and <a class="x" href='/bar.html?a=1&amp;b=2'>bar</a>
+<a name="anchor">no href</a>
+<A HREF="https://other.example.com/baz">baz</A>
+<img src="ignored.png"/>
+</body></html>
+"""
+
+def test_extract_links():
+    links = extract_links(_PAGE, "https://example.com/docs/index.html")
+    assert links == [
+        "https://example.com/docs/foo.html",
+        "https://example.com/bar.html?a=1&b=2",
+        "https://other.example.com/baz",
+    ]
+
+def test_extract_links_honours_base():
+    page = b'<a href="early.html">x</a><base href="/other/"><a href="late.html">y</a>'
+    links = extract_links(page, "https://example.com/docs/index.html")
+    assert links == [
+        "https://example.com/other/early.html",
+        "https://example.com/other/late.html",
+    ]
+
+def test_extract_links_honours_charset():
+    url = "https://example.com/"
+    page = '<a href="caf\u00e9.html">x</a>'.encode("latin-1")
+    assert extract_links(page, url, content_type="text/html; charset=ISO-8859-1") == ["https://example.com/caf\u00e9.html"]
+    meta = b'<meta charset="windows-1252">' + page
+    assert extract_links(meta, url) == ["https://example.com/caf\u00e9.html"]
+    assert extract_links(codecs.BOM_UTF8 + page.decode("latin-1").encode("utf-8"), url, content_type="text/html; charset=ISO-8859-1") == ["https://example.com/caf\u00e9.html"]
+    assert sniff_encoding(page, "text/html; charset=bogus") == "utf-8"
+
+def test_matches_bs4():
+    url = "https://example.com/docs/index.html"
+    assert extract_links(_PAGE, url) == extract_links_bs4(_PAGE, url)
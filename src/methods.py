@@ -39,18 +39,60 @@ class _KeyEncoding(object):
         uncompressed = zlib.decompress(compressed)
         return uncompressed.decode("utf-8")
 
+class _HashStream(object):
+    def __init__(self, method, m):
+        self._method = method
+        self._m = m
+
+    def update(self, data):
+        self._m.update(data)
+
+    def result(self):
+        return {
+          "method": self._method,
+          "digest": self._m.hexdigest(),
+        }
+
+class _XXHashAdapter(object):
+    def __init__(self, m):
+        self._m = m
+
+    def update(self, data):
+        self._m.update(data)
+
+    def hexdigest(self):
+        return self._m.hexdigest()
+
+def _xxh3_64():
+    # Optional dependency, only needed when the method is selected or found
+    # in stored data.
+    try:
+        import xxhash
+    except ImportError:
+        raise ValueError("content hash method xxh3-64-hex requires the xxhash package")
+    return _XXHashAdapter(xxhash.xxh3_64())
+
 class _Hasher(object):
+    def __init__(self, hash_method="sha256-hex", factory=hashlib.sha256, collision_resistant=True):
+        self._hash_method = hash_method
+        self._factory = factory
+        self._collision_resistant = collision_resistant
+
     @property
     def hash_method(self):
-        return "sha256-hex"
+        return self._hash_method
+
+    @property
+    def collision_resistant(self):
+        return self._collision_resistant
+
+    def hash_stream(self):
+        return _HashStream(self.hash_method, self._factory())
 
     def hash_bytes(self, data):
-        m = hashlib.sha256()
+        m = self.hash_stream()
         m.update(data)
-        return {
-          "method": self.hash_method,
-          "digest": m.hexdigest(),
-        }
+        return m.result()
 
 class _Differ(object):
     @property
@@ -64,8 +106,56 @@ class _Differ(object):
         p = zlib.decompress(patch)
         return bsdiff4.patch(a, p)
 
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big") for i in range(256)]
+_MASK64 = (1 << 64) - 1
+
+class _ContentChunker(object):
+    # Content-defined chunking with a gear rolling hash: a chunk ends where
+    # the top bits of the hash are zero, so boundaries move with the
+    # content rather than with byte offsets.
+    def __init__(self, min_size=2048, avg_bits=13, max_size=65536):
+        self._min_size = min_size
+        self._avg_bits = avg_bits
+        self._max_size = max_size
+        self._mask = ((1 << avg_bits) - 1) << (64 - avg_bits)
+
+    @property
+    def chunking_method(self):
+        return "gear-cdc-{}-{}-{} . blake2b-128".format(self._min_size, 1 << self._avg_bits, self._max_size)
+
+    def chunk_digest(self, chunk):
+        return hashlib.blake2b(chunk, digest_size=16).hexdigest()
+
+    def split(self, data):
+        gear, mask, mask64 = _GEAR, self._mask, _MASK64
+        n = len(data)
+        start = 0
+        while start < n:
+            end = min(n, start + self._max_size)
+            pos = start + self._min_size
+            h = 0
+            while pos < end:
+                h = ((h << 1) + gear[data[pos]]) & mask64
+                pos += 1
+                if not h & mask:
+                    end = pos
+                    break
+            yield data[start:end]
+            start = end
+
 DEFAULT_DIFFER = _Differ()
+DEFAULT_CHUNKER = _ContentChunker()
 DEFAULT_HASHER = _Hasher()
+
+CONTENT_HASHERS = {
+    "sha256-hex": DEFAULT_HASHER,
+    "blake2b-hex": _Hasher("blake2b-hex", hashlib.blake2b),
+    "xxh3-64-hex": _Hasher("xxh3-64-hex", _xxh3_64, collision_resistant=False),
+}
+
+# Key hashes name files and shards and always use DEFAULT_HASHER; content
+# hashes are recorded with their method, so this can be changed.
+_content_hasher = DEFAULT_HASHER
 DEFAULT_KEY_ENCODING = _KeyEncoding()
 DEFAULT_SHARDER = _VersionSharder()
 
@@ -80,15 +170,43 @@ ENCODED_KEY_LENGTH_LIMIT = 256
 
 _CACHE_SIZE = 1024
 
-def compute_content_hash(data):
+def get_content_hasher(method=None):
+    if method is None:
+        return _content_hasher
+    try:
+        return CONTENT_HASHERS[method]
+    except KeyError:
+        raise ValueError("unknown content hash method {}".format(repr(method)))
+
+def set_content_hash_method(method):
+    global _content_hasher
+    hasher = get_content_hasher(method)
+    # Fail early if an optional dependency is missing.
+    hasher.hash_bytes(b"")
+    _content_hasher = hasher
+
+def compute_content_hash(data, method=None):
+    return get_content_hasher(method).hash_bytes(data)
+
+def compute_dedup_hash(data, content_hash=None):
+    # Content shared by digest alone (e.g. blobs) needs a collision
+    # resistant hash, whatever is used for change detection.
+    if content_hash is not None and get_content_hasher(content_hash["method"]).collision_resistant:
+        return content_hash
     return DEFAULT_HASHER.hash_bytes(data)
 
+def content_hash_stream(method=None):
+    return get_content_hasher(method).hash_stream()
+
 def compute_diff(a, b):
     return DEFAULT_DIFFER.diff(a, b)
 
 def apply_patch(a, atob):
     return DEFAULT_DIFFER.patch(a, atob)
 
+def split_content(data):
+    return DEFAULT_CHUNKER.split(data)
+
 @functools.lru_cache(maxsize=_CACHE_SIZE)
 def compute_version_shard(ver):
     return DEFAULT_SHARDER.get_version_shard(ver)
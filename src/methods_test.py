@@ -63,3 +63,39 @@ def test_key_prefix_encoding():
         assert s[:n] == decoded_prefix
     assert got_full
     assert got_short
+
+def test_content_hash_stream():
+    data = repr(list(range(1000))).encode("utf-8")
+    m = content_hash_stream()
+    for i in range(0, len(data), 100):
+        m.update(data[i:i+100])
+    assert m.result() == compute_content_hash(data)
+
+def test_content_chunker():
+    import random
+    rng = random.Random(1)
+    data = bytes(rng.randrange(256) for _ in range(300000))
+    chunks = list(split_content(data))
+    assert b"".join(chunks) == data
+    assert all(len(chunk) <= 65536 for chunk in chunks)
+    assert all(len(chunk) >= 2048 for chunk in chunks[:-1])
+    edited = data[:100000] + b"inserted" + data[100000:]
+    edited_chunks = list(split_content(edited))
+    assert b"".join(edited_chunks) == edited
+    # Boundaries resynchronize after the edit.
+    assert len(set(edited_chunks) - set(chunks)) <= 2
+
+def test_content_hash_methods():
+    import pytest
+    assert compute_content_hash(b"")["method"] == "sha256-hex"
+    hashed = compute_content_hash(b"", method="blake2b-hex")
+    assert hashed["method"] == "blake2b-hex"
+    assert len(hashed["digest"]) == 128
+    with pytest.raises(ValueError):
+        compute_content_hash(b"", method="md5")
+    set_content_hash_method("blake2b-hex")
+    try:
+        assert compute_content_hash(b"")["method"] == "blake2b-hex"
+        assert compute_key_hash("")["method"] == "sha256-hex"
+    finally:
+        set_content_hash_method("sha256-hex")
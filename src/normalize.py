@@ -0,0 +1,58 @@
+import re
+import yaml
+
+class StripRule(object):
+    def __init__(self, url_regex, strip_regexes, replacement=b""):
+        self._url_regex = re.compile(url_regex)
+        self._strip = [re.compile(x.encode("utf-8") if isinstance(x, str) else x) for x in strip_regexes]
+        self._replacement = replacement.encode("utf-8") if isinstance(replacement, str) else replacement
+
+    def applies_to(self, url):
+        return bool(self._url_regex.match(url))
+
+    def __call__(self, url, data):
+        for pattern in self._strip:
+            data = pattern.sub(self._replacement, data)
+        return data
+
+class CallableRule(object):
+    def __init__(self, f, url_regex=".*"):
+        self._f = f
+        self._url_regex = re.compile(url_regex)
+
+    def applies_to(self, url):
+        return bool(self._url_regex.match(url))
+
+    def __call__(self, url, data):
+        return self._f(url, data)
+
+class Normalizer(object):
+    def __init__(self, rules=None):
+        self._rules = []
+        for rule in rules or []:
+            self.add_rule(rule)
+
+    def add_rule(self, rule):
+        if isinstance(rule, dict):
+            rule = StripRule(rule["url"], rule["strip"], rule.get("replacement", b""))
+        self._rules.append(rule)
+
+    def add_callable(self, f, url_regex=".*"):
+        self.add_rule(CallableRule(f, url_regex))
+
+    def normalize(self, url, data):
+        for rule in self._rules:
+            if rule.applies_to(url):
+                data = rule(url, data)
+        return data
+
+def load_normalizer(filename):
+    # Expects a list of rules such as:
+    #   - url: "https://example\\.com/"
+    #     strip: ['name="csrf" value="[^"]*"']
+    #     replacement: ""
+    with open(filename) as f:
+        rules = yaml.safe_load(f) or []
+    if not isinstance(rules, list):
+        raise ValueError("normalization rules in {} must be a list".format(filename))
+    return Normalizer(rules)
@@ -0,0 +1,17 @@
+from .normalize import *
+
+def test_strip_rules_by_url():
+    normalizer = Normalizer([
+        {"url": r"https://example\.com/", "strip": [r'name="csrf" value="[^"]*"', r"<!-- generated at [^>]* -->"]},
+        {"url": r"https://other\.com/", "strip": [r"\d+"], "replacement": "#"},
+    ])
+    page = b'<input name="csrf" value="abc123"><!-- generated at 12:00 --><p>42</p>'
+    assert normalizer.normalize("https://example.com/page", page) == b'<input ><p>42</p>'
+    assert normalizer.normalize("https://other.com/page", page) == b'<input name="csrf" value="abc#"><!-- generated at #:# --><p>#</p>'
+    assert normalizer.normalize("https://elsewhere.com/", page) is page
+
+def test_callable_rule():
+    normalizer = Normalizer()
+    normalizer.add_callable(lambda url, data: data.lower(), url_regex=r"https://example\.com/")
+    assert normalizer.normalize("https://example.com/", b"ABC") == b"abc"
+    assert normalizer.normalize("https://other.com/", b"ABC") == b"ABC"
@@ -9,6 +9,7 @@ import contextlib
 import subprocess
 import storage
 import datadiff
+import blobs
 
 
 @contextlib.contextmanager
@@ -34,12 +35,19 @@ def output_file(filename, text_mode=False, allow_overwrite=False):
 @click.option("--output", default="-", show_default=True, help="Output file.")
 @click.option("--select-key", multiple=True,
               help="Select only a specific set of keys.")
-def main(script, output, allow_overwrite, data_dir, include_unchanged, select_key):
+@click.option("--blob-dir", default=None,
+              help="Directory containing shared blobs, if the data uses them.")
+@click.option("--verify", default="full", show_default=True,
+              type=click.Choice(datadiff.VERIFY_LEVELS),
+              help="Which rebuilt versions to check against their recorded hashes: all, only the latest, the latest and a random sample, or none.")
+def main(script, output, allow_overwrite, data_dir, include_unchanged, select_key, blob_dir, verify):
     with output_file(output, allow_overwrite=allow_overwrite) as out:
         stream = datadiff.read_streaming(
-            store=storage.LocalFileStorage(data_dir),
+            store=storage.open_storage(data_dir),
             key_filter=select_key or None,
-            include_unchanged=include_unchanged)
+            include_unchanged=include_unchanged,
+            blobs=blobs.open_blob_store(blob_dir),
+            verify=verify)
         for entry, revision in stream:
             subprocess.run(
                 [script, entry.key, revision.data_version],
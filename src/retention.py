@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import click
+import collections
+import re
+import time
+
+import blobs
+import datadiff
+import filenames
+import storage
+
+RetentionTier = collections.namedtuple("RetentionTier", ["max_age", "rule"])
+
+DEFAULT_POLICY = "7d:all,30d:1h,365d:1d,*:changed"
+
+_DURATION_UNITS = {
+    "s": 1,
+    "m": 60,
+    "h": 3600,
+    "d": 86400,
+    "w": 7 * 86400,
+    "y": 365 * 86400,
+}
+
+def parse_duration(text):
+    m = re.match(r"^([0-9]+(?:\.[0-9]+)?)([smhdwy])$", text.strip())
+    if not m:
+        raise ValueError("invalid duration {}".format(repr(text)))
+    return float(m.group(1)) * _DURATION_UNITS[m.group(2)]
+
+def parse_policy(spec):
+    # Comma-separated AGE:RULE tiers, ordered by increasing age. AGE is a
+    # duration or "*" for no limit; RULE is "all", "changed" (only versions
+    # whose data changed) or a duration (at most one changed version per
+    # interval). Versions older than the last tier are dropped.
+    tiers = []
+    for part in spec.split(","):
+        try:
+            age, rule = part.split(":")
+        except ValueError:
+            raise ValueError("invalid retention tier {}; expected AGE:RULE".format(repr(part)))
+        age = None if age.strip() == "*" else parse_duration(age)
+        rule = rule.strip()
+        if rule not in ("all", "changed"):
+            rule = parse_duration(rule)
+        if tiers and (tiers[-1].max_age is None or (age is not None and age <= tiers[-1].max_age)):
+            raise ValueError("retention tiers must be ordered by increasing age")
+        tiers.append(RetentionTier(max_age=age, rule=rule))
+    return tiers
+
+def _tier_for_age(tiers, age):
+    for i, tier in enumerate(tiers):
+        if tier.max_age is None or age < tier.max_age:
+            return i
+    return None
+
+def select_versions(incarnations, tiers, now=None):
+    # The first and the latest version are always kept, so reads back to
+    # first_known_version and loading the current state keep working.
+    if now is None:
+        now = time.time()
+    incarnations = list(incarnations)
+    kept = []
+    kept_buckets = set()
+    for i, inc in enumerate(incarnations):
+        if i == 0 or i == len(incarnations) - 1:
+            kept.append(inc)
+            continue
+        tier = _tier_for_age(tiers, now - int(inc.data_version) / 1e9)
+        if tier is None:
+            continue
+        rule = tiers[tier].rule
+        if rule == "all":
+            kept.append(inc)
+            continue
+        if inc.same_data_as(kept[-1]):
+            continue
+        if rule == "changed":
+            kept.append(inc)
+            continue
+        bucket = (tier, int(int(inc.data_version) // (rule * 1e9)))
+        if bucket not in kept_buckets:
+            kept_buckets.add(bucket)
+            kept.append(inc)
+    return kept
+
+def _rewrite_layouts(entry, survivors):
+    yield [entry.with_incarnations(survivors)]
+    if len(survivors) > 1:
+        # The single chunk may have the same name as an existing one; the
+        # same versions split in two get different names.
+        full = entry.with_incarnations(survivors)
+        yield [entry.with_incarnations(survivors[:-1]), full.suffix_after(survivors[-2].data_version, dependency_chain_length=1)]
+
+def apply_to_keyhash(store, keyhash, tiers, now=None, dry_run=False, blob_store=None):
+    # Rewrites the chunks of a key keeping only the selected versions,
+    # re-diffed against each other. Returns the number of versions dropped.
+    # Must not run while a crawler is writing to the store, since its next
+    # chunk may depend on a dropped version.
+    names = store.list_filtered_chunks(keyhash_filter=[keyhash])
+    if not names:
+        return 0
+    entry = datadiff.Entry.load_dumps(store, names, full_history=True, blobs=blob_store)
+    incarnations = list(entry.incarnations())
+    survivors = select_versions(incarnations, tiers, now=now)
+    dropped = len(incarnations) - len(survivors)
+    if not dropped or dry_run:
+        return dropped
+    for layout in _rewrite_layouts(entry, survivors):
+        new_names = [filenames.encode_filename_from_nameinfo(e.info) for e in layout]
+        if not set(new_names) & set(names):
+            break
+    else:
+        raise RuntimeError("cannot rewrite {}: rewritten chunk names collide with existing chunks".format(keyhash))
+    for e in layout:
+        e.write_dump(store, blobs=blob_store)
+    for name in names:
+        store.delete_chunk(name)
+    return dropped
+
+def apply_to_store(store, tiers, now=None, dry_run=False, blob_store=None):
+    keyhashes = sorted(set(filenames.decode_filename(name).keyhash for name in store.list_chunks()))
+    rv = 0
+    for kh in keyhashes:
+        rv += apply_to_keyhash(store, kh, tiers, now=now, dry_run=dry_run, blob_store=blob_store)
+    return rv
+
+@click.command()
+@click.option("--data-dir", required=True,
+              help="Directory containing datawatch data.")
+@click.option("--policy", default=DEFAULT_POLICY, show_default=True,
+              help="Comma-separated AGE:RULE tiers; RULE is all, changed, or an interval such as 1h.")
+@click.option("--dry-run/--no-dry-run",
+              default=False, show_default=True, type=bool,
+              help="Only report how many versions would be dropped.")
+@click.option("--blob-dir", default=None,
+              help="Directory containing shared blobs, if the data uses them.")
+def main(data_dir, policy, dry_run, blob_dir):
+    tiers = parse_policy(policy)
+    store = storage.open_storage(data_dir)
+    try:
+        n = apply_to_store(store, tiers, dry_run=dry_run, blob_store=blobs.open_blob_store(blob_dir))
+    finally:
+        store.close()
+    print("{} {} versions.".format("Would drop" if dry_run else "Dropped", n))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from .retention import *
+
+import datadiff
+import pytest
+import storage
+
+_DAY = 86400
+_NOW = 1000 * _DAY
+
+def _version(age):
+    return str(int((_NOW - age) * 1e9))
+
+def test_parse_policy():
+    tiers = parse_policy("7d:all,30d:1h,*:changed")
+    assert tiers == [
+        RetentionTier(max_age=7 * _DAY, rule="all"),
+        RetentionTier(max_age=30 * _DAY, rule=3600),
+        RetentionTier(max_age=None, rule="changed"),
+    ]
+    with pytest.raises(ValueError):
+        parse_policy("30d:all,7d:changed")
+    with pytest.raises(ValueError):
+        parse_policy("*:all,7d:changed")
+    with pytest.raises(ValueError):
+        parse_policy("7d")
+    with pytest.raises(ValueError):
+        parse_policy("7x:all")
+
+def test_select_versions():
+    tiers = parse_policy("1d:all,10d:1d,*:changed")
+    ages = [50 * _DAY, 40 * _DAY, 30 * _DAY, 9.5 * _DAY, 9.4 * _DAY, 5 * _DAY, 3600, 1800, 60]
+    datas = [b"a", b"a", b"b", b"c", b"d", b"d", b"e", b"e", b"e"]
+    incs = [datadiff.DataIncarnation(data, _version(age)) for age, data in zip(ages, datas)]
+    kept = select_versions(incs, tiers, now=_NOW)
+    assert [inc.data_version for inc in kept] == [incs[i].data_version for i in (0, 2, 3, 5, 6, 7, 8)]
+    assert kept[0] is incs[0]
+    assert kept[-1] is incs[-1]
+
+def test_apply_to_keyhash():
+    store = storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    key = "https://example.com/"
+    kh = coll._compute_keyhash(key)
+    ages = [100 * _DAY - i * 3600 for i in range(20)]
+    for i, age in enumerate(ages):
+        coll.update_data(key, "content {}".format(i // 5).encode("utf-8"), _version(age))
+        coll.sync_and_flush_one()
+    tiers = parse_policy("*:changed")
+    assert apply_to_keyhash(store, kh, tiers, now=_NOW, dry_run=True) == 15
+    assert len(list(store.list_chunks())) == 20
+    assert apply_to_keyhash(store, kh, tiers, now=_NOW) == 15
+    assert apply_to_keyhash(store, kh, tiers, now=_NOW) == 0
+    entry = datadiff.Collection(store, full_history=True)[kh]
+    assert [inc.data_version for inc in entry.incarnations()] == [_version(ages[i]) for i in (0, 5, 10, 15, 19)]
+    assert entry.read_data_bytes_at(_version(ages[7])) == b"content 1"
+    assert entry.info.first_version == _version(ages[0])
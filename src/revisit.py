@@ -0,0 +1,74 @@
+import math
+
+class ChangeRateEstimate(object):
+    def __init__(self):
+        self.visits = 0
+        self.changes = 0
+        self.elapsed = 0.0
+
+    def observe(self, changed, interval):
+        self.visits += 1
+        if changed:
+            self.changes += 1
+        self.elapsed += interval
+
+    def rate(self):
+        # Poisson change rate estimated from how many revisits saw a change
+        # (Cho & Garcia-Molina); unlike changes/elapsed it accounts for
+        # multiple changes between two visits being observed as one.
+        if not self.visits or self.elapsed <= 0:
+            return None
+        unchanged_ratio = (self.visits - self.changes + 0.5) / (self.visits + 0.5)
+        mean_interval = self.elapsed / self.visits
+        return -math.log(unchanged_ratio) / mean_interval
+
+class RevisitPolicy(object):
+    def __init__(self, fetch_budget, default_delay, min_delay=1.0, max_delay=86400.0, min_visits=3):
+        if fetch_budget <= 0:
+            raise ValueError("fetch budget must be positive: {}".format(fetch_budget))
+        if not (0 < min_delay <= default_delay <= max_delay):
+            raise ValueError("delays must satisfy 0 < min_delay <= default_delay <= max_delay")
+        self._budget = fetch_budget
+        self._prior_rate = 1.0 / default_delay
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._min_visits = min_visits
+        self._estimates = {}
+        self._rates = {}
+        self._total_rate = 0.0
+
+    def _set_rate(self, url, rate):
+        self._total_rate += rate - self._rates.get(url, 0.0)
+        self._rates[url] = rate
+
+    def add(self, url):
+        if url in self._estimates:
+            return
+        self._estimates[url] = ChangeRateEstimate()
+        self._set_rate(url, self._prior_rate)
+
+    def remove(self, url):
+        if url not in self._estimates:
+            return
+        self._set_rate(url, 0.0)
+        del self._rates[url]
+        del self._estimates[url]
+
+    def observe(self, url, changed, interval):
+        est = self._estimates[url]
+        est.observe(changed, interval)
+        if est.visits >= self._min_visits:
+            self._set_rate(url, est.rate())
+
+    def estimated_rate(self, url):
+        return self._rates[url]
+
+    def delay_for(self, url):
+        # Expected detected changes f * (1 - exp(-rate / f)) summed over all
+        # targets, subject to sum(f) == budget, is maximized by visiting
+        # each target at a frequency proportional to its change rate.
+        rate = self._rates[url]
+        if rate <= 0 or self._total_rate <= 0:
+            return self._max_delay
+        delay = self._total_rate / (self._budget * rate)
+        return max(self._min_delay, min(self._max_delay, delay))
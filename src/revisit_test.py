@@ -0,0 +1,34 @@
+from .revisit import *
+
+import pytest
+
+def test_estimate_never_changing():
+    est = ChangeRateEstimate()
+    assert est.rate() is None
+    for _ in range(10):
+        est.observe(False, 60.0)
+    assert est.rate() == 0
+
+def test_estimate_tracks_change_rate():
+    slow, fast = ChangeRateEstimate(), ChangeRateEstimate()
+    for i in range(100):
+        slow.observe(i % 10 == 0, 60.0)
+        fast.observe(i % 2 == 0, 60.0)
+    assert 0 < slow.rate() < fast.rate()
+    assert slow.rate() == pytest.approx(0.1 / 60, rel=0.2)
+
+def test_policy_allocates_budget_by_change_rate():
+    policy = RevisitPolicy(fetch_budget=1.0, default_delay=60, min_delay=1, max_delay=86400)
+    for url in ("static", "slow", "fast"):
+        policy.add(url)
+    assert policy.delay_for("static") == policy.delay_for("fast")
+    for i in range(20):
+        policy.observe("static", False, 60.0)
+        policy.observe("slow", i % 10 == 0, 60.0)
+        policy.observe("fast", True, 60.0)
+    assert policy.delay_for("static") == 86400
+    assert policy.delay_for("slow") > policy.delay_for("fast")
+    frequency = 1 / policy.delay_for("slow") + 1 / policy.delay_for("fast")
+    assert frequency == pytest.approx(1.0)
+    policy.remove("fast")
+    assert policy.delay_for("slow") == pytest.approx(1.0)
@@ -4,6 +4,7 @@ import time
 import sys
 import dataclasses
 import collections
+import itertools
 
 from typing import Any
 
@@ -39,6 +40,8 @@ class Task:
     apply_global_ratelimit: bool = True
     reschedule_if: callable = never_reschedule
     reschedule_delay: callable = None
+    task_id: int = dataclasses.field(default=None, compare=False)
+    cancelled: bool = dataclasses.field(default=False, compare=False)
 
 DEFAULT_GLOBAL_RATELIMIT = fuzzed_delay_generator(0.2)
 
@@ -47,6 +50,8 @@ _VERY_SHORT_SLEEP = 0.0001
 class SchedulingLoop(object):
     def __init__(self, global_ratelimit=None, clock=None, sleep=None, verbose=False):
         self._tasks = []
+        self._pending = {}
+        self._task_ids = itertools.count(1)
         self._clock = clock or time.time
         self._sleep = sleep or time.sleep
         self._verbose = verbose
@@ -68,8 +73,20 @@ class SchedulingLoop(object):
     
     def add_task(self, task):
         self.log("scheduling task", task.name, "for", task.trigger_time)
+        if task.task_id is None:
+            task.task_id = next(self._task_ids)
+        self._pending[task.task_id] = task
         heapq.heappush(self._tasks, task)
 
+    def cancel_task(self, task_id):
+        # Cancelled tasks stay in the heap and are discarded when popped.
+        task = self._pending.pop(task_id, None)
+        if task is None:
+            return False
+        self.log("cancelling task", task.name)
+        task.cancelled = True
+        return True
+
     def schedule_task(self, delay, **kwargs):
         delay = as_delay(delay)
         trigger_time = self._clock() + delay() 
@@ -102,6 +119,8 @@ class SchedulingLoop(object):
             self._sleep(sleeptime)
             return False
         heapq.heappop(self._tasks)
+        if task.cancelled:
+            return True
         if task.apply_global_ratelimit:
             self._wait_for_global_ratelimit()
         self.log("running task", task.name, "at", now, "intended for", task.trigger_time, "delay", now - task.trigger_time)
@@ -113,11 +132,13 @@ class SchedulingLoop(object):
             if task.apply_global_ratelimit:
                 self._global_ratelimit_last_end = t1
             self.log("ran", task.name, "taking", t1-t0)
-            if task.reschedule_if and task.reschedule_if():
+            if (not task.cancelled) and task.reschedule_if and task.reschedule_if():
                 delay = task.reschedule_delay()
                 self.log("rescheduling", task.name, "for", delay, "from previous start, in", (now + delay) - t1)
                 new_task = dataclasses.replace(task, trigger_time=now + delay)
                 self.add_task(new_task)
+            else:
+                self._pending.pop(task.task_id, None)
         return True
 
     def run_loop(self):
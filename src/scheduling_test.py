@@ -0,0 +1,59 @@
+from .scheduling import *
+
+class _FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, t):
+        self.now += t
+
+def _make_loop():
+    fake = _FakeClock()
+    loop = SchedulingLoop(global_ratelimit=0.001, clock=fake.clock, sleep=fake.sleep)
+    return fake, loop
+
+def test_cancelled_task_does_not_run():
+    fake, loop = _make_loop()
+    ran = []
+    def callback(task):
+        ran.append(task.payload)
+    keep = loop.schedule_task(callback=callback, payload="keep", delay=lambda: 1.0)
+    drop = loop.schedule_task(callback=callback, payload="drop", delay=lambda: 2.0)
+    assert loop.cancel_task(drop.task_id)
+    assert not loop.cancel_task(drop.task_id)
+    fake.now += 10
+    assert loop.run_once()
+    assert loop.run_once()
+    assert ran == ["keep"]
+    assert not loop._tasks
+
+def test_cancel_rescheduled_task():
+    fake, loop = _make_loop()
+    ran = []
+    def callback(task):
+        ran.append(task.payload)
+    task = loop.schedule_task(callback=callback, payload="x", delay=lambda: 1.0, reschedule=True)
+    fake.now += 1
+    loop.run_once()
+    assert ran == ["x"]
+    assert len(loop._tasks) == 1
+    assert loop.cancel_task(task.task_id)
+    fake.now += 10
+    loop.run_once()
+    assert ran == ["x"]
+    assert not loop._tasks
+
+def test_cancel_from_within_callback():
+    fake, loop = _make_loop()
+    ran = []
+    def callback(task):
+        ran.append(task.payload)
+        loop.cancel_task(task.task_id)
+    loop.schedule_task(callback=callback, payload="x", delay=lambda: 1.0, reschedule=True)
+    fake.now += 1
+    loop.run_once()
+    assert ran == ["x"]
+    assert not loop._tasks
@@ -0,0 +1,13 @@
+import methods
+
+def shard_for_keyhash(keyhash, num_shards):
+    return int(keyhash, 16) % num_shards
+
+def shard_for_key(key, num_shards):
+    return shard_for_keyhash(methods.compute_key_hash(key)["digest"], num_shards)
+
+def partition_keys(keys, num_shards):
+    rv = [set() for _ in range(num_shards)]
+    for key in keys:
+        rv[shard_for_key(key, num_shards)].add(key)
+    return rv
@@ -0,0 +1,13 @@
+from .sharding import *
+
+def test_partition_keys():
+    keys = ["https://example.com/{}".format(i) for i in range(100)]
+    parts = partition_keys(keys, 4)
+    assert len(parts) == 4
+    assert set.union(*parts) == set(keys)
+    assert sum(len(part) for part in parts) == len(keys)
+    assert all(parts)
+    for i, part in enumerate(parts):
+        for key in part:
+            assert shard_for_key(key, 4) == i
+            assert shard_for_keyhash(methods.compute_key_hash(key)["digest"], 4) == i
@@ -0,0 +1,21 @@
+import heapq
+import re
+import zlib
+
+DEFAULT_SKETCH_SIZE = 64
+
+# Lines, and tags within long lines of HTML.
+_TOKEN_SEPARATOR = re.compile(rb"[\n>]")
+
+def compute_sketch(data, k=DEFAULT_SKETCH_SIZE):
+    # Bottom-k MinHash: the k smallest distinct token hashes.
+    hashes = set(zlib.crc32(token) for token in _TOKEN_SEPARATOR.split(data))
+    return frozenset(heapq.nsmallest(k, hashes))
+
+def estimate_similarity(a, b, k=DEFAULT_SKETCH_SIZE):
+    # Estimated Jaccard similarity of the token sets the sketches came from.
+    union = heapq.nsmallest(k, a | b)
+    if not union:
+        return 1.0
+    both = a & b
+    return sum(1 for h in union if h in both) / len(union)
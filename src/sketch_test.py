@@ -0,0 +1,21 @@
+from .sketch import *
+
+def _lines(prefix, n):
+    return b"\n".join(prefix + str(i).encode("ascii") for i in range(n))
+
+def test_similarity():
+    a = compute_sketch(_lines(b"a", 1000))
+    a2 = compute_sketch(_lines(b"a", 1000) + b"\nextra")
+    b = compute_sketch(_lines(b"b", 1000))
+    assert estimate_similarity(a, a) == 1.0
+    assert estimate_similarity(a, a2) > 0.9
+    assert estimate_similarity(a, b) < 0.1
+    assert len(a) == DEFAULT_SKETCH_SIZE
+
+def test_html_tags_are_tokens():
+    a = compute_sketch(b"".join(b"<p>item %d</p>" % i for i in range(1000)))
+    b = compute_sketch(b"".join(b"<p>item %d</p>" % i for i in range(1, 1001)))
+    assert estimate_similarity(a, b) > 0.9
+
+def test_empty():
+    assert estimate_similarity(compute_sketch(b""), compute_sketch(b"")) == 1.0
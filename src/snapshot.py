@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import base64
+import click
+import collections
+import datetime
+import json
+import time
+
+import blobs
+import datadiff
+import filenames
+import storage
+
+# A materialized listing of a store's chunks grouped by key hash, so that
+# snapshot queries do not have to list the whole store. It is only complete
+# if it is kept up to date by the writer of the store: the crawler rebuilds
+# it from a listing when it starts and then adds every chunk it writes.
+# Chunks that other tools (e.g. compaction) delete are noticed at query
+# time, and the affected keys are listed afresh.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    name TEXT PRIMARY KEY,
+    keyhash TEXT NOT NULL,
+    last_version INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chunks_keyhash ON chunks (keyhash);
+"""
+
+class ChunkIndex(storage.BatchedSqlite):
+    def __init__(self, path, batch_size=1000, max_batch_delay=5.0):
+        super().__init__(path, _SCHEMA, batch_size, max_batch_delay=max_batch_delay)
+
+    def __repr__(self):
+        return "ChunkIndex({})".format(repr(self._path))
+
+    def add_chunk(self, name):
+        fni = filenames.decode_filename(name)
+        with self._lock:
+            self._begin_if_needed()
+            self._conn.execute("INSERT OR IGNORE INTO chunks (name, keyhash, last_version) VALUES (?, ?, ?)", (name, fni.keyhash, int(fni.last_version)))
+            self._maybe_commit(1)
+
+    def remove_chunk(self, name):
+        with self._lock:
+            self._begin_if_needed()
+            self._conn.execute("DELETE FROM chunks WHERE name = ?", (name,))
+            self._maybe_commit(1)
+
+    def add_entry(self, entry):
+        self.add_chunk(filenames.encode_filename_from_nameinfo(entry.info))
+
+    def rebuild(self, store):
+        rows = []
+        for name in store.list_chunks():
+            fni = filenames.decode_filename(name)
+            rows.append((name, fni.keyhash, int(fni.last_version)))
+        with self._lock:
+            self._begin_if_needed()
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.executemany("INSERT INTO chunks (name, keyhash, last_version) VALUES (?, ?, ?)", rows)
+            self.commit()
+        return len(rows)
+
+    def chunk_names(self):
+        rv = collections.defaultdict(list)
+        with self._lock:
+            for kh, name in self._conn.execute("SELECT keyhash, name FROM chunks ORDER BY keyhash, name"):
+                rv[kh].append(name)
+        return dict(rv)
+
+def open_chunk_index(path):
+    if path is None:
+        return None
+    return ChunkIndex(path)
+
+def parse_at(text):
+    # A version (nanoseconds since the epoch), "now", or an ISO 8601 time.
+    if text == "now":
+        return str(int(time.time()*1e9))
+    if text.isdigit():
+        return text
+    when = datetime.datetime.fromisoformat(text)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return str(int(when.timestamp()*1e9))
+
+@click.command()
+@click.option("--data-dir", required=True,
+              help="Input directory containing datawatch data.")
+@click.option("--at", "at_text", default="now", show_default=True,
+              help="Point in time: a version, an ISO 8601 time (UTC unless given), or now.")
+@click.option("--index", default=None,
+              help="Chunk index kept up to date by the crawler (its --snapshot_index_path), used instead of listing the store.")
+@click.option("--select-key", multiple=True,
+              help="Select only a specific set of keys.")
+@click.option("--omit-data/--no-omit-data",
+              default=False, show_default=True, type=bool,
+              help="Omit the actual data from the output.")
+@click.option("--blob-dir", default=None,
+              help="Directory containing shared blobs, if the data uses them.")
+@click.option("--verify", default="final", show_default=True,
+              type=click.Choice(datadiff.VERIFY_LEVELS),
+              help="Which rebuilt versions to check against their recorded hashes.")
+def main(data_dir, at_text, index, select_key, omit_data, blob_dir, verify):
+    at_version = parse_at(at_text)
+    store = storage.open_storage(data_dir)
+    try:
+        chunk_names = None
+        if index:
+            idx = ChunkIndex(index)
+            try:
+                chunk_names = idx.chunk_names()
+            finally:
+                idx.close()
+        stream = datadiff.read_snapshot(
+            store,
+            at_version,
+            key_filter=select_key or None,
+            chunk_names=chunk_names,
+            blobs=blobs.open_blob_store(blob_dir),
+            verify=verify)
+        for key, data_version, data in stream:
+            record = {"key": key, "data_version": data_version}
+            if not omit_data:
+                try:
+                    record["data"] = data.decode("utf-8")
+                except UnicodeDecodeError:
+                    record["data_base64"] = base64.b64encode(data).decode("ascii")
+            print(json.dumps(record))
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
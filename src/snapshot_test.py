@@ -0,0 +1,57 @@
+from .snapshot import *
+
+import datadiff
+import storage
+
+def _make_store():
+    store = storage.InMemoryStorage()
+    coll = datadiff.Collection(store)
+    for i in range(12):
+        coll.update_data("https://example.com/", "content {}".format(i).encode("utf-8"), str(1000 + i))
+        if i % 4 == 3:
+            coll.sync_and_flush_one()
+    return store, coll
+
+def test_chunk_index_rebuild(tmp_path):
+    store, coll = _make_store()
+    idx = ChunkIndex(str(tmp_path / "chunks.sqlite"))
+    assert idx.rebuild(store) == len(list(store.list_chunks()))
+    kh = coll._compute_keyhash("https://example.com/")
+    assert idx.chunk_names() == {kh: sorted(store.list_chunks())}
+    idx.close()
+
+def test_maintained_index_sees_later_checkpoints(tmp_path):
+    store = storage.InMemoryStorage()
+    idx = ChunkIndex(str(tmp_path / "chunks.sqlite"))
+    idx.rebuild(store)
+    coll = datadiff.Collection(store, indexes=[idx])
+    coll.update_data("k", b"one", "100")
+    coll.update_data("k", b"two", "200")
+    coll.checkpoint_all()
+    # Fetched now, checkpointed after a query might have looked.
+    coll.update_data("k", b"three", "300")
+    coll.update_data("new", b"first", "310")
+    coll.checkpoint_all()
+    got = sorted(datadiff.read_snapshot(store, "350", chunk_names=idx.chunk_names(), chunk_cache=None))
+    assert got == [("k", "300", b"three"), ("new", "310", b"first")]
+    idx.close()
+
+def test_snapshot_with_deleted_chunks(tmp_path):
+    store, coll = _make_store()
+    idx = ChunkIndex(str(tmp_path / "chunks.sqlite"))
+    idx.rebuild(store)
+    kh = coll._compute_keyhash("https://example.com/")
+    names = idx.chunk_names()[kh]
+    # Replace the chunks with a single rewritten one, as compaction does.
+    entry = datadiff.Entry.load_dumps(store, names, full_history=True)
+    for name in names:
+        store.delete_chunk(name)
+    entry.with_incarnations(list(entry.incarnations())).write_dump(store)
+    got = list(datadiff.read_snapshot(store, "1005", chunk_names=idx.chunk_names(), chunk_cache=None))
+    assert got == [("https://example.com/", "1005", b"content 5")]
+    idx.close()
+
+def test_parse_at():
+    assert parse_at("12345") == "12345"
+    assert parse_at("1970-01-01T00:00:01") == "1000000000"
+    assert parse_at("1970-01-01T01:00:01+01:00") == "1000000000"
@@ -8,6 +8,7 @@ import sys
 import yaml
 import storage
 import datadiff
+import blobs
 import hashlib
 import methods
 
@@ -16,11 +17,14 @@ import methods
               help="Input directory containing datawatch data.")
 @click.option("--select-key", multiple=True,
               help="Select only a specific set of keys.")
-def main(data_dir, select_key):
+@click.option("--blob-dir", default=None,
+              help="Directory containing shared blobs, if the data uses them.")
+def main(data_dir, select_key, blob_dir):
     stream = datadiff.read_streaming(
-        store=storage.LocalFileStorage(data_dir),
+        store=storage.open_storage(data_dir),
         key_filter=select_key or None,
-        include_unchanged=True)
+        include_unchanged=True,
+        blobs=blobs.open_blob_store(blob_dir))
     last_entry = None
     last_revision = None
     class C(object): pass
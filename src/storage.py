@@ -2,8 +2,19 @@ import contextlib
 import io
 import os.path
 import os
+import json
+import mmap
+import sqlite3
+import threading
+import time
+import zlib
+import chunkcache
 import filenames
 
+_LOCK_SUFFIX = ".lock"
+_TMP_SUFFIX = ".tmp"
+_IN_PROGRESS_SUFFIXES = (_LOCK_SUFFIX, _TMP_SUFFIX)
+
 def _check_filter(value, filt):
     if filt is None:
         return True
@@ -11,18 +22,26 @@ def _check_filter(value, filt):
         return value in filt
     raise ValueError("unknown kind of filter: " + repr(filt))
 
-def _manual_check_item(item, version_shard_filter=None, keyhash_filter=None):
+def _manual_check_item(item, version_shard_filter=None, keyhash_filter=None, min_last_version=None, max_first_version=None):
     fni = filenames.decode_filename(item)
     if not _check_filter(fni.version_shard, version_shard_filter):
         return False
     if not _check_filter(fni.keyhash, keyhash_filter):
         return False
+    if min_last_version is not None and int(fni.last_version) < int(min_last_version):
+        return False
+    if max_first_version is not None and int(fni.first_version) > int(max_first_version):
+        return False
     return True
 
 def _manual_filter(items, **kwargs):
     return [item for item in items if _manual_check_item(item, **kwargs)]
 
 class Storage(object):
+    # Identifies the storage to chunk caches; None means chunks may be
+    # overwritten and must not be cached.
+    cache_namespace = None
+
     def list_chunks(self):
         raise NotImplementedError()
 
@@ -35,6 +54,21 @@ class Storage(object):
     def read_chunk(self, filename):
         raise NotImplementedError()
 
+    @contextlib.contextmanager
+    def read_chunk_buffer(self, filename):
+        # Yields the chunk contents as a memoryview, which is only valid
+        # inside the with-block; callers must not keep slices of it.
+        with self.read_chunk(filename) as f:
+            data = f.read()
+        with memoryview(data) as view:
+            yield view
+
+    def delete_chunk(self, filename):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
 class InMemoryStorage(Storage):
     def __init__(self, data=None):
         self._data = data or {}
@@ -65,6 +99,14 @@ class InMemoryStorage(Storage):
         finally:
             f.close()
 
+    @contextlib.contextmanager
+    def read_chunk_buffer(self, filename):
+        with memoryview(self._data[filename]) as view:
+            yield view
+
+    def delete_chunk(self, filename):
+        del self._data[filename]
+
 class LocalFileStorage(Storage):
     def __init__(self, outpath):
         self._outpath = outpath
@@ -75,6 +117,10 @@ class LocalFileStorage(Storage):
     def __repr__(self):
         return "LocalFileStorage({})".format(repr(self._outpath))
 
+    @property
+    def cache_namespace(self):
+        return ("file", self._abspath)
+
     def list_chunks(self):
         paths = [os.path.join(dp, f) for dp, dn, fn in os.walk(self._abspath) for f in fn]
         rv = []
@@ -82,6 +128,8 @@ class LocalFileStorage(Storage):
         for path in paths:
             if not path.startswith(prefix):
                 raise ValueError("invalid path listed")
+            if path.endswith(_IN_PROGRESS_SUFFIXES):
+                continue
             subpath = path[len(prefix):]
             rv.append(subpath)
         return rv
@@ -96,8 +144,8 @@ class LocalFileStorage(Storage):
             os.makedirs(parent, exist_ok=True)
         if os.path.exists(joined):
             raise RuntimeError("file already exists")
-        lockfile = joined + ".lock"
-        tmpfile = joined + ".tmp"
+        lockfile = joined + _LOCK_SUFFIX
+        tmpfile = joined + _TMP_SUFFIX
         try:
             with open(lockfile, "xb") as f:
                 with open(tmpfile, "xb") as f:
@@ -109,10 +157,545 @@ class LocalFileStorage(Storage):
             if os.path.exists(tmpfile):
                 os.remove(tmpfile)
         
-    @contextlib.contextmanager
-    def read_chunk(self, filename):
+    def _local_path(self, filename):
         joined = os.path.abspath(os.path.join(self._abspath, filename))
         if not joined.startswith(self._abspath):
             raise RuntimeError("local target path {} does not seem to end up below {}; bailing out".format(filename, self._abspath))
-        with open(joined, "rb") as f:
+        return joined
+
+    @contextlib.contextmanager
+    def read_chunk(self, filename):
+        with open(self._local_path(filename), "rb") as f:
+            yield f
+
+    @contextlib.contextmanager
+    def read_chunk_buffer(self, filename):
+        with open(self._local_path(filename), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # mmap refuses empty files.
+                with memoryview(b"") as view:
+                    yield view
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    yield view
+
+    def delete_chunk(self, filename):
+        os.remove(self._local_path(filename))
+        chunkcache.invalidate_chunk(self.cache_namespace, filename)
+
+_SEGMENTS_MARKER = "datawatch-segments"
+_SEGMENT_TMPL = "segment-{:08d}.dat"
+_SEGMENT_INDEX = "index.json"
+
+def _segment_seq(name):
+    if not (name.startswith("segment-") and name.endswith(".dat")):
+        return None
+    return int(name[len("segment-"):-len(".dat")])
+
+class SegmentStorage(Storage):
+    # Chunks are appended to large segment files as records of a JSON
+    # header line followed by the payload; deletions append tombstones.
+    # The in-memory index maps chunk names to (segment, offset, length)
+    # and is rebuilt from the segments (or an index snapshot plus the
+    # segment tails written after it) when opened.
+    def __init__(self, outpath, segment_size=256*1024*1024, compaction_threshold=0.5, sync=True):
+        self._outpath = outpath
+        self._abspath = os.path.abspath(outpath)
+        if not os.path.exists(self._abspath):
+            raise ValueError("output path {} does not exist".format(outpath))
+        marker = os.path.join(self._abspath, _SEGMENTS_MARKER)
+        if not os.path.exists(marker):
+            if any(not x.startswith(".") for x in os.listdir(self._abspath)):
+                raise ValueError("output path {} is not empty and not a segment store".format(outpath))
+            with open(marker, "w"):
+                pass
+        self._segment_size = segment_size
+        self._compaction_threshold = compaction_threshold
+        self._sync = sync
+        self._lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+        self._compaction_thread = None
+        self._stop_compaction = threading.Event()
+        self._load_index()
+        self._active = open(self._segment_path(self._active_seq), "ab")
+
+    def __repr__(self):
+        return "SegmentStorage({})".format(repr(self._outpath))
+
+    @property
+    def cache_namespace(self):
+        return ("segments", self._abspath)
+
+    def _segment_path(self, seq):
+        return os.path.join(self._abspath, _SEGMENT_TMPL.format(seq))
+
+    def _list_segments(self):
+        rv = [_segment_seq(x) for x in os.listdir(self._abspath)]
+        rv = [x for x in rv if x is not None]
+        rv.sort()
+        return rv
+
+    def _reset_index(self):
+        self._index = {}
+        self._tombstones = {}
+        self._segments = {}
+
+    def _segment_info(self, seq):
+        try:
+            return self._segments[seq]
+        except KeyError:
+            info = {"size": 0, "live": 0, "puts": set(), "tombstones": set()}
+            self._segments[seq] = info
+            return info
+
+    def _apply(self, seq, header, offset):
+        name = header["name"]
+        info = self._segment_info(seq)
+        old = self._index.pop(name, None)
+        if old is not None:
+            self._segments[old[0]]["live"] -= old[2]
+        self._tombstones.pop(name, None)
+        if header["op"] == "put":
+            self._index[name] = (seq, offset, header["length"])
+            info["live"] += header["length"]
+            info["puts"].add(name)
+        elif header["op"] == "del":
+            self._tombstones[name] = seq
+            info["tombstones"].add(name)
+        else:
+            raise ValueError("unknown segment record operation: {}".format(repr(header["op"])))
+
+    def _scan_segment(self, seq, start, verify):
+        path = self._segment_path(seq)
+        with open(path, "rb") as f:
+            f.seek(start)
+            while True:
+                record_start = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("truncated header")
+                    header = json.loads(line)
+                    payload_start = f.tell()
+                    if verify:
+                        payload = f.read(header["length"])
+                        if len(payload) != header["length"] or zlib.crc32(payload) != header["crc32"]:
+                            raise ValueError("truncated or corrupt payload")
+                    else:
+                        f.seek(payload_start + header["length"])
+                except ValueError:
+                    if seq != self._list_segments()[-1]:
+                        raise RuntimeError("corrupt record at offset {} of sealed segment {}".format(record_start, path))
+                    # Torn write at the end of the active segment.
+                    f.close()
+                    with open(path, "r+b") as tf:
+                        tf.truncate(record_start)
+                    break
+                self._apply(seq, header, payload_start)
+            self._segment_info(seq)["size"] = os.path.getsize(path)
+
+    def _load_snapshot(self):
+        path = os.path.join(self._abspath, _SEGMENT_INDEX)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            snapshot = json.load(f)
+        scanned = {int(k): v for k, v in snapshot["scanned"].items()}
+        for seq, length in scanned.items():
+            seg = self._segment_path(seq)
+            if not os.path.exists(seg) or os.path.getsize(seg) < length:
+                return None
+        return snapshot, scanned
+
+    def _load_index(self):
+        self._reset_index()
+        for x in os.listdir(self._abspath):
+            if _segment_seq(x[:-len(_TMP_SUFFIX)]) is not None and x.endswith(_TMP_SUFFIX):
+                # Output of a compaction interrupted before it was used.
+                os.remove(os.path.join(self._abspath, x))
+        segments = self._list_segments()
+        loaded = self._load_snapshot()
+        scanned = {}
+        if loaded is not None:
+            snapshot, scanned = loaded
+            newest = max(scanned) if scanned else -1
+            for seq in list(segments):
+                if seq not in scanned and seq < newest:
+                    # Left behind by a compaction interrupted after its
+                    # snapshot was written; its live records were copied.
+                    os.remove(self._segment_path(seq))
+                    segments.remove(seq)
+            for seq, info in snapshot["segments"].items():
+                self._segments[int(seq)] = {
+                    "size": info["size"],
+                    "live": info["live"],
+                    "puts": set(info["puts"]),
+                    "tombstones": set(info["tombstones"]),
+                }
+            self._index = {k: tuple(v) for k, v in snapshot["index"].items()}
+            self._tombstones = dict(snapshot["deleted"])
+        for seq in segments:
+            self._scan_segment(seq, scanned.get(seq, 0), verify=(seq == segments[-1]))
+        self._active_seq = segments[-1] if segments else 0
+
+    def _write_snapshot(self):
+        snapshot = {
+            "scanned": {str(seq): info["size"] for seq, info in self._segments.items()},
+            "segments": {
+                str(seq): {
+                    "size": info["size"],
+                    "live": info["live"],
+                    "puts": sorted(info["puts"]),
+                    "tombstones": sorted(info["tombstones"]),
+                } for seq, info in self._segments.items()
+            },
+            "index": self._index,
+            "deleted": self._tombstones,
+        }
+        path = os.path.join(self._abspath, _SEGMENT_INDEX)
+        with open(path + _TMP_SUFFIX, "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + _TMP_SUFFIX, path)
+
+    def _roll_active(self, skip=0):
+        # Seals the active segment; skipped sequence numbers are reserved
+        # for compaction output ordered before the new active segment.
+        self._active.close()
+        self._active_seq += 1 + skip
+        self._active = open(self._segment_path(self._active_seq), "ab")
+
+    def _append(self, header, payload=b""):
+        if self._segment_info(self._active_seq)["size"] >= self._segment_size:
+            self._roll_active()
+        line = (json.dumps(header) + "\n").encode("utf-8")
+        offset = self._active.tell()
+        self._active.write(line)
+        self._active.write(payload)
+        self._active.flush()
+        if self._sync:
+            os.fsync(self._active.fileno())
+        self._apply(self._active_seq, header, offset + len(line))
+        self._segment_info(self._active_seq)["size"] = offset + len(line) + len(payload)
+
+    def list_chunks(self):
+        with self._lock:
+            rv = list(self._index)
+        rv.sort()
+        return rv
+
+    @contextlib.contextmanager
+    def write_chunk(self, filename):
+        with self._lock:
+            if filename in self._index:
+                raise RuntimeError("file already exists")
+        f = io.BytesIO()
+        try:
             yield f
+            payload = f.getvalue()
+        finally:
+            f.close()
+        with self._lock:
+            if filename in self._index:
+                raise RuntimeError("file already exists")
+            self._append({"op": "put", "name": filename, "length": len(payload), "crc32": zlib.crc32(payload)}, payload)
+
+    def _read_payload(self, filename):
+        with self._lock:
+            seq, offset, length = self._index[filename]
+            with open(self._segment_path(seq), "rb") as f:
+                f.seek(offset)
+                return f.read(length)
+
+    @contextlib.contextmanager
+    def read_chunk(self, filename):
+        f = io.BytesIO(self._read_payload(filename))
+        try:
+            yield f
+        finally:
+            f.close()
+
+    def delete_chunk(self, filename):
+        with self._lock:
+            if filename not in self._index:
+                raise KeyError(filename)
+            self._append({"op": "del", "name": filename, "length": 0, "crc32": 0})
+        chunkcache.invalidate_chunk(self.cache_namespace, filename)
+
+    def _compaction_candidates(self):
+        rv = []
+        for seq, info in self._segments.items():
+            if seq == self._active_seq or not info["size"]:
+                continue
+            if info["live"] < self._compaction_threshold * info["size"]:
+                rv.append(seq)
+        rv.sort()
+        return rv
+
+    def compact(self):
+        # Live records of sparse segments are copied to a new segment
+        # numbered before everything written meanwhile, so later puts and
+        # deletions still win when the segments are replayed. The copy is
+        # made without holding the lock; only planning it and swapping the
+        # index over to it are done under the lock.
+        with self._compaction_lock:
+            with self._lock:
+                candidates = self._compaction_candidates()
+                if not candidates:
+                    return 0
+                plan = []
+                for seq in candidates:
+                    info = self._segments[seq]
+                    puts = [(name, self._index[name]) for name in sorted(info["puts"]) if self._index.get(name, (None,))[0] == seq]
+                    tombstones = []
+                    for name in sorted(info["tombstones"]):
+                        if self._tombstones.get(name) != seq:
+                            continue
+                        still_referenced = any(name in other["puts"] for other_seq, other in self._segments.items() if other_seq != seq)
+                        tombstones.append((name, still_referenced))
+                    plan.append((seq, puts, tombstones))
+                out_seq = self._active_seq + 1
+                self._roll_active(skip=1)
+            out_path = self._segment_path(out_seq)
+            copied = []
+            with open(out_path + _TMP_SUFFIX, "wb") as out:
+                for seq, puts, tombstones in plan:
+                    with open(self._segment_path(seq), "rb") as f:
+                        for name, loc in puts:
+                            f.seek(loc[1])
+                            payload = f.read(loc[2])
+                            header = {"op": "put", "name": name, "length": len(payload), "crc32": zlib.crc32(payload)}
+                            out.write((json.dumps(header) + "\n").encode("utf-8"))
+                            copied.append((seq, loc, header, out.tell()))
+                            out.write(payload)
+                    for name, still_referenced in tombstones:
+                        if not still_referenced:
+                            continue
+                        header = {"op": "del", "name": name, "length": 0, "crc32": 0}
+                        out.write((json.dumps(header) + "\n").encode("utf-8"))
+                        copied.append((seq, None, header, out.tell()))
+                out.flush()
+                if self._sync:
+                    os.fsync(out.fileno())
+                size = out.tell()
+            with self._lock:
+                if copied:
+                    os.rename(out_path + _TMP_SUFFIX, out_path)
+                    info = self._segment_info(out_seq)
+                    info["size"] = size
+                else:
+                    os.remove(out_path + _TMP_SUFFIX)
+                for seq, loc, header, offset in copied:
+                    name = header["name"]
+                    if header["op"] == "put":
+                        current = self._index.get(name) == loc
+                    else:
+                        current = self._tombstones.get(name) == seq
+                    if current:
+                        self._apply(out_seq, header, offset)
+                    else:
+                        # Superseded while copying; dead in the new segment.
+                        info["puts" if header["op"] == "put" else "tombstones"].add(name)
+                for seq, _, tombstones in plan:
+                    for name, still_referenced in tombstones:
+                        if not still_referenced and self._tombstones.get(name) == seq:
+                            del self._tombstones[name]
+                    del self._segments[seq]
+                # The snapshot must stop referring to the segments before they go away.
+                self._write_snapshot()
+                for seq, _, _ in plan:
+                    os.remove(self._segment_path(seq))
+        return len(plan)
+
+    def start_background_compaction(self, interval=600):
+        def run():
+            while not self._stop_compaction.wait(interval):
+                self.compact()
+        self._compaction_thread = threading.Thread(target=run, name="segment-compaction", daemon=True)
+        self._compaction_thread.start()
+
+    def close(self):
+        if self._compaction_thread is not None:
+            self._stop_compaction.set()
+            self._compaction_thread.join()
+            self._compaction_thread = None
+        with self._lock:
+            if self._active.closed:
+                return
+            self._active.close()
+            self._write_snapshot()
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    name TEXT PRIMARY KEY,
+    keyhash TEXT NOT NULL,
+    version_shard TEXT NOT NULL,
+    first_version INTEGER NOT NULL,
+    last_version INTEGER NOT NULL,
+    depends_on_version INTEGER,
+    dependency_chain_length INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_by_keyhash ON chunks (keyhash, last_version);
+CREATE INDEX IF NOT EXISTS chunks_by_version_shard ON chunks (version_shard);
+"""
+
+_SQLITE_MAGIC = b"SQLite format 3\x00"
+
+def _sql_in(column, values):
+    values = list(values)
+    return "{} IN ({})".format(column, ",".join("?" * len(values))), values
+
+class BatchedSqlite(object):
+    # A SQLite database in WAL mode whose writes are committed in batches;
+    # uncommitted writes are visible to this connection but not to other
+    # processes until commit(). The connection may be shared with a
+    # background writer thread, so it is only used under the lock.
+    def __init__(self, path, schema, batch_size, max_batch_delay=5.0):
+        self._path = path
+        self._batch_size = batch_size
+        self._max_batch_delay = max_batch_delay
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(schema)
+        self._uncommitted = 0
+        self._batch_started = None
+
+    def _begin_if_needed(self):
+        if self._batch_started is None:
+            self._conn.execute("BEGIN")
+            self._batch_started = time.time()
+
+    def _maybe_commit(self, n):
+        self._uncommitted += n
+        if self._uncommitted >= self._batch_size or (time.time() - self._batch_started) >= self._max_batch_delay:
+            self.commit()
+
+    def commit(self):
+        with self._lock:
+            if self._batch_started is None:
+                return
+            self._conn.execute("COMMIT")
+            self._batch_started = None
+            self._uncommitted = 0
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._conn.close()
+
+class SqliteStorage(BatchedSqlite, Storage):
+    # Chunk bytes are stored as BLOBs next to the fields decoded from the
+    # chunk name, so filtered listings are indexed queries.
+    def __init__(self, path, batch_size=100, max_batch_delay=5.0):
+        super().__init__(path, _SQLITE_SCHEMA, batch_size, max_batch_delay=max_batch_delay)
+
+    def __repr__(self):
+        return "SqliteStorage({})".format(repr(self._path))
+
+    @property
+    def cache_namespace(self):
+        return ("sqlite", os.path.abspath(self._path))
+
+    def list_chunks(self):
+        with self._lock:
+            return [name for (name,) in self._conn.execute("SELECT name FROM chunks ORDER BY name")]
+
+    def list_filtered_chunks(self, version_shard_filter=None, keyhash_filter=None, min_last_version=None, max_first_version=None):
+        clauses, args = [], []
+        for column, filt in (("version_shard", version_shard_filter), ("keyhash", keyhash_filter)):
+            if filt is None:
+                continue
+            if not isinstance(filt, (list, tuple)):
+                raise ValueError("unknown kind of filter: " + repr(filt))
+            clause, values = _sql_in(column, filt)
+            clauses.append(clause)
+            args.extend(values)
+        if min_last_version is not None:
+            clauses.append("last_version >= ?")
+            args.append(int(min_last_version))
+        if max_first_version is not None:
+            clauses.append("first_version <= ?")
+            args.append(int(max_first_version))
+        query = "SELECT name FROM chunks"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        with self._lock:
+            return [name for (name,) in self._conn.execute(query + " ORDER BY name", args)]
+
+    @contextlib.contextmanager
+    def write_chunk(self, filename):
+        fni = filenames.decode_filename(filename)
+        f = io.BytesIO()
+        try:
+            yield f
+            payload = f.getvalue()
+        finally:
+            f.close()
+        with self._lock:
+            self._begin_if_needed()
+            try:
+                self._conn.execute(
+                    "INSERT INTO chunks (name, keyhash, version_shard, first_version, last_version, depends_on_version, dependency_chain_length, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (filename, fni.keyhash, fni.version_shard, int(fni.first_version), int(fni.last_version),
+                     int(fni.depends_on_version) if fni.depends_on_version else None,
+                     fni.dependency_chain_length, payload))
+            except sqlite3.IntegrityError:
+                raise RuntimeError("file already exists")
+            self._maybe_commit(1)
+
+    @contextlib.contextmanager
+    def read_chunk(self, filename):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM chunks WHERE name = ?", (filename,)).fetchone()
+        if row is None:
+            raise KeyError(filename)
+        f = io.BytesIO(row[0])
+        try:
+            yield f
+        finally:
+            f.close()
+
+    def delete_chunk(self, filename):
+        with self._lock:
+            self._begin_if_needed()
+            if self._conn.execute("DELETE FROM chunks WHERE name = ?", (filename,)).rowcount != 1:
+                raise KeyError(filename)
+            self._maybe_commit(1)
+        chunkcache.invalidate_chunk(self.cache_namespace, filename)
+
+STORAGE_FORMATS = ("auto", "files", "segments", "sqlite")
+
+def is_segment_store(path):
+    return os.path.exists(os.path.join(path, _SEGMENTS_MARKER))
+
+def is_single_process_store(path, storage_format="auto"):
+    return storage_format in ("segments", "sqlite") or is_segment_store(path) or is_sqlite_store(path)
+
+def is_sqlite_store(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(_SQLITE_MAGIC)) == _SQLITE_MAGIC
+
+def open_storage(path, storage_format="auto"):
+    if storage_format == "auto":
+        if is_sqlite_store(path):
+            storage_format = "sqlite"
+        elif is_segment_store(path):
+            storage_format = "segments"
+        else:
+            storage_format = "files"
+    if storage_format == "files":
+        return LocalFileStorage(path)
+    if storage_format == "segments":
+        return SegmentStorage(path)
+    if storage_format == "sqlite":
+        return SqliteStorage(path)
+    raise ValueError("unknown storage format {} (options: {})".format(repr(storage_format), repr(STORAGE_FORMATS)))
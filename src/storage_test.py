@@ -1,4 +1,8 @@
 from .storage import *
+from .storage import _manual_filter
+
+import os
+import pytest
 
 def test_inmemory_storage():
     store = InMemoryStorage()
@@ -24,3 +28,113 @@ def test_inmemory_storage():
         f.write(b"overwrite")
     with store.read_chunk("foo/bar/baz") as f:
         assert f.read() == b"overwrite"
+
+def _chunk_name(i):
+    return filenames.encode_filename(filenames.FileInfo(
+        key="https://example.com/",
+        first_version=str(100 + i),
+        last_version=str(100 + i),
+        depends_on_version=None,
+        dependency_chain_length=0,
+    ))
+
+def test_segment_storage(tmp_path):
+    store = SegmentStorage(str(tmp_path), segment_size=100)
+    assert store.list_chunks() == []
+    for i in range(10):
+        with store.write_chunk(_chunk_name(i)) as f:
+            f.write("chunk {}".format(i).encode("utf-8") * 10)
+    with pytest.raises(RuntimeError):
+        with store.write_chunk(_chunk_name(0)) as f:
+            f.write(b"overwrite")
+    for i in range(0, 10, 2):
+        store.delete_chunk(_chunk_name(i))
+    assert store.list_chunks() == [_chunk_name(i) for i in range(1, 10, 2)]
+    assert store.list_filtered_chunks(keyhash_filter=[filenames.decode_filename(_chunk_name(1)).keyhash]) == store.list_chunks()
+    assert store.compact() > 0
+    store.close()
+    for reopened in (SegmentStorage(str(tmp_path)), open_storage(str(tmp_path))):
+        assert reopened.list_chunks() == [_chunk_name(i) for i in range(1, 10, 2)]
+        for i in range(1, 10, 2):
+            with reopened.read_chunk(_chunk_name(i)) as f:
+                assert f.read() == "chunk {}".format(i).encode("utf-8") * 10
+        reopened.close()
+
+def test_segment_compaction_replays_before_later_writes(tmp_path):
+    store = SegmentStorage(str(tmp_path), segment_size=100)
+    for i in range(6):
+        with store.write_chunk(_chunk_name(i)) as f:
+            f.write(b"x" * 60)
+    for i in (0, 2, 4):
+        store.delete_chunk(_chunk_name(i))
+    assert store.compact() > 0
+    store.delete_chunk(_chunk_name(1))
+    with store.write_chunk(_chunk_name(0)) as f:
+        f.write(b"rewritten")
+    store.close()
+    os.remove(os.path.join(str(tmp_path), "index.json"))
+    reopened = SegmentStorage(str(tmp_path))
+    assert reopened.list_chunks() == [_chunk_name(i) for i in (0, 3, 5)]
+    with reopened.read_chunk(_chunk_name(0)) as f:
+        assert f.read() == b"rewritten"
+    reopened.close()
+
+def test_segment_storage_recovers_without_snapshot(tmp_path):
+    store = SegmentStorage(str(tmp_path), segment_size=100)
+    for i in range(5):
+        with store.write_chunk(_chunk_name(i)) as f:
+            f.write(b"x" * 60)
+    store.delete_chunk(_chunk_name(1))
+    store._active.close()
+    segments = sorted(os.listdir(str(tmp_path)))
+    with open(os.path.join(str(tmp_path), [x for x in segments if x.startswith("segment-")][-1]), "ab") as f:
+        f.write(b'{"op": "put", "name": "torn')
+    reopened = SegmentStorage(str(tmp_path))
+    assert reopened.list_chunks() == [_chunk_name(i) for i in (0, 2, 3, 4)]
+    with reopened.write_chunk(_chunk_name(5)) as f:
+        f.write(b"after recovery")
+    with reopened.read_chunk(_chunk_name(5)) as f:
+        assert f.read() == b"after recovery"
+    reopened.close()
+
+def test_sqlite_storage(tmp_path):
+    path = str(tmp_path / "store.sqlite")
+    store = SqliteStorage(path, batch_size=3)
+    for i in range(10):
+        with store.write_chunk(_chunk_name(i)) as f:
+            f.write("chunk {}".format(i).encode("utf-8"))
+    with pytest.raises(RuntimeError):
+        with store.write_chunk(_chunk_name(0)) as f:
+            f.write(b"overwrite")
+    store.delete_chunk(_chunk_name(0))
+    keyhash = filenames.decode_filename(_chunk_name(1)).keyhash
+    assert store.list_chunks() == sorted(_chunk_name(i) for i in range(1, 10))
+    assert store.list_filtered_chunks(keyhash_filter=[keyhash]) == store.list_chunks()
+    assert store.list_filtered_chunks(keyhash_filter=["0" * 64]) == []
+    assert store.list_filtered_chunks(keyhash_filter=[keyhash], min_last_version="103", max_first_version="105") == [_chunk_name(i) for i in (3, 4, 5)]
+    assert _manual_filter(store.list_chunks(), keyhash_filter=[keyhash], min_last_version="103", max_first_version="105") == [_chunk_name(i) for i in (3, 4, 5)]
+    store.close()
+    reopened = open_storage(path)
+    assert isinstance(reopened, SqliteStorage)
+    with reopened.read_chunk(_chunk_name(7)) as f:
+        assert f.read() == b"chunk 7"
+    reopened.close()
+
+def test_read_chunk_buffer(tmp_path):
+    os.mkdir(str(tmp_path / "files"))
+    stores = [
+        InMemoryStorage(),
+        LocalFileStorage(str(tmp_path / "files")),
+        SqliteStorage(str(tmp_path / "store.sqlite")),
+    ]
+    for store in stores:
+        with store.write_chunk(_chunk_name(1)) as f:
+            f.write(b"hello world")
+        with store.write_chunk(_chunk_name(2)) as f:
+            pass
+        with store.read_chunk_buffer(_chunk_name(1)) as buf:
+            assert isinstance(buf, memoryview)
+            assert bytes(buf[6:]) == b"world"
+        with store.read_chunk_buffer(_chunk_name(2)) as buf:
+            assert bytes(buf) == b""
+        store.close()
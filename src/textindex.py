@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import click
+import collections
+
+import blobs
+import datadiff
+import filenames
+import methods
+import storage
+
+# An inverted index from the trigrams of each key's (case-folded, UTF-8)
+# content to the version intervals during which the content contained them.
+# Only changes are recorded: a new version adds rows for the trigrams it
+# gained and closes the intervals of those it lost. Content that is not
+# valid UTF-8 indexes as empty.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS postings (
+    trigram TEXT NOT NULL,
+    keyhash TEXT NOT NULL,
+    first_version INTEGER NOT NULL,
+    last_version INTEGER,
+    PRIMARY KEY (trigram, keyhash, first_version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_open ON postings (keyhash, last_version);
+CREATE TABLE IF NOT EXISTS keys (
+    keyhash TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    last_version INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Above this many candidate keys, a trigram's postings are read for all
+# keys rather than looked up key by key.
+_MAX_KEYHASH_LOOKUPS = 200
+
+# Postings are counted up to this many when ordering a query's trigrams.
+_MAX_COUNTED_POSTINGS = 10000
+
+def trigrams(text):
+    text = text.casefold()
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+def _query_trigrams(text):
+    grams = sorted(trigrams(text))
+    if not grams:
+        raise ValueError("cannot search for {}: at least 3 characters are needed".format(repr(text)))
+    return grams
+
+def _incarnation_trigrams(inc):
+    text = inc.get_data_as_bytes_or_unicode()
+    if isinstance(text, bytes):
+        return set()
+    return trigrams(text)
+
+def _intersect_intervals(a, b):
+    # Both are sorted lists of disjoint [first, last) intervals, where a
+    # last of None is unbounded.
+    rv = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        first = max(a[i][0], b[j][0])
+        ends = [x for x in (a[i][1], b[j][1]) if x is not None]
+        last = min(ends) if ends else None
+        if last is None or first < last:
+            rv.append((first, last))
+        if b[j][1] is None or (a[i][1] is not None and a[i][1] < b[j][1]):
+            i += 1
+        else:
+            j += 1
+    return rv
+
+class TextIndex(storage.BatchedSqlite):
+    def __init__(self, path, batch_size=10000, max_batch_delay=5.0):
+        super().__init__(path, _SCHEMA, batch_size, max_batch_delay=max_batch_delay)
+
+    def __repr__(self):
+        return "TextIndex({})".format(repr(self._path))
+
+    def add_incarnations(self, key, keyhash, incarnations):
+        # Versions at or before the last one indexed for the key are
+        # skipped, since consecutive chunks may overlap.
+        with self._lock:
+            self._begin_if_needed()
+            row = self._conn.execute("SELECT last_version FROM keys WHERE keyhash = ?", (keyhash,)).fetchone()
+            last = row[0] if row else None
+            current = None
+            prev = None
+            n = 0
+            for inc in incarnations:
+                v = int(inc.data_version)
+                if last is not None and v <= last:
+                    continue
+                last = v
+                if inc.same_data_as(prev):
+                    continue
+                prev = inc
+                if current is None:
+                    current = set(t for (t,) in self._conn.execute("SELECT trigram FROM postings WHERE keyhash = ? AND last_version IS NULL", (keyhash,)))
+                grams = _incarnation_trigrams(inc)
+                added = grams - current
+                removed = current - grams
+                self._conn.executemany("INSERT INTO postings (trigram, keyhash, first_version, last_version) VALUES (?, ?, ?, NULL)", [(t, keyhash, v) for t in added])
+                self._conn.executemany("UPDATE postings SET last_version = ? WHERE trigram = ? AND keyhash = ? AND last_version IS NULL", [(v, t, keyhash) for t in removed])
+                current = grams
+                n += len(added) + len(removed)
+            if last is not None:
+                self._conn.execute("INSERT OR REPLACE INTO keys (keyhash, key, last_version) VALUES (?, ?, ?)", (keyhash, key, last))
+            self._maybe_commit(n + 1)
+
+    def add_entry(self, entry):
+        self.add_incarnations(entry.key, entry.keyhash, entry.incarnations())
+
+    def clear(self):
+        with self._lock:
+            self._begin_if_needed()
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM keys")
+            self.commit()
+
+    def rebuild(self, store, blob_store=None):
+        # Reconstructs every version of every key in the store.
+        self.clear()
+        keyhashes = sorted(set(filenames.decode_filename(name).keyhash for name in store.list_chunks()))
+        for kh in keyhashes:
+            names = store.list_filtered_chunks(keyhash_filter=[kh])
+            entry = datadiff.Entry.load_dumps(store, names, full_history=True, chunk_cache=None, blobs=blob_store)
+            self.add_entry(entry)
+        self.commit()
+        return len(keyhashes)
+
+    def _postings(self, trigram, keyhashes, min_version, max_version):
+        query = "SELECT keyhash, first_version, last_version FROM postings WHERE trigram = ?"
+        args = [trigram]
+        if keyhashes is not None:
+            query += " AND keyhash IN ({})".format(",".join("?" for _ in keyhashes))
+            args.extend(sorted(keyhashes))
+        if max_version is not None:
+            query += " AND first_version <= ?"
+            args.append(int(max_version))
+        if min_version is not None:
+            query += " AND (last_version IS NULL OR last_version > ?)"
+            args.append(int(min_version))
+        rv = collections.defaultdict(list)
+        with self._lock:
+            for kh, first, last in self._conn.execute(query + " ORDER BY keyhash, first_version", args):
+                rv[kh].append((first, last))
+        return rv
+
+    def _posting_count(self, trigram):
+        with self._lock:
+            (n,) = self._conn.execute("SELECT COUNT(*) FROM (SELECT 1 FROM postings WHERE trigram = ? LIMIT ?)", (trigram, _MAX_COUNTED_POSTINGS)).fetchone()
+        return n
+
+    def candidates(self, text, keyhash=None, min_version=None, max_version=None):
+        # (keyhash, first_version, last_version) intervals during which the
+        # content of a key had every trigram of text; last_version is
+        # exclusive, or None if the interval is still open. The content
+        # may still not contain text itself.
+        grams = _query_trigrams(text)
+        # Rarest first, so the candidate keys shrink quickly and the common
+        # trigrams are only looked up for them.
+        grams.sort(key=self._posting_count)
+        found = None
+        for gram in grams:
+            keyhashes = None
+            if keyhash is not None:
+                keyhashes = [keyhash]
+            elif found is not None and len(found) <= _MAX_KEYHASH_LOOKUPS:
+                keyhashes = list(found)
+            postings = self._postings(gram, keyhashes, min_version, max_version)
+            if found is None:
+                found = postings
+            else:
+                found = {kh: _intersect_intervals(found[kh], postings[kh]) for kh in found if kh in postings}
+                found = {kh: intervals for kh, intervals in found.items() if intervals}
+            if not found:
+                return []
+        return sorted((kh, first, last) for kh, intervals in found.items() for first, last in intervals)
+
+    def key_for_keyhash(self, keyhash):
+        with self._lock:
+            row = self._conn.execute("SELECT key FROM keys WHERE keyhash = ?", (keyhash,)).fetchone()
+        return row[0] if row else None
+
+def open_text_index(path):
+    if path is None:
+        return None
+    return TextIndex(path)
+
+def search(store, index, text, key=None, min_version=None, max_version=None, blob_store=None):
+    # Yields (key, version) for every version in the range whose content
+    # contains text, ignoring case. Only the candidate intervals from the
+    # index are reconstructed and checked.
+    keyhash = methods.compute_key_hash(key)["digest"] if key is not None else None
+    needle = text.casefold()
+    ranges = collections.defaultdict(list)
+    for kh, first, last in index.candidates(text, keyhash=keyhash, min_version=min_version, max_version=max_version):
+        lo = max(first, int(min_version)) if min_version is not None else first
+        hi = last - 1 if last is not None else None
+        if max_version is not None:
+            hi = int(max_version) if hi is None else min(hi, int(max_version))
+        ranges[kh].append((lo, hi))
+    for kh in sorted(ranges):
+        lo = ranges[kh][0][0]
+        hi = ranges[kh][-1][1]
+        names = datadiff._list_chunks_for_range(store, kh, min_version=lo, max_version=hi)
+        if not names:
+            continue
+        entry = datadiff.Entry.load_dumps(store, names, full_history=True, blobs=blob_store, min_version=lo, max_version=hi)
+        for lo, hi in ranges[kh]:
+            for inc in entry.versions_between(lo, hi):
+                content = inc.get_data_as_bytes_or_unicode()
+                if not isinstance(content, bytes) and needle in content.casefold():
+                    yield entry.key, inc.data_version
+
+@click.command()
+@click.option("--index", required=True,
+              help="Text index file.")
+@click.option("--data-dir", default=None,
+              help="Directory containing datawatch data; required with --rebuild and unless --candidates-only is given.")
+@click.option("--rebuild/--no-rebuild",
+              default=False, show_default=True, type=bool,
+              help="Rebuild the index from --data-dir before searching.")
+@click.option("--select-key", default=None,
+              help="Only search the versions of this key.")
+@click.option("--min-version", default=None,
+              help="Only search versions at or after this version.")
+@click.option("--max-version", default=None,
+              help="Only search versions at or before this version.")
+@click.option("--candidates-only/--no-candidates-only",
+              default=False, show_default=True, type=bool,
+              help="Only list the version intervals the index matches, without checking the content.")
+@click.option("--blob-dir", default=None,
+              help="Directory containing shared blobs, if the data uses them.")
+@click.argument("text", required=False)
+def main(index, data_dir, rebuild, select_key, min_version, max_version, candidates_only, blob_dir, text):
+    if text is not None:
+        try:
+            _query_trigrams(text)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+    idx = TextIndex(index)
+    store = storage.open_storage(data_dir) if data_dir else None
+    try:
+        blob_store = blobs.open_blob_store(blob_dir)
+        if rebuild:
+            if store is None:
+                raise click.UsageError("--rebuild requires --data-dir")
+            print("Indexed {} keys.".format(idx.rebuild(store, blob_store=blob_store)))
+        if text is None:
+            return
+        if candidates_only:
+            keyhash = methods.compute_key_hash(select_key)["digest"] if select_key else None
+            for kh, first, last in idx.candidates(text, keyhash=keyhash, min_version=min_version, max_version=max_version):
+                print("\t".join((str(first), "" if last is None else str(last), idx.key_for_keyhash(kh) or kh)))
+            return
+        if store is None:
+            raise click.UsageError("searching requires --data-dir unless --candidates-only is given")
+        for key, version in search(store, idx, text, key=select_key, min_version=min_version, max_version=max_version, blob_store=blob_store):
+            print("\t".join((version, key)))
+    finally:
+        idx.close()
+        if store is not None:
+            store.close()
+
+if __name__ == "__main__":
+    main()
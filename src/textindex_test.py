@@ -0,0 +1,48 @@
+from .textindex import *
+from .textindex import _intersect_intervals
+
+import datadiff
+import methods
+import pytest
+import storage
+
+def test_intersect_intervals():
+    assert _intersect_intervals([(1, 5), (8, None)], [(3, 10)]) == [(3, 5), (8, 10)]
+    assert _intersect_intervals([(1, None)], [(2, 3), (4, None)]) == [(2, 3), (4, None)]
+    assert _intersect_intervals([(1, 2)], [(2, 3)]) == []
+
+def _make_store(idx):
+    store = storage.InMemoryStorage()
+    coll = datadiff.Collection(store, indexes=[idx])
+    pages = {
+        "https://example.com/a": ["hello world", "hello world", "Goodbye World", "hello again", b"\xff\xfe", "hello world"],
+        "https://example.com/b": ["nothing here", "the world is round", "world peace", "world peace", "lorem ipsum", "lorem ipsum"],
+    }
+    for i in range(6):
+        for key, contents in pages.items():
+            content = contents[i]
+            coll.update_data(key, content if isinstance(content, bytes) else content.encode("utf-8"), str(1000 + 10 * i))
+        if i % 2 == 1:
+            coll.sync_and_flush_one()
+            coll.sync_and_flush_one()
+    return store
+
+def test_search(tmp_path):
+    idx = TextIndex(str(tmp_path / "text.sqlite"))
+    store = _make_store(idx)
+    a, b = "https://example.com/a", "https://example.com/b"
+    found = sorted(search(store, idx, "world"))
+    assert found == [(a, "1000"), (a, "1010"), (a, "1020"), (a, "1050"), (b, "1010"), (b, "1020"), (b, "1030")]
+    assert sorted(search(store, idx, "WORLD", key=a, min_version="1015", max_version="1050")) == [(a, "1020"), (a, "1050")]
+    assert list(search(store, idx, "hello world", min_version="1025", max_version="1045")) == []
+    assert sorted(search(store, idx, "peace")) == [(b, "1020"), (b, "1030")]
+    kha = methods.compute_key_hash(a)["digest"]
+    assert idx.candidates("goodbye", keyhash=kha) == [(kha, 1020, 1030)]
+    assert idx.key_for_keyhash(kha) == a
+    assert idx._posting_count("wor") > idx._posting_count("bye") > idx._posting_count("zzz") == 0
+    with pytest.raises(ValueError):
+        idx.candidates("hi")
+    before = sorted(idx.candidates("world"))
+    assert idx.rebuild(store) == 2
+    assert sorted(idx.candidates("world")) == before
+    idx.close()
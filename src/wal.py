@@ -0,0 +1,100 @@
+import binascii
+import json
+import os
+import time
+import zlib
+
+class WriteAheadLog(object):
+    def __init__(self, path, group_commit_delay=1.0, group_commit_bytes=4*1024*1024, clock=None):
+        self._path = path
+        self._group_commit_delay = group_commit_delay
+        self._group_commit_bytes = group_commit_bytes
+        self._clock = clock or time.time
+        self._recover()
+        self._f = open(path, "ab")
+        self._unsynced_bytes = 0
+        self._last_sync = self._clock()
+
+    def __repr__(self):
+        return "WriteAheadLog({})".format(repr(self._path))
+
+    def _valid_records(self):
+        if not os.path.exists(self._path):
+            return
+        offset = 0
+        with open(self._path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    return
+                offset += len(line)
+                yield offset, record
+
+    def _recover(self):
+        # A crash can leave a partially written last record; drop it so
+        # that new records are appended after the last complete one.
+        valid = 0
+        for offset, _ in self._valid_records():
+            valid = offset
+        if os.path.exists(self._path) and os.path.getsize(self._path) > valid:
+            with open(self._path, "r+b") as f:
+                f.truncate(valid)
+
+    def append(self, key, data_version, content_hash, data=None):
+        record = {
+            "key": key,
+            "version": data_version,
+            "content_hash": content_hash,
+        }
+        if data is None:
+            record["content"] = {"unchanged": True}
+        else:
+            record["content"] = {
+                "full_compressed": {
+                    "method": "zlib.compress",
+                    "data": binascii.b2a_base64(zlib.compress(data, 1)).decode("utf-8").strip(),
+                },
+            }
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        self._f.write(line)
+        self._unsynced_bytes += len(line)
+        if self._unsynced_bytes >= self._group_commit_bytes:
+            self.sync()
+        else:
+            self.sync_if_due()
+
+    def sync_if_due(self):
+        if self._unsynced_bytes and (self._clock() - self._last_sync) >= self._group_commit_delay:
+            self.sync()
+
+    def sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._unsynced_bytes = 0
+        self._last_sync = self._clock()
+
+    def replay(self):
+        self._f.flush()
+        for _, record in self._valid_records():
+            content = record["content"]
+            if content.get("unchanged"):
+                data = None
+            else:
+                data = zlib.decompress(binascii.a2b_base64(content["full_compressed"]["data"]))
+            yield record["key"], record["version"], record["content_hash"], data
+
+    def truncate(self):
+        self._f.flush()
+        self._f.truncate(0)
+        os.fsync(self._f.fileno())
+        self._unsynced_bytes = 0
+        self._last_sync = self._clock()
+
+    def close(self):
+        if self._f.closed:
+            return
+        self.sync()
+        self._f.close()
@@ -0,0 +1,29 @@
+from .wal import *
+
+def test_append_and_replay(tmp_path):
+    path = str(tmp_path / "wal.log")
+    log = WriteAheadLog(path)
+    log.append("k1", "100", {"method": "sha256-hex", "digest": "aa"}, b"hello")
+    log.append("k1", "200", {"method": "sha256-hex", "digest": "aa"})
+    log.close()
+    log = WriteAheadLog(path)
+    assert list(log.replay()) == [
+        ("k1", "100", {"method": "sha256-hex", "digest": "aa"}, b"hello"),
+        ("k1", "200", {"method": "sha256-hex", "digest": "aa"}, None),
+    ]
+    log.truncate()
+    assert list(log.replay()) == []
+    log.close()
+
+def test_torn_tail_is_dropped(tmp_path):
+    path = str(tmp_path / "wal.log")
+    log = WriteAheadLog(path)
+    log.append("k1", "100", {"method": "sha256-hex", "digest": "aa"}, b"hello")
+    log.close()
+    with open(path, "ab") as f:
+        f.write(b'{"key": "k1", "vers')
+    log = WriteAheadLog(path)
+    log.append("k1", "300", {"method": "sha256-hex", "digest": "bb"}, b"world")
+    assert [r[1] for r in log.replay()] == ["100", "300"]
+    log.close()
+
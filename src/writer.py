@@ -0,0 +1,54 @@
+import queue
+import threading
+
+class BackgroundWriter(object):
+    def __init__(self, max_pending=64):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                f, args = item
+                # Once a write has failed, later writes may depend on it
+                # (e.g. chained chunks), so skip them rather than write them.
+                if self._error is None:
+                    try:
+                        f(*args)
+                    except BaseException as e:
+                        self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError("background write failed") from self._error
+
+    def submit(self, f, *args):
+        if self._closed:
+            raise RuntimeError("writer is closed")
+        self._raise_if_failed()
+        # Blocks while the queue is full.
+        self._queue.put((f, args))
+
+    def drain(self):
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_if_failed()
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
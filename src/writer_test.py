@@ -0,0 +1,39 @@
+from .writer import *
+
+import pytest
+import threading
+
+def test_writes_run_in_order_and_drain():
+    w = BackgroundWriter(max_pending=2)
+    done = []
+    for i in range(10):
+        w.submit(done.append, i)
+    w.drain()
+    assert done == list(range(10))
+    w.close()
+    with pytest.raises(RuntimeError):
+        w.submit(done.append, 10)
+
+def test_backpressure():
+    w = BackgroundWriter(max_pending=1)
+    release = threading.Event()
+    w.submit(release.wait)
+    w.submit(lambda: None)
+    blocked = threading.Thread(target=w.submit, args=(lambda: None,))
+    blocked.start()
+    blocked.join(timeout=0.1)
+    assert blocked.is_alive()
+    release.set()
+    blocked.join()
+    w.close()
+
+def test_failure_is_reported_and_stops_later_writes():
+    w = BackgroundWriter()
+    done = []
+    def fail():
+        raise IOError("disk full")
+    w.submit(fail)
+    w.submit(done.append, 1)
+    with pytest.raises(RuntimeError):
+        w.drain()
+    assert done == []
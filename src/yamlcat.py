@@ -8,6 +8,7 @@ import sys
 import yaml
 import storage
 import datadiff
+import blobs
 import hashlib
 import methods
 
@@ -33,7 +34,9 @@ import methods
               help="Select only a specific set of keys.")
 @click.option("--value-type", default="auto", show_default=True,
               help="Choose kind of value to output.")
-def main(data_dir, include_unchanged, omit_data, extra_info, select_key, value_type):
+@click.option("--blob-dir", default=None,
+              help="Directory containing shared blobs, if the data uses them.")
+def main(data_dir, include_unchanged, omit_data, extra_info, select_key, value_type, blob_dir):
     valuedecoders = {
         "auto": lambda rev: rev.get_data_as_bytes_or_unicode(),
         "raw": lambda rev: rev.data,
@@ -44,9 +47,10 @@ def main(data_dir, include_unchanged, omit_data, extra_info, select_key, value_t
     except KeyError:
         raise ValueError("unknown or unhandled --value_type: {} (options: {})".format(repr(value_type), repr(list(valuedecoders))))
     stream = datadiff.read_streaming(
-        store=storage.LocalFileStorage(data_dir),
+        store=storage.open_storage(data_dir),
         key_filter=select_key or None,
-        include_unchanged=include_unchanged)
+        include_unchanged=include_unchanged,
+        blobs=blobs.open_blob_store(blob_dir))
     for entry, revision in stream:
         record = {
             "key": entry.key,